@@ -0,0 +1,306 @@
+import decimal
+import threading
+
+from django.conf import settings
+from django.db.models import Sum, Count, Max, F, DecimalField
+from django.db.models.functions import ExtractYear, ExtractMonth, ExtractDay
+from django.utils import timezone
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import database.models
+
+from .backup import CHANGE_MARGIN
+
+
+DIMENSIONS = ('year', 'month', 'day', 'product', 'category', 'source', 'supplier', 'customer', 'credit')
+MEASURES = ('sales', 'profit', 'units', 'quantity', 'returned', 'lines')
+MONEY_MEASURES = ('sales', 'profit')
+
+
+def format_money(mils):
+    return str(decimal.Decimal(int(mils)).scaleb(-3))
+
+
+# Sales facts of every invoice line held as columns in memory, so arbitrary group-by queries are answered with
+# vectorized aggregation instead of a fresh SQL aggregate each time. Money is kept in integer thousandths so sums
+# are exact. Lines and products changed since the last query are merged in before each query, using the indexed
+# modified columns and the deletion log, and product attributes are looked up at query time so a product moved
+# to another category is reported under its new one. Lines are kept sorted by id so they are found by binary
+# search.
+class SalesCube(object):
+    LINE_COLUMNS = [('id', 'int64'), ('date', 'datetime64[D]'), ('customer', 'int64'), ('credit', 'int64'),
+                    ('product', 'int64'), ('quantity', 'int64'), ('returned', 'int64'), ('sell', 'int64'),
+                    ('cost', 'int64'), ('live', 'bool')]
+    PRODUCT_COLUMNS = ['category', 'source', 'supplier']
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.refreshed = None
+        self.marker = None
+        self.lines = {name: numpy.empty(0, dtype=dtype) for name, dtype in self.LINE_COLUMNS}
+        self.products = {name: numpy.zeros(0, dtype='int64') for name in self.PRODUCT_COLUMNS}
+
+    # The latest line modification and deletion log entry, both read from an index. A restore brings back an
+    # earlier state and empties the deletion log, so one of them goes back.
+    @staticmethod
+    def change_marker():
+        modified = database.models.InvoiceProduct.objects.aggregate(modified=Max('modified'))['modified']
+        deleted = database.models.DeletedRow.objects.aggregate(id=Max('id'))['id']
+        return modified, deleted or 0
+
+    def refresh(self):
+        marker = self.change_marker()
+        if self.marker is not None and (marker[1] < self.marker[1] or
+                                        (self.marker[0] is not None and (marker[0] is None or marker[0] < self.marker[0]))):
+            self.clear()
+
+        self.load(self.refreshed - CHANGE_MARGIN if self.refreshed is not None else None)
+        self.marker = marker
+
+    def load(self, since=None):
+        now = timezone.now()
+        fields = ('id', 'invoice__date_of_sale', 'invoice__customer_id', 'invoice__credit', 'product_id', 'quantity',
+                  'returned_quantity', 'sell_price', 'cost_price')
+        lines = database.models.InvoiceProduct.objects.order_by()
+        products = database.models.Product.objects.all()
+        deleted = []
+
+        if since is None:
+            lines = list(lines.values_list(*fields))
+        else:
+            # Editing an invoice can change the date, customer or credit of lines that were not saved themselves.
+            # Two queries so each is served by its modified index.
+            changed_invoices = database.models.Invoice.objects.filter(modified__gte=since).values('id')
+            lines = {line[0]: line for queryset in (lines.filter(modified__gte=since),
+                                                    lines.filter(invoice__in=changed_invoices))
+                     for line in queryset.values_list(*fields)}
+            lines = list(lines.values())
+            products = products.filter(modified__gte=since)
+            deleted = list(database.models.DeletedRow.objects.filter(model='database.invoiceproduct',
+                                                                     deleted__gte=since)
+                                                             .values_list('object_id', flat=True))
+
+        self.merge_products(list(products.values_list('id', 'category_id', 'source_id', 'supplier_id')))
+        self.merge_lines(lines)
+
+        if deleted:
+            rows, found = self.find(numpy.array(deleted, dtype='int64'))
+            self.lines['live'][rows[found]] = False
+        self.refreshed = now
+
+    # Rows of the given line ids and whether each was found
+    def find(self, ids):
+        rows = numpy.searchsorted(self.lines['id'], ids)
+        found = rows < len(self.lines['id'])
+        found[found] = self.lines['id'][rows[found]] == ids[found]
+        return rows, found
+
+    def merge_products(self, products):
+        if not products:
+            return
+
+        size = max(product[0] for product in products) + 1
+        if size > len(self.products['category']):
+            for name in self.PRODUCT_COLUMNS:
+                self.products[name] = numpy.concatenate([self.products[name],
+                                                         numpy.zeros(size - len(self.products[name]), dtype='int64')])
+
+        ids = numpy.array([product[0] for product in products])
+        for index, name in enumerate(self.PRODUCT_COLUMNS, 1):
+            self.products[name][ids] = [product[index] for product in products]
+
+    def merge_lines(self, lines):
+        if not lines:
+            return
+
+        columns = {
+            'id': numpy.array([line[0] for line in lines], dtype='int64'),
+            'date': numpy.array([timezone.localtime(line[1]).date() for line in lines], dtype='datetime64[D]'),
+            'customer': numpy.array([line[2] for line in lines], dtype='int64'),
+            'credit': numpy.array([line[3] for line in lines], dtype='int64'),
+            'product': numpy.array([line[4] for line in lines], dtype='int64'),
+            'quantity': numpy.array([line[5] for line in lines], dtype='int64'),
+            'returned': numpy.array([line[6] for line in lines], dtype='int64'),
+            'sell': numpy.array([int(line[7] * 1000) for line in lines], dtype='int64'),
+            'cost': numpy.array([int(line[8] * 1000) for line in lines], dtype='int64'),
+            'live': numpy.ones(len(lines), dtype='bool'),
+        }
+
+        # Lines seen before are updated in place, new ones are appended
+        rows, known = self.find(columns['id'])
+        if known.any():
+            for name, values in columns.items():
+                self.lines[name][rows[known]] = values[known]
+
+        new = ~known
+        if new.any():
+            start = max(len(self.lines['id']) - 1, 0)
+            for name, values in columns.items():
+                self.lines[name] = numpy.concatenate([self.lines[name], values[new]])
+
+            # New ids usually follow the existing ones in order, otherwise sort again
+            if numpy.any(numpy.diff(self.lines['id'][start:]) < 0):
+                order = numpy.argsort(self.lines['id'], kind='stable')
+                for name in self.lines:
+                    self.lines[name] = self.lines[name][order]
+
+    def dimension(self, name):
+        if name == 'year':
+            return self.lines['date'].astype('datetime64[Y]').astype('int64') + 1970
+        if name == 'month':
+            return self.lines['date'].astype('datetime64[M]').astype('int64') % 12 + 1
+        if name == 'day':
+            return (self.lines['date'] - self.lines['date'].astype('datetime64[M]')).astype('int64') + 1
+        if name in self.PRODUCT_COLUMNS:
+            return self.products[name][self.lines['product']]
+        return self.lines[name]
+
+    def measure(self, name):
+        units = self.lines['quantity'] - self.lines['returned']
+        if name == 'sales':
+            return units * self.lines['sell']
+        if name == 'profit':
+            return units * (self.lines['sell'] - self.lines['cost'])
+        if name == 'units':
+            return units
+        if name == 'lines':
+            return numpy.ones(len(units), dtype='int64')
+        return self.lines[name]
+
+    def query(self, group_by, measures, filters, start=None, end=None):
+        with self.lock:
+            self.refresh()
+
+            mask = self.lines['live'].copy()
+            if start is not None:
+                mask &= self.lines['date'] >= numpy.datetime64(start, 'D')
+            if end is not None:
+                mask &= self.lines['date'] < numpy.datetime64(end, 'D')
+            for name, ids in filters.items():
+                mask &= numpy.isin(self.dimension(name), ids)
+
+            keys = [self.dimension(name)[mask] for name in group_by]
+            values = {name: self.measure(name)[mask] for name in measures}
+
+        if keys:
+            groups, inverse = numpy.unique(numpy.stack(keys, axis=1), axis=0, return_inverse=True)
+            inverse = inverse.reshape(-1)
+        else:
+            groups, inverse = numpy.zeros((1, 0), dtype='int64'), numpy.zeros(mask.sum(), dtype='int64')
+
+        # Sums of integers stay exact in float64 well past any realistic sales total
+        totals = {name: numpy.rint(numpy.bincount(inverse, weights=column, minlength=len(groups))).astype('int64')
+                  for name, column in values.items()}
+
+        rows = []
+        for index, group in enumerate(groups):
+            row = {name: int(value) for name, value in zip(group_by, group)}
+            for name in measures:
+                value = totals[name][index]
+                row[name] = format_money(value) if name in MONEY_MEASURES else int(value)
+            rows.append(row)
+
+        return rows if keys or mask.any() else []
+
+
+# The same query answered by the database, used when NumPy is not installed or the in-memory cube is turned off
+def query_database(group_by, measures, filters, start=None, end=None):
+    dimensions = {
+        'year': ExtractYear('invoice__date_of_sale'),
+        'month': ExtractMonth('invoice__date_of_sale'),
+        'day': ExtractDay('invoice__date_of_sale'),
+        'product': F('product_id'),
+        'category': F('product__category_id'),
+        'source': F('product__source_id'),
+        'supplier': F('product__supplier_id'),
+        'customer': F('invoice__customer_id'),
+        'credit': F('invoice__credit'),
+    }
+    units = F('quantity') - F('returned_quantity')
+    money = {'output_field': DecimalField(max_digits=15, decimal_places=3)}
+    aggregates = {
+        'sales': Sum(units * F('sell_price'), **money),
+        'profit': Sum(units * (F('sell_price') - F('cost_price')), **money),
+        'units': Sum(units),
+        'quantity': Sum('quantity'),
+        'returned': Sum('returned_quantity'),
+        'lines': Count('id'),
+    }
+
+    queryset = database.models.InvoiceProduct.objects.all()
+    if start is not None:
+        queryset = queryset.filter(invoice__date_of_sale__gte=start)
+    if end is not None:
+        queryset = queryset.filter(invoice__date_of_sale__lt=end)
+
+    queryset = queryset.annotate(**{'group_' + name: expression for name, expression in dimensions.items()
+                                    if name in group_by or name in filters})
+    for name, ids in filters.items():
+        queryset = queryset.filter(**{'group_' + name + '__in': ids})
+
+    if group_by:
+        queryset = queryset.values(*['group_' + name for name in group_by])\
+                           .annotate(**{'total_' + name: aggregates[name] for name in measures})\
+                           .order_by(*['group_' + name for name in group_by])
+        results = list(queryset)
+    else:
+        results = [queryset.aggregate(rows=Count('id'), **{'total_' + name: aggregates[name] for name in measures})]
+        if not results[0]['rows']:
+            results = []
+
+    rows = []
+    for result in results:
+        row = {name: int(result['group_' + name]) for name in group_by}
+        for name in measures:
+            value = result['total_' + name] or 0
+            row[name] = '{0:.3f}'.format(value) if name in MONEY_MEASURES else int(value)
+        rows.append(row)
+
+    return rows
+
+
+cube = None
+cube_lock = threading.Lock()
+
+
+def in_memory():
+    return numpy is not None and getattr(settings, 'SALES_ANALYTICS_IN_MEMORY', False)
+
+
+# Aggregate the invoice lines by any of the DIMENSIONS. Filters map dimensions to lists of values, start and end
+# are aware datetimes bounding the date of sale. With a pivot dimension each measure becomes a {value: total} dict
+# over that dimension.
+def sales_query(group_by, measures, filters, start=None, end=None, pivot=None):
+    global cube
+
+    keys = group_by + [pivot] if pivot else group_by
+    if in_memory():
+        with cube_lock:
+            if cube is None:
+                cube = SalesCube()
+        rows = cube.query(keys, measures, filters,
+                          start=timezone.localtime(start).date() if start else None,
+                          end=timezone.localtime(end).date() if end else None)
+    else:
+        rows = query_database(keys, measures, filters, start, end)
+
+    if not pivot:
+        return rows
+
+    pivoted = dict()
+    for row in rows:
+        key = tuple(row[name] for name in group_by)
+        result = pivoted.get(key)
+        if result is None:
+            result = pivoted[key] = dict(zip(group_by, key), **{name: dict() for name in measures})
+        for name in measures:
+            result[name][str(row[pivot])] = row[name]
+
+    return list(pivoted.values())
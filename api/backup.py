@@ -0,0 +1,295 @@
+import io
+import re
+import json
+import time
+import zlib
+import logging
+import contextlib
+import tarfile
+import datetime
+import tempfile
+
+from django.apps import apps
+from django.db import connection, transaction
+from django.core import serializers
+from django.core.management.color import no_style
+from django.core.serializers.python import Deserializer as PythonDeserializer
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.dateparse import parse_datetime
+
+import database.models
+
+logger = logging.getLogger(__name__)
+
+
+# Models in the order they are backed up, with their file names inside the archive
+BACKUP_FIXTURES = [
+    ('database.Category', 'categories.json'),
+    ('database.Source', 'sources.json'),
+    ('database.Supplier', 'suppliers.json'),
+    ('database.Product', 'products.json'),
+    ('database.Customer', 'customers.json'),
+    ('database.Invoice', 'invoices.json'),
+    ('database.InvoiceProduct', 'invoice_products.json'),
+    ('database.InvoiceCreditPayment', 'payments.json'),
+]
+
+# Extra archive members, the backup's id, uuid and base, and in delta backups the rows deleted since the base
+MANIFEST = 'manifest.json'
+DELETED = 'deleted.json'
+
+# A change that commits shortly after a backup read its table can carry an earlier modified time, so deltas reach
+# back this far before the start of their base backup. Rows picked up twice are simply restored twice.
+CHANGE_MARGIN = datetime.timedelta(minutes=5)
+
+# Archive members in foreign key dependency order for restoring
+RESTORE_ORDER = [
+    'categories.json', 'sources.json', 'suppliers.json', 'customers.json',
+    'products.json', 'invoices.json', 'invoice_products.json', 'payments.json',
+]
+
+# Tables up to this size are spooled in memory before going into the archive, larger ones spill to disk
+SPOOL_MAX_SIZE = 16 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+
+# Serialize a queryset as a compact loaddata compatible JSON fixture, reading rows through a server-side cursor.
+# Returns the spooled file positioned at its start and its size in bytes.
+def dump_fixture(queryset, chunk_size=2000):
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    text = io.TextIOWrapper(spool, encoding='utf-8')
+
+    serializers.serialize('json', queryset.iterator(chunk_size=chunk_size), stream=text)
+
+    text.flush()
+    text.detach()
+    size = spool.tell()
+    spool.seek(0)
+
+    return spool, size
+
+
+def dump_json(data):
+    content = json.dumps(data, cls=DjangoJSONEncoder).encode('utf-8')
+    return io.BytesIO(content), len(content)
+
+
+# Read every table of a backup from one snapshot, so a sale that commits while the archive streams is either all
+# in it or all left out. PostgreSQL starts each query of a READ COMMITTED transaction from a new snapshot, the
+# isolation level has to be raised before the first query. Inside an outer transaction, as in the tests, its
+# isolation level applies.
+@contextlib.contextmanager
+def snapshot():
+    outermost = not connection.in_atomic_block
+    with transaction.atomic():
+        if outermost and connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+        yield
+
+
+# The (name, fileobj, size) members of a backup archive. A full backup holds every row, a delta backup only the
+# rows modified and deleted since the given time. The tables are read as the archive reaches them, in one snapshot
+# held until the last one is dumped.
+def backup_members(record, since=None):
+    with snapshot():
+        yield (MANIFEST,) + dump_json({'backup': record.id, 'uuid': record.uuid, 'base': record.base_id,
+                                       'base_uuid': record.base.uuid if record.base else None, 'taken': record.taken})
+
+        for fixture, filename in BACKUP_FIXTURES:
+            queryset = apps.get_model(fixture)._base_manager.order_by('pk')
+            if since is not None:
+                queryset = queryset.filter(modified__gte=since)
+
+            yield (filename,) + dump_fixture(queryset)
+
+        if since is not None:
+            deleted = database.models.DeletedRow.objects.filter(deleted__gte=since).order_by('pk')
+            yield (DELETED,) + dump_json(list(deleted.values('model', 'object_id')))
+
+
+def read_manifest(archive):
+    if MANIFEST not in archive.getnames():
+        return None
+
+    return json.loads(archive.extractfile(MANIFEST).read().decode('utf-8'))
+
+
+# Whether a delta backup was taken on top of the previous backup. A restore empties the backup table, so ids are
+# used again and only the uuids tell two backups apart. Archives written before uuids were added are checked by
+# the time they were taken instead.
+def follows(manifest, previous):
+    if manifest['base'] != previous['backup']:
+        return False
+    if manifest.get('base_uuid') and previous.get('uuid'):
+        return manifest['base_uuid'] == previous['uuid']
+    return parse_datetime(manifest['taken']) > parse_datetime(previous['taken'])
+
+
+# Write (name, fileobj, size) members as a gzipped tar archive, yielding compressed bytes as they are produced so
+# the archive can be sent to the client while it is still being built
+def stream_tar_gz(members, compresslevel=6):
+    # wbits of 31 selects the gzip container
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 31)
+    written = 0
+
+    for name, fileobj, size in members:
+        tarinfo = tarfile.TarInfo(name=name)
+        tarinfo.size = size
+        tarinfo.mtime = int(time.time())
+
+        header = tarinfo.tobuf(format=tarfile.GNU_FORMAT)
+        written += len(header)
+        yield compressor.compress(header)
+
+        try:
+            chunk = fileobj.read(CHUNK_SIZE)
+            while chunk:
+                yield compressor.compress(chunk)
+                chunk = fileobj.read(CHUNK_SIZE)
+        finally:
+            fileobj.close()
+
+        padding = -size % tarfile.BLOCKSIZE
+        written += size + padding
+        yield compressor.compress(tarfile.NUL * padding)
+
+    # Two empty blocks mark the end of the archive, padded to a full record
+    end = 2 * tarfile.BLOCKSIZE
+    end += -(written + end) % tarfile.RECORDSIZE
+    yield compressor.compress(tarfile.NUL * end)
+    yield compressor.flush()
+
+
+SEPARATORS = re.compile(r'[\s,]*')
+
+
+# Yield the objects of a JSON list fixture one at a time without loading the whole file, works for both the
+# indented archives of older backups and the compact ones written by dump_fixture
+def iter_fixture(fileobj):
+    decoder = json.JSONDecoder()
+    text = io.TextIOWrapper(fileobj, encoding='utf-8')
+
+    buffer = text.read(CHUNK_SIZE).lstrip()
+    if not buffer.startswith('['):
+        raise ValueError("Fixture is not a JSON list")
+
+    position = 1
+    eof = False
+    while True:
+        position = SEPARATORS.match(buffer, position).end()
+        if buffer.startswith(']', position):
+            return
+
+        try:
+            row, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+
+            # The next object is cut off at the end of the buffer, read some more
+            chunk = text.read(CHUNK_SIZE)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+
+        yield row
+
+
+# bulk_create stamps auto_now fields with the time of the insert, put back the modified times a batch was archived
+# with so restored rows look unchanged to the next delta backup and the analytics cube. bulk_update writes the values
+# as they are, without pre_save. Rows of archives older than the column keep the restore time.
+def restore_modified(model, batch, archived):
+    fields = [field.attname for field in model._meta.concrete_fields if getattr(field, 'auto_now', False)]
+    if not fields:
+        return
+
+    for obj, values in zip(batch, archived):
+        for name, value in zip(fields, values):
+            if value is not None:
+                setattr(obj, name, value)
+    model._base_manager.bulk_update(batch, fields)
+
+
+# Insert the rows of a fixture with bulk_create in batches, skipping signals and per-row saves. With upsert, rows
+# that already exist are overwritten, as when applying a delta backup. Returns the number of rows restored.
+def load_fixture(fileobj, name, batch_size=2000, upsert=False):
+    count = 0
+    batch = []
+
+    def insert(batch):
+        model = batch[0].__class__
+        archived = [[getattr(obj, field.attname) for field in model._meta.concrete_fields
+                     if getattr(field, 'auto_now', False)] for obj in batch]
+
+        if upsert:
+            model._base_manager.bulk_create(batch, update_conflicts=True, unique_fields=[model._meta.pk.name],
+                                            update_fields=[field.name for field in model._meta.concrete_fields
+                                                           if not field.primary_key])
+        else:
+            model._base_manager.bulk_create(batch)
+        restore_modified(model, batch, archived)
+
+        logger.info("Restored %d rows from %s", count, name)
+
+    for deserialized in PythonDeserializer(iter_fixture(fileobj), ignorenonexistent=True):
+        if batch and batch[0].__class__ is not deserialized.object.__class__:
+            insert(batch)
+            batch = []
+
+        batch.append(deserialized.object)
+        count += 1
+
+        if len(batch) >= batch_size:
+            insert(batch)
+            batch = []
+
+    if batch:
+        insert(batch)
+
+    return count
+
+
+# Remove the rows listed in a delta backup, dependent rows before the rows they refer to
+def apply_deleted(fileobj):
+    deleted = dict()
+    for row in json.loads(fileobj.read().decode('utf-8')):
+        deleted.setdefault(row['model'], []).append(row['object_id'])
+
+    fixture_models = {filename: fixture for fixture, filename in BACKUP_FIXTURES}
+    count = 0
+    for filename in reversed(RESTORE_ORDER):
+        model = apps.get_model(fixture_models[filename])
+        if model._meta.label_lower in deleted:
+            count += model._base_manager.filter(pk__in=deleted[model._meta.label_lower]).delete()[0]
+
+    return count
+
+
+# Restore every fixture found in a backup archive, in dependency order, then move the id sequences past the
+# restored rows. Must run inside a transaction, on an empty database for a full backup or on top of the restored
+# base for a delta (upsert). Returns a (name, count) pair per fixture.
+def restore_archive(archive, batch_size=2000, upsert=False):
+    names = set(archive.getnames())
+    results = []
+
+    for name in RESTORE_ORDER:
+        if name not in names:
+            continue
+
+        fileobj = archive.extractfile(name)
+        try:
+            results.append((name, load_fixture(fileobj, name, batch_size, upsert)))
+        finally:
+            fileobj.close()
+
+    if upsert and DELETED in names:
+        results.append((DELETED, apply_deleted(archive.extractfile(DELETED))))
+
+    statements = connection.ops.sequence_reset_sql(no_style(), apps.get_app_config('database').get_models())
+    with connection.cursor() as cursor:
+        for sql in statements:
+            cursor.execute(sql)
+
+    return results
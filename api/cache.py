@@ -0,0 +1,46 @@
+import uuid
+import hashlib
+
+from django.core.cache import caches
+from django.db import transaction
+
+
+CATALOGUE_CACHE = 'catalogue'
+VERSION_KEY = 'version'
+
+
+# The current catalogue version, a random token kept in the catalogue cache and replaced by invalidate_catalogue on
+# every write, so checking an ETag costs no queries. A token lost to eviction is replaced by a new one, which only
+# costs a cache miss. Worker processes only see each other's writes through a cache they share, see CACHES.
+def catalogue_version():
+    cache = caches[CATALOGUE_CACHE]
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, uuid.uuid4().hex, timeout=None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def catalogue_etag(version, request):
+    key = '{0}|{1}|{2}'.format(version, request.get_full_path(), request.accepted_media_type)
+    return '"{0}"'.format(hashlib.md5(key.encode('utf-8')).hexdigest())
+
+
+def get_catalogue(etag):
+    return caches[CATALOGUE_CACHE].get(etag)
+
+
+def set_catalogue(etag, data):
+    caches[CATALOGUE_CACHE].set(etag, data)
+
+
+def new_catalogue_version():
+    cache = caches[CATALOGUE_CACHE]
+    cache.clear()
+    cache.set(VERSION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+# Move to a new catalogue version once the change is committed, so a concurrent request can not cache the old rows
+# under the new version. Clearing the cache frees the entries of the old version straight away.
+def invalidate_catalogue():
+    transaction.on_commit(new_catalogue_version)
@@ -1,5 +1,4 @@
 from django.db.models import F
-from django.db.models.functions import Coalesce
 from django_filters import rest_framework as filters
 
 import database.models
@@ -35,9 +34,10 @@ class InvoiceFilter(filters.FilterSet):
             'id': ['exact',],
         }
 
+    # Together with credit=true this is served by the receivable partial index
     def filter_unpaid_invoices(self, queryset, name, value):
         if value:
-            queryset = queryset.filter(invoice_total__gt=Coalesce(F('payments_total'), 0.0))
+            queryset = queryset.filter(invoice_total__gt=F('payments_total'))
         return queryset
 
     def filter_last_invoice(self, queryset, name, value):
@@ -0,0 +1,200 @@
+import io
+import json
+import time
+import random
+import platform
+import statistics
+
+import django
+import xlwt
+
+from django.db import connection
+from django.db.models import F
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+from django.utils import timezone
+from django.core.management.base import BaseCommand
+
+import database.models
+from database import sample_data
+
+
+# Time a request and count its queries, reading streamed bodies to the end
+def measure(send):
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        response = send()
+        size = len(b''.join(response.streaming_content) if response.streaming else response.content)
+        elapsed = time.perf_counter() - start
+
+    if response.status_code >= 400:
+        raise RuntimeError("HTTP {0}: {1}".format(response.status_code, response.content[:500]))
+
+    return elapsed, len(queries), size
+
+
+class Command(BaseCommand):
+    help = "Generate synthetic data in a throwaway test database, time the invoice, payment, report, backup and " \
+           "stock spreadsheet endpoints and write a JSON report that can be diffed between versions"
+
+    def add_arguments(self, parser):
+        sample_data.add_scale_arguments(parser)
+        parser.add_argument('--repeat', type=int, default=5, help="Runs of each benchmark")
+        parser.add_argument('--only', help="Comma separated benchmark names to run")
+        parser.add_argument('--output', help="Write the report to this file instead of stdout")
+        parser.add_argument('--keepdb', action='store_true', help="Reuse the test database and its data if it exists")
+
+    def handle(self, *args, **options):
+        scale = {name: options[name] for name in sample_data.DEFAULT_SCALE}
+
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options['keepdb'])
+        try:
+            if database.models.Invoice.objects.exists():
+                counts = {model._meta.label: model.objects.count() for model in
+                          [database.models.Product, database.models.Customer, database.models.Invoice,
+                           database.models.InvoiceProduct, database.models.InvoiceCreditPayment]}
+            else:
+                self.stderr.write("Generating data...")
+                start = time.perf_counter()
+                counts = sample_data.generate(seed=options['seed'], **scale)
+                self.stderr.write("Generated data in {0:.1f}s".format(time.perf_counter() - start))
+
+            only = set(options['only'].split(',')) if options['only'] else None
+            results = self.run_benchmarks(options['repeat'], only, random.Random(options['seed']))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+
+        report = {
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'database_version': '.'.join(str(part) for part in connection.get_database_version()),
+                'date': timezone.now().isoformat(),
+            },
+            'scale': dict(scale, seed=options['seed']),
+            'rows': counts,
+            'benchmarks': results,
+        }
+
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as report_file:
+                report_file.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+    def run_benchmarks(self, repeat, only, rng):
+        client = Client()
+        models = database.models
+
+        year = timezone.localdate().year
+        product_ids = list(models.Product.objects.values_list('id', flat=True))
+        customer_ids = list(models.Customer.objects.values_list('id', flat=True))
+        credit_invoice = models.Invoice.objects.receivable().order_by(F('payments_total') - F('invoice_total')).first()
+        return_invoice = models.Invoice.objects.filter(credit=False).latest('id')
+        return_line = return_invoice.products.first()
+        backup = dict()
+
+        def invoice_data(lines):
+            return {'customer': rng.choice(customer_ids), 'credit': False,
+                    'products': [{'product': product_id, 'quantity': rng.randint(1, 5), 'sell_price': '1.000'}
+                                 for product_id in rng.sample(product_ids, lines)]}
+
+        def post_json(url, data):
+            return lambda: client.post(url, json.dumps(data() if callable(data) else data),
+                                       content_type='application/json')
+
+        def get(url):
+            return lambda: client.get(url)
+
+        def toggle_return():
+            return_line.refresh_from_db()
+            returned_quantity = 0 if return_line.returned_quantity else 1
+            return client.patch('/api/v1/invoices/{0}/'.format(return_invoice.id), json.dumps(
+                {'products': [{'product': return_line.product_id, 'quantity': return_line.quantity,
+                               'sell_price': str(return_line.sell_price), 'returned_quantity': returned_quantity}]}),
+                content_type='application/json')
+
+        def post_payment():
+            return client.post('/api/v1/payments/', json.dumps({'invoice': credit_invoice.id, 'payment': '0.010'}),
+                               content_type='application/json')
+
+        def take_backup():
+            response = client.get('/api/v1/external/backup_db/')
+            backup['archive'] = b''.join(response.streaming_content)
+            response.streaming_content = [backup['archive']]
+            return response
+
+        def restore_backup():
+            archive = io.BytesIO(backup['archive'])
+            archive.name = 'backup.tar.gz'
+            return client.post('/api/v1/external/restore_db/', {'file': archive})
+
+        def import_stock():
+            workbook = xlwt.Workbook()
+            sheet = workbook.add_sheet('Stock')
+            for col, heading in enumerate(['ID', 'Stock']):
+                sheet.write(0, col, heading)
+            for row, (product_id, stock) in enumerate(models.Product.objects.values_list('id', 'stock'), 1):
+                sheet.write(row, 0, product_id)
+                sheet.write(row, 1, stock + 1)
+
+            spreadsheet = io.BytesIO()
+            workbook.save(spreadsheet)
+            spreadsheet.seek(0)
+            spreadsheet.name = 'stock.xls'
+            return client.post('/api/v1/external/stock/', {'file': spreadsheet})
+
+        benchmarks = [
+            ('invoice_create', post_json('/api/v1/invoices/', lambda: invoice_data(5))),
+            ('invoice_create_bulk_20', post_json('/api/v1/invoices/bulk/', lambda: [invoice_data(5) for _ in range(20)])),
+            ('invoice_return', toggle_return),
+            ('payment_post', post_payment),
+            ('products_list', get('/api/v1/products/')),
+            ('customers_statistics', get('/api/v1/customers/?expand=statistics')),
+            ('sales_total_year', get('/api/v1/sales/total/?year={0}&group_by=month'.format(year))),
+            ('sales_products_year', get('/api/v1/sales/products/?year={0}'.format(year))),
+            ('sales_customers_year', get('/api/v1/sales/customers/?year={0}'.format(year))),
+            ('sales_suppliers_year', get('/api/v1/sales/suppliers/?year={0}'.format(year))),
+            ('sales_category_year', get('/api/v1/sales/category_source/?type=category&year={0}'.format(year))),
+            ('cashflow_total_year', get('/api/v1/cashflow/total/?year={0}'.format(year))),
+            ('products_search', get('/api/v1/products/search/?q=bolt')),
+            ('products_companions', get('/api/v1/products/{0}/companions/'.format(return_line.product_id))),
+            ('stock_sold_total', get('/api/v1/stock/sold/total/')),
+            ('stock_velocity', get('/api/v1/stock/velocity/')),
+            ('stock_reorder', get('/api/v1/stock/reorder/')),
+            ('receivables', get('/api/v1/receivables/')),
+            ('stock_export_xls', get('/api/v1/external/stock/')),
+            ('stock_export_xlsx', get('/api/v1/external/stock/?export=xlsx')),
+            ('stock_import_xls', import_stock),
+            ('backup', take_backup),
+            ('restore', restore_backup),
+        ]
+
+        results = dict()
+        for name, send in benchmarks:
+            if only and name not in only:
+                continue
+            # Product search relies on PostgreSQL trigram functions
+            if name == 'products_search' and connection.vendor != 'postgresql':
+                continue
+            if name == 'restore' and 'archive' not in backup:
+                take_backup()
+
+            runs = [measure(send) for _ in range(repeat)]
+            timings = [elapsed * 1000 for elapsed, queries, size in runs]
+            results[name] = {
+                'runs': repeat,
+                'queries': runs[-1][1],
+                'bytes': runs[-1][2],
+                'min_ms': round(min(timings), 3),
+                'median_ms': round(statistics.median(timings), 3),
+                'max_ms': round(max(timings), 3),
+            }
+            self.stderr.write("{0}: median {1:.1f}ms, {2} queries".format(name, results[name]['median_ms'],
+                                                                         results[name]['queries']))
+
+        return results
@@ -0,0 +1,203 @@
+import re
+import time
+import random
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connection
+from django.http import HttpResponse, Http404
+from rest_framework.response import Response
+
+logger = logging.getLogger(__name__)
+
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# Histograms kept per route and method, with their help text and bucket bounds
+HISTOGRAMS = [
+    ('api_request_duration_seconds', "Time to handle a request, up to the first byte of a streamed body", DURATION_BUCKETS),
+    ('api_request_db_seconds', "Time spent in database queries per request", DURATION_BUCKETS),
+    ('api_request_serialize_seconds', "Time spent building serializer data, with its queries", DURATION_BUCKETS),
+    ('api_request_render_seconds', "Time for the renderer to encode the response body", DURATION_BUCKETS),
+    ('api_request_queries', "Database queries per request", QUERY_BUCKETS),
+]
+
+# Statements included in a slow request log entry
+SLOW_LOG_STATEMENTS = 50
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield '{0:g}'.format(bound), cumulative
+        yield '+Inf', self.count
+
+
+# Histograms of the sampled requests of this process, in the Prometheus text exposition format
+class Registry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = dict()
+
+    def observe(self, route, method, values):
+        with self.lock:
+            histograms = self.routes.get((route, method))
+            if histograms is None:
+                histograms = self.routes[(route, method)] = {name: Histogram(buckets)
+                                                             for name, _, buckets in HISTOGRAMS}
+            for name, value in values.items():
+                histograms[name].observe(value)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, help_text, _ in HISTOGRAMS:
+                lines.append('# HELP {0} {1}'.format(name, help_text))
+                lines.append('# TYPE {0} histogram'.format(name))
+
+                for (route, method), histograms in sorted(self.routes.items()):
+                    histogram = histograms[name]
+                    labels = 'route="{0}",method="{1}"'.format(route.replace('\\', '\\\\').replace('"', '\\"'), method)
+                    for bound, count in histogram.samples():
+                        lines.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(name, labels, bound, count))
+                    lines.append('{0}_sum{{{1}}} {2}'.format(name, labels, histogram.sum))
+                    lines.append('{0}_count{{{1}}} {2}'.format(name, labels, histogram.count))
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+# Per request measurements, installed as a database execute wrapper to count and time every query
+class RequestMetrics(object):
+    def __init__(self, keep_sql):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.serialize_seconds = 0.0
+        self.render_start = None
+        self.render_seconds = 0.0
+        self.statements = [] if keep_sql else None
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.queries += 1
+            self.db_seconds += elapsed
+            if self.statements is not None and len(self.statements) < SLOW_LOG_STATEMENTS:
+                self.statements.append((elapsed, sql))
+
+    def rendered(self, response):
+        self.render_seconds = time.perf_counter() - self.render_start
+
+
+URL_PARAMETER = re.compile(r'\(\?P<(\w+)>[^)]*\)')
+
+
+# The URL pattern of a request, e.g. api/v1/products/<pk>/. Several router registrations share a basename and so
+# a view name, the pattern tells their endpoints apart.
+def route_label(resolver_match):
+    return URL_PARAMETER.sub(r'<\1>', resolver_match.route).replace('^', '').replace('$', '')
+
+
+# Instruments a METRICS_SAMPLE_RATE share of requests with query counts and timings per route. Sampled requests
+# slower than METRICS_SLOW_REQUEST_SECONDS are logged with their SQL. Requests that are not sampled only pay for
+# one random number.
+class MetricsMiddleware(object):
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'METRICS_SAMPLE_RATE', 0.0)
+        self.slow_seconds = getattr(settings, 'METRICS_SLOW_REQUEST_SECONDS', None)
+
+    def __call__(self, request):
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            return self.get_response(request)
+
+        metrics = request.metrics = RequestMetrics(keep_sql=self.slow_seconds is not None)
+        start = time.perf_counter()
+        with connection.execute_wrapper(metrics):
+            response = self.get_response(request)
+        duration = time.perf_counter() - start
+
+        route = route_label(request.resolver_match) if request.resolver_match else 'unmatched'
+        registry.observe(route, request.method, {
+            'api_request_duration_seconds': duration,
+            'api_request_db_seconds': metrics.db_seconds,
+            'api_request_serialize_seconds': metrics.serialize_seconds,
+            'api_request_render_seconds': metrics.render_seconds,
+            'api_request_queries': metrics.queries,
+        })
+
+        if self.slow_seconds is not None and duration >= self.slow_seconds:
+            logger.warning("Slow request %s %s took %.3fs, %d queries in %.3fs, serialized in %.3fs, "
+                           "rendered in %.3fs\n%s",
+                           request.method, request.get_full_path(), duration, metrics.queries, metrics.db_seconds,
+                           metrics.serialize_seconds, metrics.render_seconds,
+                           '\n'.join('{0:.3f}s {1}'.format(elapsed, sql) for elapsed, sql in metrics.statements))
+
+        return response
+
+    # DRF responses are rendered after the view returns, time it separately from the view
+    def process_template_response(self, request, response):
+        metrics = getattr(request, 'metrics', None)
+        if metrics is not None:
+            metrics.render_start = time.perf_counter()
+            response.add_post_render_callback(metrics.rendered)
+        return response
+
+
+# Time the serializers of sampled requests. DRF builds serializer data inside the view, where related rows are
+# fetched, so it is measured apart from the view and the renderer. Lists and single rows go through serializer_data,
+# as should the custom actions.
+class SerializerMetricsMixin(object):
+    def serializer_data(self, serializer):
+        metrics = getattr(self.request, 'metrics', None)
+        if metrics is None:
+            return serializer.data
+
+        start = time.perf_counter()
+        try:
+            return serializer.data
+        finally:
+            metrics.serialize_seconds += time.perf_counter() - start
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(self.serializer_data(self.get_serializer(page, many=True)))
+
+        return Response(self.serializer_data(self.get_serializer(queryset, many=True)))
+
+    def retrieve(self, request, *args, **kwargs):
+        return Response(self.serializer_data(self.get_serializer(self.get_object())))
+
+
+# Metrics endpoint for the Prometheus scraper, only answered for INTERNAL_IPS
+def metrics_view(request):
+    if request.META.get('REMOTE_ADDR') not in settings.INTERNAL_IPS:
+        raise Http404()
+
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
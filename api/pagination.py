@@ -0,0 +1,30 @@
+from django.core.exceptions import FieldDoesNotExist
+from rest_framework.exceptions import ParseError
+from rest_framework.pagination import CursorPagination
+
+
+# Keyset pagination, stable while new rows are inserted. Lists stay unpaginated unless the client asks for a
+# page_size or the PAGE_SIZE setting is configured.
+class KeysetPagination(CursorPagination):
+    ordering = 'id'
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+    # The cursor records only the first ordering field and pages on from it with > or <, which skips NULLs and
+    # rows that share a value. Paginated lists can only be ordered by a unique, non-null field.
+    def get_ordering(self, request, queryset, view):
+        ordering = super(KeysetPagination, self).get_ordering(request, queryset, view)
+
+        name = ordering[0].lstrip('-')
+        try:
+            field = queryset.model._meta.get_field(name)
+        except FieldDoesNotExist:
+            field = None
+        if field is None or field.null or not field.unique:
+            raise ParseError("Paginated lists can not be ordered by {0}, leave out page_size to order by it".format(name))
+
+        return ordering
+
+
+class InvoicePagination(KeysetPagination):
+    ordering = '-id'
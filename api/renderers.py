@@ -0,0 +1,33 @@
+import json
+
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+
+def render_row(row):
+    return json.dumps(row, cls=JSONEncoder, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+# Render rows one at a time, either as newline delimited JSON or as the items of a single JSON array
+def stream_rows(rows, ndjson=False):
+    if ndjson:
+        for row in rows:
+            yield render_row(row) + b'\n'
+        return
+
+    yield b'['
+    for index, row in enumerate(rows):
+        yield (b',' if index else b'') + render_row(row)
+    yield b']'
+
+
+# Newline delimited JSON, one object per line
+class NDJSONRenderer(BaseRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+
+        return b''.join(stream_rows(data if isinstance(data, list) else [data], ndjson=True))
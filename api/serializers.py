@@ -1,20 +1,38 @@
 from rest_framework import serializers
 from drf_queryfields import QueryFieldsMixin
-from django.db.models import Sum, F, DecimalField
+from django.db import transaction
+from django.utils import timezone
+from django.db.models import F, Case, When, Value, IntegerField, prefetch_related_objects
 
 import decimal
 
 import database.models as models
 
+from .cache import invalidate_catalogue
+
 
 # Customer
 class CustomerSerializer(QueryFieldsMixin, serializers.ModelSerializer):
+    outstanding_total = serializers.DecimalField(max_digits=15, decimal_places=3, read_only=True)
 
     class Meta:
         model = models.Customer
         fields = '__all__'
 
 
+class CustomerStatisticsSerializer(serializers.ModelSerializer):
+    average_basket = serializers.DecimalField(max_digits=15, decimal_places=3, read_only=True)
+
+    class Meta:
+        model = models.CustomerStatistics
+        exclude = ('customer',)
+
+
+# Customer with its lifetime statistics, null for a customer without invoices
+class CustomerExpandedSerializer(CustomerSerializer):
+    statistics = CustomerStatisticsSerializer(read_only=True)
+
+
 # Source
 class SourceSerializer(QueryFieldsMixin, serializers.ModelSerializer):
     total_value = serializers.DecimalField(max_digits=15, decimal_places=3, read_only=True)
@@ -40,6 +58,22 @@ class ProductSerializer(QueryFieldsMixin, serializers.ModelSerializer):
         model = models.Product
         fields = '__all__'
 
+    @transaction.atomic
+    def create(self, validated_data):
+        product = super(ProductSerializer, self).create(validated_data)
+        adjust_inventory_value([(product.source_id, product.category_id, stock_value(product))])
+        return product
+
+    @transaction.atomic
+    def update(self, instance, validated_data):
+        # Re-read the row under lock so a concurrent sale is neither overwritten nor counted twice
+        instance = models.Product.objects.select_for_update().get(pk=instance.pk)
+        previous = (instance.source_id, instance.category_id, -stock_value(instance))
+
+        product = super(ProductSerializer, self).update(instance, validated_data)
+        adjust_inventory_value([previous, (product.source_id, product.category_id, stock_value(product))])
+        return product
+
 
 # Supplier
 class SupplierSerializer(QueryFieldsMixin, serializers.ModelSerializer):
@@ -50,37 +84,270 @@ class SupplierSerializer(QueryFieldsMixin, serializers.ModelSerializer):
 
 
 # Credit Payments
+# Post credit payments in one short transaction: lock their invoices, check each payment against the stored balance,
+# insert the payments and bring the stored totals up to date
+@transaction.atomic
+def post_payments(payments_data):
+    invoice_ids = {data["invoice"].id for data in payments_data}
+    invoices = models.Invoice.objects.select_for_update().order_by('id').in_bulk(invoice_ids)
+    balances = {invoice.id: invoice.invoice_total - invoice.payments_total for invoice in invoices.values()}
+
+    payments = []
+    for data in payments_data:
+        invoice = invoices[data["invoice"].id]
+        check_payment(invoice, data["payment"], balances[invoice.id])
+        balances[invoice.id] -= data["payment"]
+        payments.append(models.InvoiceCreditPayment(**dict(data, invoice=invoice)))
+
+    models.InvoiceCreditPayment.objects.bulk_create(payments)
+    models.Invoice.objects.refresh_totals(invoice_ids)
+    models.Customer.objects.refresh_outstanding({invoice.customer_id for invoice in invoices.values()})
+    models.CashflowEntry.objects.record([payment_cashflow(payment) for payment in payments])
+
+    return payments
+
+
+def check_payment(invoice, payment, balance):
+    if not invoice.credit:
+        raise serializers.ValidationError({"invoice": "Invoice {0} is not a credit invoice.".format(invoice.id)})
+
+    if balance <= 0:
+        raise serializers.ValidationError({"invoice": "Invoice {0} is already fully paid.".format(invoice.id)})
+
+    if payment <= 0 or payment > balance:
+        raise serializers.ValidationError({"payment": "Payment for invoice {0} must be greater than 0 and less than "
+                                                      "or equal to {1}.".format(invoice.id, balance)})
+
+
+class InvoiceCreditPaymentListSerializer(serializers.ListSerializer):
+
+    def create(self, validated_data):
+        return post_payments(validated_data)
+
+
 class InvoiceCreditPaymentSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = models.InvoiceCreditPayment
         fields = ('invoice', 'payment', 'date_of_payment',)
+        list_serializer_class = InvoiceCreditPaymentListSerializer
 
-    def validate(self, data):
-        invoice = data["invoice"]
-        current_payments = invoice.payments_total if invoice.payments_total else decimal.Decimal(0.0)
+    def create(self, validated_data):
+        return post_payments([validated_data])[0]
+
+    @transaction.atomic
+    def update(self, instance, validated_data):
+        invoice_id = validated_data["invoice"].id if "invoice" in validated_data else instance.invoice_id
+        invoices = models.Invoice.objects.select_for_update().order_by('id').in_bulk({instance.invoice_id, invoice_id})
+        instance = models.InvoiceCreditPayment.objects.select_for_update().get(pk=instance.pk)
 
-        if not invoice.credit:
-            raise serializers.ValidationError("Invoice {0} is not a credit invoice.".format(invoice.id))
+        # The payment being edited no longer counts against the balance of its invoice
+        invoice = invoices[invoice_id]
+        balance = invoice.invoice_total - invoice.payments_total
+        if instance.invoice_id == invoice_id:
+            balance += instance.payment
+        check_payment(invoice, validated_data.get("payment", instance.payment), balance)
 
-        if current_payments >= invoice.invoice_total:
-            raise serializers.ValidationError("Invoice {0} is already fully paid.".format(invoice.id))
+        original_customer_id = invoices[instance.invoice_id].customer_id
+        reversal = payment_cashflow(instance, reverse=True)
+        payment = super(InvoiceCreditPaymentSerializer, self).update(instance, dict(validated_data, invoice=invoice))
+        models.Invoice.objects.refresh_totals(list(invoices))
+        models.Customer.objects.refresh_outstanding([original_customer_id, invoice.customer_id])
+        models.CashflowEntry.objects.record([reversal, payment_cashflow(payment)])
+        return payment
 
-        max_payment = invoice.invoice_total - current_payments
-        if decimal.Decimal(data["payment"]) > max_payment:
-            raise serializers.ValidationError("Payment must be less than or equal to {0}.".format(max_payment))
 
-        return data
+# Cashflow ledger entry for a credit payment, or the entry cancelling it
+def payment_cashflow(payment, reverse=False):
+    return (payment.date_of_payment, models.CashflowEntry.CREDIT_PAYMENT,
+            -payment.payment if reverse else payment.payment, payment.invoice_id)
 
 
 # Invoice
 class InvoiceProductSerializer(serializers.ModelSerializer):
+    # Plain id so that a large invoice does not fetch its products one at a time while validating
+    product = serializers.IntegerField(source='product_id')
 
     class Meta:
         model = models.InvoiceProduct
         exclude = ('invoice', 'id',)
 
 
+# Create invoices with one locking read of their products, bulk inserts and a single stock update
+@transaction.atomic
+def create_invoices(invoices_data):
+    product_ids = {product["product_id"] for data in invoices_data for product in data["products"]}
+    product_objects = models.Product.objects.select_for_update().order_by('id').in_bulk(product_ids)
+
+    missing_ids = product_ids - set(product_objects)
+    if missing_ids:
+        raise serializers.ValidationError({"products": "Invalid product(s) {0}.".format(
+            ', '.join(str(product_id) for product_id in sorted(missing_ids)))})
+
+    invoices = []
+    invoice_products = []
+    sold_quantities = dict()
+
+    for data in invoices_data:
+        invoice = models.Invoice(invoice_total=0, profit_total=0,
+                                 **{field: value for field, value in data.items() if field != "products"})
+        invoice_products.append([])
+
+        for product in data["products"]:
+            invoice_product = models.InvoiceProduct(invoice=invoice, **dict(product,
+                                                    cost_price=product_objects[product["product_id"]].cost_price))
+            invoice_products[-1].append(invoice_product)
+
+            units = invoice_product.quantity - invoice_product.returned_quantity
+            invoice.invoice_total += units * invoice_product.sell_price
+            invoice.profit_total += units * (invoice_product.sell_price - invoice_product.cost_price)
+
+            sold_quantities[product["product_id"]] = sold_quantities.get(product["product_id"], 0) + product["quantity"]
+
+        invoices.append(invoice)
+
+    models.Invoice.objects.bulk_create(invoices)
+
+    # Set the foreign keys now that the invoices have ids
+    sold_lines = []
+    for invoice, lines in zip(invoices, invoice_products):
+        for invoice_product in lines:
+            invoice_product.invoice = invoice
+            sold_lines.append((invoice.date_of_sale, invoice.customer_id, invoice_product.product_id,
+                               invoice_product.quantity - invoice_product.returned_quantity,
+                               invoice_product.sell_price, invoice_product.cost_price))
+
+    models.InvoiceProduct.objects.bulk_create([invoice_product for lines in invoice_products for invoice_product in lines])
+
+    models.DailySales.objects.record(sold_lines)
+    models.MonthlySales.objects.record(sold_lines)
+    models.CustomerStatistics.objects.record([(invoice.customer_id, invoice.date_of_sale, 1, invoice.invoice_total,
+                                               invoice.profit_total) for invoice in invoices])
+    models.CashflowEntry.objects.record([(invoice.date_of_sale, models.CashflowEntry.INVOICE, invoice.invoice_total,
+                                          invoice.id) for invoice in invoices if not invoice.credit])
+
+    credit_customer_ids = {invoice.customer_id for invoice in invoices if invoice.credit}
+    if credit_customer_ids:
+        models.Customer.objects.refresh_outstanding(credit_customer_ids)
+
+    # Last, see adjust_inventory_value
+    adjust_stock({product_id: -quantity for product_id, quantity in sold_quantities.items()})
+
+    return invoices
+
+
+# Apply returned quantities to an invoice with one read of its line items, a bulk update and a single stock update
+@transaction.atomic
+def apply_returns(invoice, products):
+    try:
+        returned_quantities = {product["product_id"]: product["returned_quantity"] for product in products}
+    except KeyError:
+        raise serializers.ValidationError({"products": "Provide product and returned_quantity for each returned line."})
+
+    # Lock the invoice first, as the payment paths do, so a payment waits for the reduced total. Then the products
+    # before the line items, in the same order as create_invoices.
+    invoice = models.Invoice.objects.select_for_update().get(pk=invoice.pk)
+    list(models.Product.objects.select_for_update().filter(id__in=returned_quantities).order_by('id').values_list('id'))
+    invoice_products = models.InvoiceProduct.objects.select_for_update()\
+                                                    .filter(invoice=invoice, product_id__in=returned_quantities)
+    invoice_products = {invoice_product.product_id: invoice_product for invoice_product in invoice_products}
+
+    missing_ids = set(returned_quantities) - set(invoice_products)
+    if missing_ids:
+        raise serializers.ValidationError({"products": "Product(s) {0} not in invoice {1}.".format(
+            ', '.join(str(product_id) for product_id in sorted(missing_ids)), invoice.id)})
+
+    returned_products = []
+    returned_lines = []
+    stock_changes = dict()
+
+    for product_id, returned_quantity in returned_quantities.items():
+        invoice_product = invoice_products[product_id]
+
+        if returned_quantity < 0 or returned_quantity > invoice_product.quantity:
+            raise serializers.ValidationError({"products": "Return quantity for product {0} must be between 0 and {1}."
+                                               .format(product_id, invoice_product.quantity)})
+
+        change = returned_quantity - invoice_product.returned_quantity
+        if not change:
+            continue
+
+        invoice_product.returned_quantity = returned_quantity
+        invoice_product.modified = timezone.now()
+        returned_products.append(invoice_product)
+        stock_changes[product_id] = change
+        returned_lines.append((invoice.date_of_sale, invoice.customer_id, product_id, -change,
+                               invoice_product.sell_price, invoice_product.cost_price))
+
+    if not returned_products:
+        return invoice
+
+    models.InvoiceProduct.objects.bulk_update(returned_products, ['returned_quantity', 'modified'])
+    models.DailySales.objects.record(returned_lines)
+    models.MonthlySales.objects.record(returned_lines)
+    models.Invoice.objects.refresh_totals([invoice.id])
+    models.CustomerStatistics.objects.record([(invoice.customer_id, None, 0,
+        sum(units * sell_price for _, _, _, units, sell_price, _ in returned_lines),
+        sum(units * (sell_price - cost_price) for _, _, _, units, sell_price, cost_price in returned_lines))])
+
+    # Refunds of a cash invoice count against its day of sale, like the invoice total they reduce
+    if invoice.credit:
+        models.Customer.objects.refresh_outstanding([invoice.customer_id])
+    else:
+        models.CashflowEntry.objects.record([(invoice.date_of_sale, models.CashflowEntry.INVOICE,
+                                              sum(units * sell_price for _, _, _, units, sell_price, _ in returned_lines),
+                                              invoice.id)])
+
+    # Last, see adjust_inventory_value
+    adjust_stock(stock_changes)
+
+    return invoice
+
+
+# Add the given change to the stock of each product in a single UPDATE
+def adjust_stock(stock_changes):
+    if not stock_changes:
+        return
+
+    models.Product.objects.filter(id__in=stock_changes)\
+                          .update(stock=F('stock') + Case(*[When(id=product_id, then=Value(change))
+                                                            for product_id, change in stock_changes.items()],
+                                                          output_field=IntegerField()),
+                                  modified=timezone.now())
+
+    products = models.Product.objects.filter(id__in=stock_changes).values_list('id', 'source_id', 'category_id', 'cost_price')
+    adjust_inventory_value([(source_id, category_id, stock_changes[product_id] * cost_price)
+                            for product_id, source_id, category_id, cost_price in products])
+    invalidate_catalogue()
+
+
+def stock_value(product):
+    return product.stock * decimal.Decimal(str(product.cost_price))
+
+
+# Add signed stock values to the stored totals of their sources and categories, [(source_id, category_id, value)].
+# There are only a few sources and categories, so every sale updates the same rows and holds their locks until it
+# commits: concurrent sales wait on each other here even when they sell different products. That is the price of
+# reading the values without aggregating the products. Callers make it their last write to keep the wait short.
+def adjust_inventory_value(changes):
+    source_values = dict()
+    category_values = dict()
+    for source_id, category_id, value in changes:
+        source_values[source_id] = source_values.get(source_id, 0) + value
+        category_values[category_id] = category_values.get(category_id, 0) + value
+
+    models.Source.objects.adjust_values(source_values)
+    models.Category.objects.adjust_values(category_values)
+
+
+class InvoiceListSerializer(serializers.ListSerializer):
+
+    def create(self, validated_data):
+        invoices = create_invoices(validated_data)
+        prefetch_related_objects(invoices, 'products')
+        return invoices
+
+
 class InvoiceSerializer(QueryFieldsMixin, serializers.ModelSerializer):
     products = InvoiceProductSerializer(many=True)
     invoice_total = serializers.DecimalField(max_digits=15, decimal_places=3, read_only=True)
@@ -88,7 +355,8 @@ class InvoiceSerializer(QueryFieldsMixin, serializers.ModelSerializer):
 
     class Meta:
         model = models.Invoice
-        fields = '__all__'
+        exclude = ('profit_total',)
+        list_serializer_class = InvoiceListSerializer
 
     @staticmethod
     def setup_eager_loading(queryset):
@@ -117,33 +385,12 @@ class InvoiceSerializer(QueryFieldsMixin, serializers.ModelSerializer):
         return data
 
     def update(self, instance, validated_data):
-        products = validated_data.pop('products')
-
-        for product in products:
-            invoice_product = models.InvoiceProduct.objects.get(invoice=instance.id, product=product["product"])
-            original_returned_quantity = invoice_product.returned_quantity
-            invoice_product.returned_quantity = product["returned_quantity"]
-            invoice_product.save(update_fields=["returned_quantity"])
-
-            product_object = models.Product.objects.get(id=product["product"].id)
-            product_object.stock += (product["returned_quantity"] - original_returned_quantity)
-            product_object.save(update_fields=["stock"])
-
+        apply_returns(instance, validated_data.pop('products'))
+        instance.refresh_from_db(fields=['invoice_total', 'profit_total', 'payments_total'])
         return instance
 
     def create(self, validated_data):
-        products = validated_data.pop('products')
-        invoice = models.Invoice.objects.create(**validated_data)
-
-        for product in products:
-            product_object = models.Product.objects.get(id=product["product"].id)
-
-            models.InvoiceProduct.objects.create(invoice=invoice, cost_price=product_object.cost_price, **product)
-
-            product_object.stock -= product["quantity"]
-            product_object.save(update_fields=["stock"])
-
-        return invoice
+        return create_invoices([validated_data])[0]
 
 
 # Sales total
@@ -211,8 +458,38 @@ class CashflowTotalSerializer(serializers.Serializer):
     cash = serializers.DecimalField(max_digits=15, decimal_places=3, read_only=True)
 
 
+# Receivables
+class ReceivablesSerializer(serializers.Serializer):
+    customer = serializers.IntegerField(read_only=True)
+    invoices = serializers.IntegerField(read_only=True)
+    oldest_sale = serializers.DateTimeField(read_only=True)
+    outstanding = serializers.DecimalField(max_digits=15, decimal_places=3, read_only=True)
+    days_0_30 = serializers.DecimalField(max_digits=15, decimal_places=3, read_only=True)
+    days_31_60 = serializers.DecimalField(max_digits=15, decimal_places=3, read_only=True)
+    days_61_90 = serializers.DecimalField(max_digits=15, decimal_places=3, read_only=True)
+    days_over_90 = serializers.DecimalField(max_digits=15, decimal_places=3, read_only=True)
+
+
 # Stock history
 class StockSoldTotalSerializer(serializers.Serializer):
     product = serializers.IntegerField(read_only=True)
-    month = serializers.IntegerField(read_only=True)
-    quantity = serializers.IntegerField(read_only=True)
+    year = serializers.IntegerField(read_only=True)
+    month = serializers.IntegerField(source='month_number', read_only=True)
+    quantity = serializers.IntegerField(source='units_total', read_only=True)
+
+
+class StockVelocitySerializer(serializers.Serializer):
+    id = serializers.IntegerField(read_only=True)
+    supplier = serializers.IntegerField(source='supplier_id', read_only=True)
+    stock = serializers.IntegerField(read_only=True)
+    units_month = serializers.IntegerField(read_only=True)
+    units_3_months = serializers.IntegerField(read_only=True)
+    units_12_months = serializers.IntegerField(read_only=True)
+    average_3_months = serializers.FloatField(read_only=True)
+    average_12_months = serializers.FloatField(read_only=True)
+    daily_rate = serializers.FloatField(read_only=True)
+    days_of_cover = serializers.FloatField(read_only=True)
+
+
+class StockReorderSerializer(StockVelocitySerializer):
+    reorder_quantity = serializers.IntegerField(read_only=True)
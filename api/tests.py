@@ -1,3 +1,871 @@
-from django.test import TestCase
+from . import analytics, backup, metrics
+from .cache import CATALOGUE_CACHE
 
-# Create your tests here.
+import io
+import csv
+import xlwt
+import json
+import decimal
+import tarfile
+import zipfile
+import datetime
+
+from unittest import skipIf, skipUnless
+from xml.etree import ElementTree
+
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from django.db import connection
+from django.test import override_settings
+from django.core.cache import caches
+from django.apps import apps
+from django.db.models import Sum, F, Q
+
+import database.models
+
+SPREADSHEET_NAMESPACE = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+
+
+class ApiTestCase(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.supplier = database.models.Supplier.objects.create(company="Weavers")
+        cls.source = database.models.Source.objects.create(name="Kashmir")
+        cls.category = database.models.Category.objects.create(name="Shawls")
+        cls.customer = database.models.Customer.objects.create(name="Aisha")
+        cls.other_customer = database.models.Customer.objects.create(name="Omar")
+
+        cls.shawl = database.models.Product.objects.create(name="Shawl", cost_price=6, sell_price=10, stock=20,
+                                                           source=cls.source, category=cls.category,
+                                                           supplier=cls.supplier)
+        cls.scarf = database.models.Product.objects.create(name="Scarf", cost_price=2, sell_price=5, stock=30,
+                                                           source=cls.source, category=cls.category,
+                                                           supplier=cls.supplier)
+        database.models.Source.objects.refresh_values()
+        database.models.Category.objects.refresh_values()
+
+    # Writes never commit inside a test, so the catalogue cache would keep the lists of earlier tests
+    def setUp(self):
+        caches[CATALOGUE_CACHE].clear()
+
+    def line(self, product, quantity, sell_price=None, returned_quantity=0):
+        return {'product': product.id, 'quantity': quantity, 'returned_quantity': returned_quantity,
+                'sell_price': str(sell_price if sell_price is not None else product.sell_price)}
+
+    def create_invoice(self, lines, credit=False, customer=None, date_of_sale=None):
+        data = {'customer': (customer or self.customer).id, 'credit': credit, 'products': lines}
+        if date_of_sale:
+            data['date_of_sale'] = date_of_sale
+        return self.client.post('/api/v1/invoices/', data, format='json')
+
+    def stock(self, product):
+        return database.models.Product.objects.get(id=product.id).stock
+
+
+# Invoices
+class CreateInvoiceTests(ApiTestCase):
+
+    def test_create_decrements_stock(self):
+        response = self.create_invoice([self.line(self.shawl, 2), self.line(self.scarf, 3, returned_quantity=1)])
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        self.assertEqual(self.stock(self.shawl), 18)
+        self.assertEqual(self.stock(self.scarf), 27)
+
+    def test_bulk_create_sums_duplicate_products(self):
+        response = self.client.post('/api/v1/invoices/bulk/', [
+            {'customer': self.customer.id, 'credit': False,
+             'products': [self.line(self.shawl, 1), self.line(self.shawl, 2, sell_price=9)]},
+            {'customer': self.other_customer.id, 'credit': True, 'products': [self.line(self.shawl, 4)]},
+        ], format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.data), 2)
+
+        self.assertEqual(self.stock(self.shawl), 13)
+        self.assertEqual(sorted(database.models.Invoice.objects.values_list('invoice_total', flat=True)),
+                         [decimal.Decimal('28'), decimal.Decimal('40')])
+        self.assertEqual(database.models.InvoiceProduct.objects.count(), 3)
+
+    def test_bulk_create_with_missing_product_creates_nothing(self):
+        response = self.client.post('/api/v1/invoices/bulk/', [
+            {'customer': self.customer.id, 'credit': False, 'products': [self.line(self.shawl, 1)]},
+            {'customer': self.customer.id, 'credit': False,
+             'products': [self.line(self.scarf, 1), {'product': 999999, 'quantity': 1, 'sell_price': '1'}]},
+        ], format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('999999', str(response.data))
+
+        self.assertFalse(database.models.Invoice.objects.exists())
+        self.assertEqual(self.stock(self.shawl), 20)
+        self.assertEqual(self.stock(self.scarf), 30)
+
+    def test_create_stores_totals(self):
+        response = self.create_invoice([self.line(self.shawl, 2, sell_price=9), self.line(self.scarf, 3)])
+        invoice = database.models.Invoice.objects.get(id=response.data['id'])
+
+        self.assertEqual(invoice.invoice_total, decimal.Decimal('33'))
+        self.assertEqual(invoice.profit_total, decimal.Decimal('15'))
+        self.assertEqual(invoice.payments_total, 0)
+
+    def test_invoice_without_products_is_rejected(self):
+        response = self.create_invoice([])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(database.models.Invoice.objects.exists())
+
+
+# Returns
+class ReturnTests(ApiTestCase):
+
+    def setUp(self):
+        super(ReturnTests, self).setUp()
+        self.invoice_id = self.create_invoice([self.line(self.shawl, 3), self.line(self.scarf, 2)]).data['id']
+
+    def returns(self, products):
+        return self.client.patch('/api/v1/invoices/{0}/'.format(self.invoice_id),
+                                 {'products': [{'product': product.id, 'returned_quantity': quantity}
+                                               for product, quantity in products]}, format='json')
+
+    def test_return_restores_stock_and_totals(self):
+        response = self.returns([(self.shawl, 2), (self.scarf, 1)])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.assertEqual(self.stock(self.shawl), 19)
+        self.assertEqual(self.stock(self.scarf), 29)
+        self.assertEqual(decimal.Decimal(response.data['invoice_total']), decimal.Decimal('15'))
+
+    def test_return_of_more_than_sold_is_rejected(self):
+        response = self.returns([(self.scarf, 1), (self.shawl, 4)])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        self.assertEqual(self.stock(self.shawl), 17)
+        self.assertEqual(self.stock(self.scarf), 28)
+        self.assertFalse(database.models.InvoiceProduct.objects.filter(returned_quantity__gt=0).exists())
+
+
+# Credit payments
+class PaymentTests(ApiTestCase):
+
+    def setUp(self):
+        super(PaymentTests, self).setUp()
+        self.invoice_id = self.create_invoice([self.line(self.shawl, 2)], credit=True).data['id']
+
+    def pay(self, amount):
+        return self.client.post('/api/v1/payments/', {'invoice': self.invoice_id, 'payment': str(amount)}, format='json')
+
+    def test_overpayment_is_rejected(self):
+        self.assertEqual(self.pay(25).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.pay(0).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(database.models.InvoiceCreditPayment.objects.exists())
+
+        self.assertEqual(self.pay(20).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.pay(1).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(database.models.Customer.objects.get(id=self.customer.id).outstanding_total, 0)
+
+    def test_bulk_overpayment_is_rejected(self):
+        response = self.client.post('/api/v1/payments/bulk/', [{'invoice': self.invoice_id, 'payment': '15'},
+                                                               {'invoice': self.invoice_id, 'payment': '10'}],
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(database.models.InvoiceCreditPayment.objects.exists())
+
+    def test_edited_payment_cannot_exceed_the_balance(self):
+        self.pay(5)
+        self.pay(10)
+        payment_id = database.models.InvoiceCreditPayment.objects.get(payment=10).id
+
+        response = self.client.patch('/api/v1/payments/{0}/'.format(payment_id), {'payment': '16'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.patch('/api/v1/payments/{0}/'.format(payment_id), {'payment': '15'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(database.models.Invoice.objects.get(id=self.invoice_id).payments_total, decimal.Decimal('20'))
+
+    def test_deleted_payment_reopens_the_balance(self):
+        self.pay(20)
+        payment_id = database.models.InvoiceCreditPayment.objects.get().id
+
+        response = self.client.delete('/api/v1/payments/{0}/'.format(payment_id))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(database.models.Invoice.objects.get(id=self.invoice_id).payments_total, 0)
+        self.assertEqual(database.models.Customer.objects.get(id=self.customer.id).outstanding_total, 20)
+
+    def test_payment_on_cash_invoice_is_rejected(self):
+        self.invoice_id = self.create_invoice([self.line(self.shawl, 1)]).data['id']
+        self.assertEqual(self.pay(5).status_code, status.HTTP_400_BAD_REQUEST)
+
+
+# Pagination
+class PaginationTests(ApiTestCase):
+
+    def walk(self, url):
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            ids += [row['id'] for row in response.data['results']]
+            url = response.data['next']
+        return ids
+
+    def test_pages_cover_every_row_once(self):
+        for number in range(3):
+            database.models.Product.objects.create(name="Stole {0}".format(number), cost_price=1, sell_price=2,
+                                                   source=self.source, category=self.category, supplier=self.supplier)
+            self.create_invoice([self.line(self.shawl, 1)])
+
+        product_ids = list(database.models.Product.objects.order_by('id').values_list('id', flat=True))
+        self.assertEqual(self.walk('/api/v1/products/?page_size=2'), product_ids)
+
+        invoice_ids = list(database.models.Invoice.objects.order_by('-id').values_list('id', flat=True))
+        self.assertEqual(self.walk('/api/v1/invoices/?page_size=2'), invoice_ids)
+
+    # Most products have no description, a cursor on it would skip all of them after the first page
+    def test_nullable_ordering_is_rejected(self):
+        response = self.client.get('/api/v1/products/', {'ordering': '-description_sort', 'page_size': 1})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.get('/api/v1/products/', {'ordering': '-description_sort'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 2)
+
+
+# Streamed lists
+class StreamingTests(ApiTestCase):
+
+    def setUp(self):
+        super(StreamingTests, self).setUp()
+        self.create_invoice([self.line(self.shawl, 2), self.line(self.scarf, 1)], date_of_sale='2026-01-15T10:00:00Z')
+        self.create_invoice([self.line(self.scarf, 4)], customer=self.other_customer,
+                            date_of_sale='2026-01-20T10:00:00Z')
+
+    def streamed(self, url, params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        return response, b''.join(response.streaming_content).decode()
+
+    def test_stream_matches_the_list(self):
+        for url, params in [('/api/v1/invoices/', {}), ('/api/v1/sales/products/', {'year': 2026})]:
+            expected = json.loads(self.client.get(url, params).content)
+            response, content = self.streamed(url, dict(params, stream=1))
+            self.assertEqual(json.loads(content), expected, url)
+
+    def test_ndjson_has_one_row_per_line(self):
+        expected = json.loads(self.client.get('/api/v1/invoices/').content)
+        response, content = self.streamed('/api/v1/invoices/', {'format': 'ndjson'})
+        self.assertEqual(len(expected), 2)
+
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual([json.loads(line) for line in content.splitlines()], expected)
+
+
+# Backups
+class BackupTests(ApiTestCase):
+
+    def setUp(self):
+        super(BackupTests, self).setUp()
+        invoice_id = self.create_invoice([self.line(self.shawl, 2), self.line(self.scarf, 1)], credit=True).data['id']
+        self.client.post('/api/v1/payments/', {'invoice': invoice_id, 'payment': '5'}, format='json')
+
+    def backup(self, **params):
+        response = self.client.get('/api/v1/external/backup_db/', params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return b''.join(response.streaming_content), response['X-Backup-Id']
+
+    def members(self, content):
+        with tarfile.open(fileobj=io.BytesIO(content), mode='r:gz') as archive:
+            return {name: json.loads(archive.extractfile(name).read().decode('utf-8')) for name in archive.getnames()}
+
+    def test_archive_holds_every_table(self):
+        content, backup_id = self.backup()
+        members = self.members(content)
+
+        self.assertEqual(members[backup.MANIFEST]['backup'], int(backup_id))
+        self.assertIsNone(members[backup.MANIFEST]['base'])
+        for fixture, filename in backup.BACKUP_FIXTURES:
+            model = apps.get_model(fixture)
+            self.assertEqual(sorted(row['pk'] for row in members[filename]),
+                             sorted(model._base_manager.values_list('pk', flat=True)), filename)
+        self.assertEqual(len(members['invoice_products.json']), 2)
+
+    def restore(self, content, *deltas):
+        uploads = [io.BytesIO(data) for data in (content,) + deltas]
+        for number, upload in enumerate(uploads):
+            upload.name = 'backup_{0}.tar.gz'.format(number)
+        return self.client.post('/api/v1/external/restore_db/', {'file': uploads[0], 'delta': uploads[1:]},
+                                format='multipart')
+
+    # Every backed up row but its modified time, with times cut to the milliseconds kept by the JSON fixtures
+    def tables(self):
+        def row(values):
+            return {name: value.replace(microsecond=value.microsecond // 1000 * 1000)
+                    if isinstance(value, datetime.datetime) else value
+                    for name, value in values.items() if name != 'modified'}
+
+        return {filename: [row(values) for values in apps.get_model(fixture)._base_manager.order_by('pk').values()]
+                for fixture, filename in backup.BACKUP_FIXTURES}
+
+    def test_restore_roundtrip(self):
+        content, backup_id = self.backup()
+        tables = self.tables()
+        outstanding = dict(database.models.Customer.objects.values_list('id', 'outstanding_total'))
+
+        self.create_invoice([self.line(self.shawl, 5)], customer=self.other_customer, credit=True)
+        database.models.InvoiceCreditPayment.objects.all().delete()
+
+        response = self.restore(content)
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.content)
+        self.assertEqual(self.tables(), tables)
+        self.assertEqual(dict(database.models.Customer.objects.values_list('id', 'outstanding_total')), outstanding)
+        self.assertFalse(database.models.Invoice.objects.drifted().exists())
+
+    def test_broken_archive_changes_nothing(self):
+        tables = self.tables()
+
+        response = self.restore(b'not a backup')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.tables(), tables)
+
+    def modified(self):
+        return {filename: [(pk, modified.replace(microsecond=modified.microsecond // 1000 * 1000)) for pk, modified
+                           in apps.get_model(fixture)._base_manager.order_by('pk').values_list('pk', 'modified')]
+                for fixture, filename in backup.BACKUP_FIXTURES}
+
+    # Move every row out of the change margin of the next backup
+    def backdate(self):
+        for fixture, filename in backup.BACKUP_FIXTURES:
+            apps.get_model(fixture)._base_manager.update(modified=F('modified') - datetime.timedelta(hours=1))
+
+    def test_delta_chain(self):
+        self.backdate()
+        full, backup_id = self.backup()
+
+        payment = database.models.InvoiceCreditPayment.objects.get()
+        self.assertEqual(self.client.delete('/api/v1/payments/{0}/'.format(payment.id)).status_code,
+                         status.HTTP_204_NO_CONTENT)
+        self.client.patch('/api/v1/products/{0}/'.format(self.scarf.id), {'stock': 25}, format='json')
+        delta, delta_id = self.backup(since=backup_id)
+
+        members = self.members(delta)
+        self.assertEqual(members[backup.MANIFEST]['base'], int(backup_id))
+        self.assertEqual([row['pk'] for row in members['products.json']], [self.scarf.id])
+        self.assertEqual(members[backup.DELETED], [{'model': 'database.invoicecreditpayment', 'object_id': payment.id}])
+
+        tables, modified = self.tables(), self.modified()
+        database.models.Product.objects.filter(id=self.scarf.id).update(stock=0)
+
+        response = self.restore(full, delta)
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.content)
+        self.assertEqual(self.tables(), tables)
+        self.assertEqual(self.modified(), modified)
+
+    def test_delta_of_another_backup_is_rejected(self):
+        full, backup_id = self.backup()
+        delta, delta_id = self.backup(since=backup_id)
+
+        self.assertEqual(self.restore(delta).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.restore(full, delta).status_code, status.HTTP_200_OK)
+
+        # The restore emptied the backup table, a new full backup can get the id of the old one
+        full, backup_id = self.backup()
+        self.assertEqual(self.restore(full, delta).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_compression_level(self):
+        stored, backup_id = self.backup(compression=0)
+        compressed, backup_id = self.backup(compression=9)
+        self.assertLess(len(compressed), len(stored))
+
+        response = self.client.get('/api/v1/external/backup_db/', {'compression': 10})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+# Stock spreadsheets
+class StockSpreadsheetTests(ApiTestCase):
+
+    def upload(self, rows):
+        workbook = xlwt.Workbook(encoding='utf-8')
+        sheet = workbook.add_sheet('Stock')
+        for row_num, row in enumerate([["Stock count"], ["ID", "Product Name", "Stock", "Cost Price"]] + rows):
+            for col_num, value in enumerate(row):
+                sheet.write(row_num, col_num, value)
+
+        file = io.BytesIO()
+        workbook.save(file)
+        file.seek(0)
+        file.name = 'stock.xls'
+        return self.client.post('/api/v1/external/stock/', {'file': file}, format='multipart')
+
+    def export(self, export):
+        response = self.client.get('/api/v1/external/stock/', {'export': export})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return b''.join(response.streaming_content)
+
+    def test_xlsx_export(self):
+        database.models.Product.objects.filter(id=self.shawl.id).update(description="Pashmina & silk <2m>")
+
+        with zipfile.ZipFile(io.BytesIO(self.export('xlsx'))) as archive:
+            sheet = ElementTree.fromstring(archive.read('xl/worksheets/sheet1.xml'))
+        cells = {cell.get('r'): ''.join(cell.itertext()) for cell in sheet.iter('{%s}c' % SPREADSHEET_NAMESPACE)}
+
+        self.assertEqual(cells['A1'], "ID")
+        self.assertEqual(cells['J1'], "Category")
+        self.assertEqual([cells['A2'], cells['B2'], cells['C2'], cells['E2'], cells['J2']],
+                         [str(self.shawl.id), "Shawl", "Pashmina & silk <2m>", "20", "Shawls"])
+        self.assertEqual(decimal.Decimal(cells['G3']), 5)
+        self.assertNotIn('C3', cells)
+        self.assertNotIn('A4', cells)
+
+    def test_csv_export(self):
+        rows = list(csv.reader(io.StringIO(self.export('csv').decode('utf-8'))))
+
+        self.assertEqual(rows[0][:5], ["ID", "Product Name", "Description", "Size", "Stock"])
+        self.assertEqual([row[0] for row in rows[1:]], [str(self.shawl.id), str(self.scarf.id)])
+        self.assertEqual(rows[2][4], "30")
+
+    def test_unknown_export_is_rejected(self):
+        response = self.client.get('/api/v1/external/stock/', {'export': 'pdf'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_import_updates_changed_products(self):
+        response = self.upload([[self.shawl.id, "Shawl", 15, 7], [self.scarf.id, "Scarf", 30, 2],
+                                [999999, "Gone", 1, 1]])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'updated': [self.shawl.id], 'unchanged': [self.scarf.id], 'missing': [999999]})
+
+        shawl = database.models.Product.objects.get(id=self.shawl.id)
+        self.assertEqual((shawl.stock, shawl.cost_price), (15, decimal.Decimal('7')))
+        self.assertEqual(database.models.Source.objects.get(id=self.source.id).total_value, decimal.Decimal('165'))
+        self.assertFalse(database.models.Source.objects.drifted().exists())
+        self.assertFalse(database.models.Category.objects.drifted().exists())
+
+    def test_invalid_value_changes_nothing(self):
+        response = self.upload([[self.shawl.id, "Shawl", 15, 7], [self.scarf.id, "Scarf", 2.5, 2]])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.stock(self.shawl), 20)
+
+
+# Product search, trigram similarity needs PostgreSQL
+class SearchTests(ApiTestCase):
+
+    def test_missing_query_is_rejected(self):
+        response = self.client.get('/api/v1/products/search/', {'q': ' '})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @skipUnless(connection.vendor == 'postgresql', "Trigram search needs PostgreSQL")
+    def test_best_match_first(self):
+        database.models.Product.objects.filter(id=self.scarf.id).update(description="Shawl pattern")
+
+        response = self.client.get('/api/v1/products/search/', {'q': 'shawl'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([row['id'] for row in response.data], [self.shawl.id, self.scarf.id])
+
+        response = self.client.get('/api/v1/products/search/', {'q': 'shawl', 'limit': 1})
+        self.assertEqual([row['id'] for row in response.data], [self.shawl.id])
+
+        response = self.client.get('/api/v1/products/search/', {'q': 'stole'})
+        self.assertEqual(response.data, [])
+
+
+# Catalogue cache
+class CatalogueCacheTests(ApiTestCase):
+
+    def products(self, etag=None):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        return self.client.get('/api/v1/products/', **headers)
+
+    def test_unchanged_catalogue_costs_no_queries(self):
+        response = self.products()
+        etag = response['ETag']
+
+        with self.assertNumQueries(0):
+            response = self.products(etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        with self.assertNumQueries(0):
+            cached = self.products()
+        self.assertEqual(cached.status_code, status.HTTP_200_OK)
+        self.assertEqual(cached['ETag'], etag)
+        self.assertEqual(len(cached.data), 2)
+
+    def test_writes_invalidate_the_catalogue(self):
+        etag = self.products()['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch('/api/v1/products/{0}/'.format(self.shawl.id), {'stock': 5}, format='json')
+
+        response = self.products(etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual({row['id']: row['stock'] for row in response.data}[self.shawl.id], 5)
+
+        etag = response['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_invoice([self.line(self.shawl, 2)])
+
+        response = self.products(etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual({row['id']: row['stock'] for row in response.data}[self.shawl.id], 3)
+
+
+# Delta sync
+class ChangesTests(ApiTestCase):
+
+    def setUp(self):
+        super(ChangesTests, self).setUp()
+        self.walk_in = database.models.Customer.objects.create(name="Walk-in")
+        for model in [database.models.Product, database.models.Customer]:
+            model.objects.update(modified=F('modified') - datetime.timedelta(hours=1))
+
+    def changes(self, url, since=None):
+        response = self.client.get(url, {'since': since} if since else {})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_changes_since_token(self):
+        data = self.changes('/api/v1/products/changes/')
+        self.assertEqual([row['id'] for row in data['changed']], [self.shawl.id, self.scarf.id])
+        token = data['token']
+
+        self.client.patch('/api/v1/products/{0}/'.format(self.scarf.id), {'stock': 12}, format='json')
+        data = self.changes('/api/v1/products/changes/', token)
+        self.assertEqual([(row['id'], row['stock']) for row in data['changed']], [(self.scarf.id, 12)])
+        self.assertEqual(data['deleted'], [])
+
+        token = self.changes('/api/v1/customers/changes/')['token']
+        self.client.delete('/api/v1/customers/{0}/'.format(self.walk_in.id))
+        data = self.changes('/api/v1/customers/changes/', token)
+        self.assertEqual(data['changed'], [])
+        self.assertEqual(data['deleted'], [self.walk_in.id])
+
+    def test_invalid_token_is_rejected(self):
+        for since in ['yesterday', '2026-01-01T00:00:00']:
+            response = self.client.get('/api/v1/products/changes/', {'since': since})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, since)
+
+
+# Request metrics, every request is sampled
+@override_settings(METRICS_SAMPLE_RATE=1.0)
+class MetricsTests(ApiTestCase):
+
+    def setUp(self):
+        super(MetricsTests, self).setUp()
+        metrics.registry.routes.clear()
+
+    def samples(self):
+        response = self.client.get('/internal/metrics')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return dict(line.rsplit(' ', 1) for line in response.content.decode().splitlines() if not line.startswith('#'))
+
+    def test_requests_are_labelled_by_route(self):
+        self.client.get('/api/v1/products/')
+        self.client.get('/api/v1/products/{0}/'.format(self.shawl.id))
+        self.client.get('/api/v1/products/{0}/'.format(self.scarf.id))
+        self.client.get('/api/v1/customers/{0}/'.format(self.customer.id))
+
+        samples = self.samples()
+        self.assertEqual(samples['api_request_duration_seconds_count{route="api/v1/products/",method="GET"}'], '1')
+        self.assertEqual(samples['api_request_duration_seconds_count{route="api/v1/products/<pk>/",method="GET"}'], '2')
+        self.assertEqual(samples['api_request_queries_count{route="api/v1/customers/<pk>/",method="GET"}'], '1')
+        self.assertGreater(float(samples['api_request_queries_sum{route="api/v1/products/",method="GET"}']), 0)
+        self.assertGreater(float(samples['api_request_serialize_seconds_sum{route="api/v1/products/",method="GET"}']), 0)
+
+    def test_metrics_only_answer_internal_addresses(self):
+        response = self.client.get('/internal/metrics', REMOTE_ADDR='203.0.113.7')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+# Ad-hoc sales analytics, the in-memory cube must answer like the database
+@skipIf(analytics.numpy is None, "The in-memory analytics need numpy")
+class AnalyticsTests(ApiTestCase):
+
+    QUERIES = [{}, {'group_by': 'year,month'}, {'group_by': 'category', 'pivot': 'credit'},
+               {'group_by': 'customer,product', 'measures': 'sales,profit,units,quantity,returned,lines'},
+               {'group_by': 'day,month', 'year': 2026, 'month': 1}, {'pivot': 'supplier', 'credit': 1}]
+
+    def setUp(self):
+        super(AnalyticsTests, self).setUp()
+        analytics.cube = None
+
+        self.create_invoice([self.line(self.shawl, 2), self.line(self.scarf, 1)], date_of_sale='2026-01-15T10:00:00Z')
+        self.credit_id = self.create_invoice([self.line(self.shawl, 3, sell_price=9), self.line(self.scarf, 2)],
+                                             credit=True, date_of_sale='2026-02-03T18:30:00Z').data['id']
+        self.create_invoice([self.line(self.scarf, 4)], customer=self.other_customer,
+                            date_of_sale='2026-01-20T12:00:00Z')
+
+    def assertCubeMatchesDatabase(self):
+        for params in self.QUERIES:
+            with override_settings(SALES_ANALYTICS_IN_MEMORY=True):
+                in_memory = self.client.get('/api/v1/sales/analytics/', params)
+            with override_settings(SALES_ANALYTICS_IN_MEMORY=False):
+                in_database = self.client.get('/api/v1/sales/analytics/', params)
+
+            self.assertEqual(in_memory.status_code, status.HTTP_200_OK)
+            self.assertEqual(in_memory.data, in_database.data, params)
+
+    def test_cube_matches_database(self):
+        self.assertCubeMatchesDatabase()
+
+        with override_settings(SALES_ANALYTICS_IN_MEMORY=True):
+            response = self.client.get('/api/v1/sales/analytics/', {'group_by': 'customer'})
+        self.assertEqual(response.data, [
+            {'customer': self.customer.id, 'sales': '62.000', 'profit': '26.000', 'units': 8},
+            {'customer': self.other_customer.id, 'sales': '20.000', 'profit': '12.000', 'units': 4},
+        ])
+
+    def test_cube_follows_changes(self):
+        self.assertCubeMatchesDatabase()
+
+        other = database.models.Category.objects.create(name="Scarves")
+        self.client.patch('/api/v1/products/{0}/'.format(self.scarf.id), {'category': other.id}, format='json')
+        self.client.patch('/api/v1/invoices/{0}/'.format(self.credit_id),
+                          {'products': [{'product': self.shawl.id, 'returned_quantity': 1}]}, format='json')
+        self.create_invoice([self.line(self.shawl, 1)], date_of_sale='2026-02-05T10:00:00Z')
+
+        self.assertCubeMatchesDatabase()
+
+
+# Rollups kept up to date by the invoice and payment endpoints must match a rebuild from the source tables. Each
+# rollup test names its rows() and how to rebuild() them.
+class RollupTests(object):
+
+    def rows(self):
+        raise NotImplementedError
+
+    def rebuild(self):
+        raise NotImplementedError
+
+    def assertMatchesRebuild(self):
+        recorded = self.rows()
+        self.rebuild()
+        self.assertEqual(recorded, self.rows())
+
+    def setUp(self):
+        super(RollupTests, self).setUp()
+        self.create_invoice([self.line(self.shawl, 2), self.line(self.scarf, 1)], date_of_sale='2026-01-15T10:00:00Z')
+        self.credit_id = self.create_invoice([self.line(self.shawl, 3, sell_price=9), self.line(self.scarf, 2)],
+                                             credit=True, date_of_sale='2026-02-03T18:30:00Z').data['id']
+        self.cash_id = self.create_invoice([self.line(self.scarf, 4)], customer=self.other_customer).data['id']
+
+    def test_create(self):
+        self.assertMatchesRebuild()
+
+    def test_return(self):
+        for invoice_id, product in [(self.credit_id, self.shawl), (self.cash_id, self.scarf)]:
+            response = self.client.patch('/api/v1/invoices/{0}/'.format(invoice_id),
+                                         {'products': [{'product': product.id, 'returned_quantity': 1}]}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.assertMatchesRebuild()
+
+    def test_payment_edit(self):
+        response = self.client.post('/api/v1/payments/', {'invoice': self.credit_id, 'payment': '12',
+                                                          'date_of_payment': '2026-02-10T09:00:00Z'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        payment_id = database.models.InvoiceCreditPayment.objects.get().id
+
+        response = self.client.patch('/api/v1/payments/{0}/'.format(payment_id),
+                                     {'payment': '20', 'date_of_payment': '2026-02-11T09:00:00Z'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.assertMatchesRebuild()
+
+    def test_payment_delete(self):
+        self.client.post('/api/v1/payments/', {'invoice': self.credit_id, 'payment': '12'}, format='json')
+        payment_id = database.models.InvoiceCreditPayment.objects.get().id
+
+        response = self.client.delete('/api/v1/payments/{0}/'.format(payment_id))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+        self.assertMatchesRebuild()
+
+
+class InvoiceTotalsTests(RollupTests, ApiTestCase):
+
+    def rows(self):
+        return sorted(database.models.Invoice.objects.values_list('id', 'invoice_total', 'profit_total',
+                                                                  'payments_total'))
+
+    def rebuild(self):
+        self.assertFalse(database.models.Invoice.objects.drifted().exists())
+        database.models.Invoice.objects.refresh_totals()
+
+
+class InventoryValueTests(RollupTests, ApiTestCase):
+
+    def rows(self):
+        return (sorted(database.models.Source.objects.values_list('id', 'total_value')),
+                sorted(database.models.Category.objects.values_list('id', 'total_value')))
+
+    def rebuild(self):
+        database.models.Source.objects.refresh_values()
+        database.models.Category.objects.refresh_values()
+
+    def test_product_edits(self):
+        other = database.models.Source.objects.create(name="Jaipur")
+        response = self.client.post('/api/v1/products/', {'name': "Stole", 'description': None, 'size': None,
+                                                          'cost_price': '3', 'sell_price': '7', 'stock': 4,
+                                                          'source': self.source.id, 'category': self.category.id,
+                                                          'supplier': self.supplier.id}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertMatchesRebuild()
+
+        response = self.client.patch('/api/v1/products/{0}/'.format(response.data['id']),
+                                     {'cost_price': '4', 'source': other.id}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertMatchesRebuild()
+        self.assertEqual(database.models.Source.objects.get(id=other.id).total_value, 16)
+
+        response = self.client.delete('/api/v1/products/{0}/'.format(response.data['id']))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertMatchesRebuild()
+
+
+class CashflowTests(RollupTests, ApiTestCase):
+
+    # Corrections are appended as signed entries, compare the net cash of each invoice and day
+    def rows(self):
+        cashflow = database.models.CashflowEntry.objects.values('date', 'type', 'invoice')\
+                                                        .annotate(total=Sum('amount')).filter(~Q(total=0))
+        return sorted((row['date'], row['type'], row['invoice'], row['total']) for row in cashflow)
+
+    def rebuild(self):
+        database.models.CashflowEntry.objects.rebuild()
+
+    def test_cashflow_report(self):
+        self.client.post('/api/v1/payments/', {'invoice': self.credit_id, 'payment': '12',
+                                               'date_of_payment': '2026-02-10T09:00:00Z'}, format='json')
+
+        response = self.client.get('/api/v1/cashflow/total/', {'year': 2026})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        cash = {(row['month'], row['type']): decimal.Decimal(row['cash']) for row in response.data}
+        self.assertEqual(cash[(1, database.models.CashflowEntry.INVOICE)], 25)
+        self.assertEqual(cash[(2, database.models.CashflowEntry.CREDIT_PAYMENT)], 12)
+        self.assertNotIn((2, database.models.CashflowEntry.INVOICE), cash)
+
+
+class OutstandingTests(RollupTests, ApiTestCase):
+
+    def rows(self):
+        return sorted(database.models.Customer.objects.values_list('id', 'outstanding_total'))
+
+    def rebuild(self):
+        database.models.Customer.objects.refresh_outstanding()
+
+    def test_receivables_report(self):
+        self.create_invoice([self.line(self.scarf, 2)], credit=True)
+        self.client.post('/api/v1/payments/', {'invoice': self.credit_id, 'payment': '7'}, format='json')
+
+        response = self.client.get('/api/v1/receivables/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 1)
+
+        row = response.data[0]
+        self.assertEqual((row['customer'], row['invoices']), (self.customer.id, 2))
+        self.assertEqual([decimal.Decimal(row[name]) for name in ('outstanding', 'days_0_30', 'days_over_90')],
+                         [40, 10, 30])
+        self.assertEqual(database.models.Customer.objects.get(id=self.customer.id).outstanding_total, 40)
+
+
+class DailySalesTests(RollupTests, ApiTestCase):
+
+    def rows(self):
+        return sorted(database.models.DailySales.objects.values_list(
+            'date', 'product', 'customer', 'sales_total', 'profit_total', 'units_total'))
+
+    def rebuild(self):
+        database.models.DailySales.objects.rebuild()
+
+    def test_sales_report_reads_the_rollup(self):
+        response = self.client.get('/api/v1/sales/products/', {'year': 2026, 'month': 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        sales = {row['product']: (decimal.Decimal(row['sales']), row['units']) for row in response.data}
+        self.assertEqual(sales, {self.shawl.id: (decimal.Decimal('20'), 2), self.scarf.id: (decimal.Decimal('5'), 1)})
+
+
+class MonthlySalesTests(RollupTests, ApiTestCase):
+
+    def rows(self):
+        return sorted(database.models.MonthlySales.objects.values_list('month', 'product', 'units_total'))
+
+    def rebuild(self):
+        database.models.MonthlySales.objects.rebuild()
+
+    def test_sold_total_by_year(self):
+        self.create_invoice([self.line(self.shawl, 5)], date_of_sale='2025-12-20T10:00:00Z')
+
+        response = self.client.get('/api/v1/stock/sold/total/', {'year': 2025})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, [{'product': self.shawl.id, 'year': 2025, 'month': 12, 'quantity': 5}])
+
+        response = self.client.get('/api/v1/stock/sold/total/', {'year': 2026})
+        self.assertEqual(sorted((row['product'], row['month'], row['quantity']) for row in response.data
+                                if row['month'] < 3),
+                         sorted([(self.shawl.id, 1, 2), (self.scarf.id, 1, 1), (self.shawl.id, 2, 3),
+                                 (self.scarf.id, 2, 2)]))
+
+    # Only the cash invoice of the scarf is recent enough to count
+    def test_velocity_and_reorder(self):
+        response = self.client.get('/api/v1/stock/velocity/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        velocity = {row['id']: row for row in response.data}
+        self.assertEqual(velocity[self.scarf.id]['units_month'], 4)
+        self.assertEqual(velocity[self.shawl.id]['daily_rate'], 0)
+        self.assertIsNone(velocity[self.shawl.id]['days_of_cover'])
+
+        response = self.client.get('/api/v1/stock/reorder/', {'lead_days': 0, 'cover_days': 0})
+        self.assertEqual(response.data, [])
+
+        response = self.client.get('/api/v1/stock/reorder/', {'cover_days': 10000})
+        self.assertEqual([row['id'] for row in response.data], [self.scarf.id])
+        self.assertGreater(response.data[0]['reorder_quantity'], 0)
+
+
+class CustomerStatisticsTests(RollupTests, ApiTestCase):
+
+    def rows(self):
+        return sorted(database.models.CustomerStatistics.objects.values_list(
+            'customer', 'first_purchase', 'last_purchase', 'invoice_count', 'sales_total', 'profit_total'))
+
+    def rebuild(self):
+        database.models.CustomerStatistics.objects.rebuild()
+
+    def test_expanded_customers(self):
+        walk_in = database.models.Customer.objects.create(name="Walk-in")
+
+        response = self.client.get('/api/v1/customers/', {'expand': 'statistics'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        statistics = {row['id']: row['statistics'] for row in response.data}
+
+        self.assertIsNone(statistics[walk_in.id])
+        self.assertEqual(statistics[self.customer.id]['invoice_count'], 2)
+        self.assertEqual(decimal.Decimal(statistics[self.customer.id]['sales_total']), 62)
+        self.assertEqual(decimal.Decimal(statistics[self.customer.id]['average_basket']), 31)
+        self.assertNotIn('statistics', self.client.get('/api/v1/customers/').data[0])
+
+
+# Date windows
+class DateWindowTests(ApiTestCase):
+
+    def setUp(self):
+        super(DateWindowTests, self).setUp()
+        for date_of_sale in ['2026-01-15T10:00:00Z', '2026-01-31T23:30:00Z', '2026-02-01T00:30:00Z']:
+            self.create_invoice([self.line(self.shawl, 1)], date_of_sale=date_of_sale)
+
+    def sales(self, params):
+        response = self.client.get('/api/v1/sales/total/', params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return decimal.Decimal(response.data[0]['sales'])
+
+    def test_custom_range_includes_the_whole_end_day(self):
+        self.assertEqual(self.sales({'date_start': '2026-01-15T00:00:00Z', 'date_end': '2026-01-31T00:00:00Z'}), 20)
+        self.assertEqual(self.sales({'date_start': '2026-01-16T00:00:00Z', 'date_end': '2026-02-01T00:00:00Z'}), 20)
+
+    def test_month_and_year(self):
+        self.assertEqual(self.sales({'year': 2026, 'month': 1}), 20)
+        self.assertEqual(self.sales({'year': 2026, 'month': 2}), 10)
+        self.assertEqual(self.sales({'year': 2026}), 30)
+
+    def test_missing_or_invalid_window_is_rejected(self):
+        for params in [{}, {'month': 1}, {'year': 'last'}, {'date_start': '2026-01-15T00:00:00Z'}]:
+            response = self.client.get('/api/v1/sales/total/', params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, params)
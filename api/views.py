@@ -1,31 +1,72 @@
 from .filters import *
+from .pagination import *
 from .serializers import *
+from .renderers import NDJSONRenderer, stream_rows
+from .metrics import SerializerMetricsMixin
+from .cache import catalogue_version, catalogue_etag, get_catalogue, set_catalogue, invalidate_catalogue
+from . import analytics, backup, xlsx
 
-import io
-import os
-import sys
-import json
+import csv
 import xlwt
 import xlrd
 import tarfile
-import tempfile
+import decimal
 import datetime
 
-from rest_framework import viewsets
+from rest_framework import status, viewsets
+from rest_framework.decorators import action
+from rest_framework.response import Response
 from rest_framework.exceptions import ParseError
 from rest_framework.filters import OrderingFilter
 from django_filters import rest_framework as filters
 
-from django.db import models, transaction, connection
+from django.db import models, transaction
 from django.core import management
-from django.http import HttpResponse, HttpResponseBadRequest, FileResponse
-from django.db.models import Sum, ExpressionWrapper, F, Case, When, Value
+from django.core.cache import caches
+from django.core.serializers.base import DeserializationError
+from django.http import HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.http import parse_etags
+from django.db.models import Sum, Count, Min, F, Q, Value
 from django.db.models.functions import Coalesce, ExtractMonth, ExtractYear, ExtractDay
 
 import database.models
 
-# d = list(database.models.InvoiceProduct.objects.filter(product=389).values_list('invoice', flat=True))
-# database.models.InvoiceProduct.objects.filter(Q(invoice__in=d), ~Q(product=389)).values('product').annotate(count=Count('product')).filter(count__gt=5)
+
+# Turn the year, month or date_start/date_end params into a half-open [start, end) window of aware datetimes so
+# reports filter with plain range comparisons on indexed columns. A custom range includes the whole of date_end.
+def date_window(params):
+    year = params.get("year")
+    month = params.get("month")
+    date_end = params.get("date_end")
+    date_start = params.get("date_start")
+
+    def parse_day(value):
+        parsed = parse_datetime(value)
+        if parsed is None:
+            raise ValueError(value)
+        return timezone.localtime(parsed).date() if timezone.is_aware(parsed) else parsed.date()
+
+    try:
+        if month:
+            if not year:
+                raise ParseError("Provide year for month {0}".format(month))
+            start = datetime.date(int(year), int(month), 1)
+            end = datetime.date(start.year + start.month // 12, start.month % 12 + 1, 1)
+        elif year:
+            start = datetime.date(int(year), 1, 1)
+            end = datetime.date(start.year + 1, 1, 1)
+        elif date_start and date_end:
+            start = parse_day(date_start)
+            end = parse_day(date_end) + datetime.timedelta(days=1)
+        else:
+            raise ParseError("Must provide a month, year or custom date range")
+    except ValueError:
+        raise ParseError("Invalid month, year or custom date range")
+
+    return (timezone.make_aware(datetime.datetime.combine(start, datetime.time.min)),
+            timezone.make_aware(datetime.datetime.combine(end, datetime.time.min)))
 
 
 def sales_per_type(type_name, field_lookup, params):
@@ -33,8 +74,6 @@ def sales_per_type(type_name, field_lookup, params):
     year = params.get("year")
     month = params.get("month")
     group_by = params.get("group_by")
-    date_end = params.get("date_end")
-    date_start = params.get("date_start")
 
     # Format id param into list
     ids_list = ids.split(',') if ids else []
@@ -54,7 +93,7 @@ def sales_per_type(type_name, field_lookup, params):
         raise ParseError("Can not group by month when filtering by month")
 
     # Initial queryset
-    queryset = database.models.InvoiceProduct.objects.totals().select_related('product', 'invoice')
+    queryset = database.models.DailySales.objects.all()
 
     # Handle ids filter
     if ids_list:
@@ -62,87 +101,237 @@ def sales_per_type(type_name, field_lookup, params):
         queryset = queryset.filter(**{lookup: ids_list})
 
     # Handle date range filters
-    if month:
-        if not year:
-            raise ParseError("Provide year for month {0}".format(month))
-        queryset = queryset.filter(invoice__date_of_sale__month=month, invoice__date_of_sale__year=year)
-    elif year:
-        queryset = queryset.filter(invoice__date_of_sale__year=year)
-    elif date_start and date_end:
-        queryset = queryset.filter(invoice__date_of_sale__range=(date_start, date_end))
-    else:
-        raise ParseError("Must provide a month, year or custom date range")
+    start, end = date_window(params)
+    queryset = queryset.filter(date__gte=start.date(), date__lt=end.date())
 
     # Check for case where field already exists in the queryset i.e. product field
     if type_name != field_lookup:
         queryset = queryset.annotate(**{type_name: F(field_lookup)})
 
     # Do the query
-    queryset = queryset.annotate(customer=F('invoice__customer'),
-                                 month=ExtractMonth('invoice__date_of_sale'),
-                                 year=ExtractYear('invoice__date_of_sale'),
-                                 day=ExtractDay('invoice__date_of_sale'))\
-                       .annotate(product_sales=ExpressionWrapper(
-                           (F('quantity') - F('returned_quantity')) * F('sell_price'),
-                               output_field=models.DecimalField(max_digits=15, decimal_places=3)))\
-                       .annotate(product_profit=ExpressionWrapper(
-                           (F('quantity') - F('returned_quantity')) * (F('sell_price') - F('cost_price')),
-                               output_field=models.DecimalField(max_digits=15, decimal_places=3)))\
-                       .annotate(_sales=Sum("product_sales"))\
-                       .annotate(_profit=Sum("product_profit"))\
+    queryset = queryset.annotate(month=ExtractMonth('date'), year=ExtractYear('date'), day=ExtractDay('date'))\
                        .values(*group_by_params)\
-                       .annotate(sales=F('_sales'), profit=F('_profit'),
-                                 units=Sum(F('quantity') - F('returned_quantity')))\
+                       .annotate(sales=Sum('sales_total'), profit=Sum('profit_total'), units=Sum('units_total'))\
                        .order_by(*group_by_params)
 
     return queryset
 
 
-class CustomerViewSet(viewsets.ModelViewSet):
+# Lists are streamed row by row from a server-side cursor when the client asks for ?stream=1 or for NDJSON
+# (Accept: application/x-ndjson or ?format=ndjson), so memory stays flat however large the result is. Every viewset
+# with serializers lists through it, so it also brings in the serializer timing of the request metrics.
+class StreamingListMixin(SerializerMetricsMixin):
+    stream_chunk_size = 2000
+
+    def list(self, request, *args, **kwargs):
+        ndjson = isinstance(request.accepted_renderer, NDJSONRenderer)
+        if not ndjson and request.query_params.get("stream") not in ("1", "true"):
+            return super(StreamingListMixin, self).list(request, *args, **kwargs)
+
+        queryset = self.filter_queryset(self.get_queryset())
+        if isinstance(queryset, models.QuerySet):
+            queryset = queryset.iterator(chunk_size=self.stream_chunk_size)
+
+        serializer = self.get_serializer()
+        rows = (serializer.to_representation(row) for row in queryset)
+
+        return StreamingHttpResponse(stream_rows(rows, ndjson=ndjson),
+                                     content_type=NDJSONRenderer.media_type if ndjson else 'application/json')
+
+
+# Lists of the product catalogue are cached per catalogue version and tagged with an ETag, so the till can poll them
+# cheaply and gets a 304 while nothing has changed. Writes through these viewsets drop the cached lists.
+class CatalogueCacheMixin(object):
+
+    def list(self, request, *args, **kwargs):
+        etag = catalogue_etag(catalogue_version(), request)
+
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+        data = get_catalogue(etag)
+        if data is None:
+            response = super(CatalogueCacheMixin, self).list(request, *args, **kwargs)
+            if response.streaming or response.status_code != status.HTTP_200_OK:
+                return response
+            set_catalogue(etag, response.data)
+        else:
+            response = Response(data)
+
+        response['ETag'] = etag
+        return response
+
+    def perform_create(self, serializer):
+        super(CatalogueCacheMixin, self).perform_create(serializer)
+        invalidate_catalogue()
+
+    def perform_update(self, serializer):
+        super(CatalogueCacheMixin, self).perform_update(serializer)
+        invalidate_catalogue()
+
+    def perform_destroy(self, instance):
+        super(CatalogueCacheMixin, self).perform_destroy(instance)
+        invalidate_catalogue()
+
+
+# Rows created, updated or deleted since a sync token, so a till can keep a local mirror without downloading the
+# whole list. The token is the server time of the previous sync and changes reach back CHANGE_MARGIN before it to
+# catch transactions that committed late, clients upsert the changed rows by id. Without a token every row is sent.
+class ChangesMixin(object):
+
+    @action(detail=False)
+    def changes(self, request):
+        token = timezone.now()
+        queryset = self.get_queryset()
+        deleted = []
+
+        since = request.query_params.get("since")
+        if since:
+            since = parse_datetime(since)
+            if since is None or timezone.is_naive(since):
+                raise ParseError("Invalid sync token")
+
+            since -= backup.CHANGE_MARGIN
+            queryset = queryset.filter(modified__gte=since)
+            deleted = database.models.DeletedRow.objects.filter(model=queryset.model._meta.label_lower,
+                                                                deleted__gte=since)\
+                                                        .values_list('object_id', flat=True)
+
+        serializer = self.get_serializer(queryset.order_by('modified', 'id'), many=True)
+        return Response({"token": token.strftime('%Y-%m-%dT%H:%M:%S.%fZ'), "changed": self.serializer_data(serializer),
+                         "deleted": list(deleted)})
+
+
+class CustomerViewSet(ChangesMixin, StreamingListMixin, viewsets.ModelViewSet):
     queryset = database.models.Customer.objects.all()
     serializer_class = CustomerSerializer
+    pagination_class = KeysetPagination
+
+    # ?expand=statistics adds the precomputed lifetime statistics of each customer
+    def expanded(self):
+        return "statistics" in self.request.query_params.get("expand", "").split(',')
+
+    def get_queryset(self):
+        queryset = super(CustomerViewSet, self).get_queryset()
+        if self.expanded():
+            queryset = queryset.select_related('statistics')
+        return queryset
+
+    def get_serializer_class(self):
+        if self.expanded():
+            return CustomerExpandedSerializer
+        return super(CustomerViewSet, self).get_serializer_class()
 
 
-class SupplierViewSet(viewsets.ModelViewSet):
+class SupplierViewSet(CatalogueCacheMixin, StreamingListMixin, viewsets.ModelViewSet):
     queryset = database.models.Supplier.objects.all()
     serializer_class = SupplierSerializer
 
 
-class SourceViewSet(viewsets.ModelViewSet):
+class SourceViewSet(CatalogueCacheMixin, StreamingListMixin, viewsets.ModelViewSet):
     queryset = database.models.Source.objects.all()
     serializer_class = SourceSerializer
 
 
-class CategoryViewSet(viewsets.ModelViewSet):
+class CategoryViewSet(CatalogueCacheMixin, StreamingListMixin, viewsets.ModelViewSet):
     queryset = database.models.Category.objects.all()
     serializer_class = CategorySerializer
 
 
-class ProductViewSet(viewsets.ModelViewSet):
+class ProductViewSet(ChangesMixin, CatalogueCacheMixin, StreamingListMixin, viewsets.ModelViewSet):
     queryset = database.models.Product.objects.all()
     serializer_class = ProductSerializer
     filter_backends = (filters.DjangoFilterBackend, OrderingFilter,)
     filterset_class = ProductFilter
+    pagination_class = KeysetPagination
     ordering_fields = ('name_sort', 'description_sort', 'size_sort')
+    ordering = ('id',)
+    invoice_count_timeout = 300
+
+    @transaction.atomic
+    def perform_destroy(self, instance):
+        instance = database.models.Product.objects.select_for_update().get(pk=instance.pk)
+        super(ProductViewSet, self).perform_destroy(instance)
+        adjust_inventory_value([(instance.source_id, instance.category_id, -stock_value(instance))])
+
+    # Search-as-you-type over name, description and size, best matches first
+    @action(detail=False)
+    def search(self, request):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            raise ParseError("Search query 'q' is required")
 
+        try:
+            limit = min(int(request.query_params.get('limit', 20)), 100)
+        except ValueError:
+            raise ParseError("Limit must be a number")
+
+        queryset = database.models.Product.objects.search(query)
+        queryset = filters.DjangoFilterBackend().filter_queryset(request, queryset, self)
+        serializer = self.get_serializer(queryset[:max(limit, 1)], many=True)
+        return Response(self.serializer_data(serializer))
+
+    # Products most often bought together with this one, from the product pair counts
+    @action(detail=True)
+    def companions(self, request, pk=None):
+        try:
+            limit = min(int(request.query_params.get('limit', 10)), 100)
+            product_id = int(pk)
+        except ValueError:
+            raise ParseError("Limit and product must be numbers")
 
-class InvoiceViewSet(viewsets.ModelViewSet):
+        # The invoice count only scales support and lift, a few minutes old is close enough
+        invoice_count = caches['default'].get_or_set('invoice_count', database.models.Invoice.objects.count,
+                                                     self.invoice_count_timeout)
+
+        return Response(database.models.ProductPair.objects.companions(product_id, invoice_count, max(limit, 1)))
+
+
+class InvoiceViewSet(StreamingListMixin, viewsets.ModelViewSet):
     serializer_class = InvoiceSerializer
     filterset_class = InvoiceFilter
+    pagination_class = InvoicePagination
 
     def get_queryset(self):
         queryset = database.models.Invoice.objects.all()
         queryset = self.get_serializer_class().setup_eager_loading(queryset)
         return queryset
 
+    # Create many invoices in one transaction, e.g. when an offline till syncs
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        serializer = self.get_serializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        return Response(self.serializer_data(serializer), status=status.HTTP_201_CREATED)
 
-class CreditPaymentsViewSet(viewsets.ModelViewSet):
+
+class CreditPaymentsViewSet(StreamingListMixin, viewsets.ModelViewSet):
     queryset = database.models.InvoiceCreditPayment.objects.all()
     serializer_class = InvoiceCreditPaymentSerializer
     filterset_fields = ('invoice',)
 
-
-class SalesTotalViewSet(viewsets.ModelViewSet):
+    # Post many payments in one transaction, e.g. a customer settling several invoices
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        serializer = self.get_serializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        return Response(self.serializer_data(serializer), status=status.HTTP_201_CREATED)
+
+    # Lock the invoice before the payment, like post_payments and the payment serializer's update, so a payment
+    # posted meanwhile waits and then checks against the refreshed balance
+    @transaction.atomic
+    def perform_destroy(self, instance):
+        invoice = database.models.Invoice.objects.select_for_update().get(pk=instance.invoice_id)
+        instance = database.models.InvoiceCreditPayment.objects.select_for_update().get(pk=instance.pk)
+        instance.delete()
+        database.models.Invoice.objects.refresh_totals([invoice.id])
+        database.models.Customer.objects.refresh_outstanding([invoice.customer_id])
+        database.models.CashflowEntry.objects.record([payment_cashflow(instance, reverse=True)])
+
+
+class SalesTotalViewSet(StreamingListMixin, viewsets.ModelViewSet):
     serializer_class = SalesTotalSerializer
     http_method_names = ('get')
 
@@ -150,8 +339,6 @@ class SalesTotalViewSet(viewsets.ModelViewSet):
         year = self.request.query_params.get("year")
         month = self.request.query_params.get("month")
         group_by = self.request.query_params.get("group_by")
-        date_end = self.request.query_params.get("date_end")
-        date_start = self.request.query_params.get("date_start")
 
         # Format group_by param into list
         group_by_params = group_by.split(',') if group_by else []
@@ -163,37 +350,24 @@ class SalesTotalViewSet(viewsets.ModelViewSet):
             raise ParseError("Can not group by month when filtering by month")
 
         # Initial queryset
-        queryset = database.models.Invoice.objects
+        queryset = database.models.DailySales.objects
 
         # Handle date range filters
-        if month:
-            if not year:
-                raise ParseError("Provide year for month {0}".format(month))
-            queryset = queryset.filter(date_of_sale__month=month, date_of_sale__year=year)
-        elif year:
-            queryset = queryset.filter(date_of_sale__year=year)
-        elif date_start and date_end:
-            queryset = queryset.filter(date_of_sale__range=(date_start, date_end))
-        else:
-            raise ParseError("Must provide a month, year or custom date range")
-
-        queryset = queryset.annotate(month=ExtractMonth('date_of_sale'), year=ExtractYear('date_of_sale'),
-                                     day=ExtractDay('date_of_sale'))
+        start, end = date_window(self.request.query_params)
+        queryset = queryset.filter(date__gte=start.date(), date__lt=end.date())
 
         if group_by_params:
-            queryset = queryset.values(*group_by_params)\
-                               .annotate(sales=Sum('invoice_total'), profit=Sum('profit_total'))\
+            queryset = queryset.annotate(month=ExtractMonth('date'), year=ExtractYear('date'), day=ExtractDay('date'))\
+                               .values(*group_by_params)\
+                               .annotate(sales=Sum('sales_total'), profit=Sum('profit_total'))\
                                .order_by(*group_by_params)
         else:
-            queryset = queryset.annotate(_sales=Sum('invoice_total'), _profit=Sum('profit_total'))\
-                               .values('_sales', '_profit')\
-                               .annotate(sales=F('_sales'), profit=F('_profit'))\
-                               .values('sales', 'profit')
+            queryset = [queryset.aggregate(sales=Sum('sales_total'), profit=Sum('profit_total'))]
 
         return queryset
 
 
-class SalesCustomersViewSet(viewsets.ModelViewSet):
+class SalesCustomersViewSet(StreamingListMixin, viewsets.ModelViewSet):
     serializer_class = SalesCustomersSerializer
     http_method_names = ('get')
 
@@ -202,8 +376,6 @@ class SalesCustomersViewSet(viewsets.ModelViewSet):
         year = self.request.query_params.get("year")
         month = self.request.query_params.get("month")
         group_by = self.request.query_params.get("group_by")
-        date_end = self.request.query_params.get("date_end")
-        date_start = self.request.query_params.get("date_start")
 
         # Format id param into list
         ids_list = ids.split(',') if ids else []
@@ -221,33 +393,24 @@ class SalesCustomersViewSet(viewsets.ModelViewSet):
             raise ParseError("Can not group by month when filtering by month")
 
         # Initial queryset
-        queryset = database.models.Invoice.objects
+        queryset = database.models.DailySales.objects
 
         # Handle ids filter
         if ids_list:
             queryset = queryset.filter(customer__in=ids_list)
 
         # Handle date range filters
-        if month:
-            if not year:
-                raise ParseError("Provide year for month {0}".format(month))
-            queryset = queryset.filter(date_of_sale__month=month, date_of_sale__year=year)
-        elif year:
-            queryset = queryset.filter(date_of_sale__year=year)
-        elif date_start and date_end:
-            queryset = queryset.filter(date_of_sale__range=(date_start, date_end))
-        else:
-            raise ParseError("Must provide a month, year or custom date range")
+        start, end = date_window(self.request.query_params)
+        queryset = queryset.filter(date__gte=start.date(), date__lt=end.date())
 
-        queryset = queryset.annotate(month=ExtractMonth('date_of_sale'), year=ExtractYear('date_of_sale'),
-                                     day=ExtractDay('date_of_sale'))\
+        queryset = queryset.annotate(month=ExtractMonth('date'), year=ExtractYear('date'), day=ExtractDay('date'))\
                            .values(*group_by_params)\
-                           .annotate(sales=Sum('invoice_total'), profit=Sum('profit_total'))\
+                           .annotate(sales=Sum('sales_total'), profit=Sum('profit_total'), units=Sum('units_total'))\
                            .order_by(*group_by_params)
         return queryset
 
 
-class SalesProductsViewSet(viewsets.ModelViewSet):
+class SalesProductsViewSet(StreamingListMixin, viewsets.ModelViewSet):
     serializer_class = SalesProductsSerializer
     http_method_names = ('get')
 
@@ -255,7 +418,7 @@ class SalesProductsViewSet(viewsets.ModelViewSet):
         return sales_per_type("product", "product", self.request.query_params)
 
 
-class SalesCategorySourceViewSet(viewsets.ModelViewSet):
+class SalesCategorySourceViewSet(StreamingListMixin, viewsets.ModelViewSet):
     serializer_class = SalesCategorySourceSerializer
     http_method_names = ('get')
 
@@ -269,7 +432,7 @@ class SalesCategorySourceViewSet(viewsets.ModelViewSet):
         return sales_per_type("requested_type", "product__" + type_name, self.request.query_params)
 
 
-class SalesSuppliersViewSet(viewsets.ModelViewSet):
+class SalesSuppliersViewSet(StreamingListMixin, viewsets.ModelViewSet):
     serializer_class = SalesSuppliersSerializer
     http_method_names = ('get')
 
@@ -277,15 +440,13 @@ class SalesSuppliersViewSet(viewsets.ModelViewSet):
         return sales_per_type("supplier", "product__supplier", self.request.query_params)
 
 
-class CashflowTotalViewSet(viewsets.ModelViewSet):
+class CashflowTotalViewSet(StreamingListMixin, viewsets.ModelViewSet):
     serializer_class = CashflowTotalSerializer
     http_method_names = ('get')
 
     def get_queryset(self):
         year = self.request.query_params.get("year")
         month = self.request.query_params.get("month")
-        date_end = self.request.query_params.get("date_end")
-        date_start = self.request.query_params.get("date_start")
 
         # Set group by field
         if year and month:
@@ -293,167 +454,288 @@ class CashflowTotalViewSet(viewsets.ModelViewSet):
         else:
             group_by = "month"
 
-        # Initial querysets
-        cash_invoices = database.models.Invoice.objects.filter(credit=False)
-        payments = database.models.InvoiceCreditPayment.objects
-
         # Handle date range filters
-        if month:
-            if not year:
-                raise ParseError("Provide year for month {0}".format(month))
-            cash_invoices = cash_invoices.filter(date_of_sale__month=month, date_of_sale__year=year)
-            payments = payments.filter(date_of_payment__month=month, date_of_payment__year=year)
-        elif year:
-            cash_invoices = cash_invoices.filter(date_of_sale__year=year)
-            payments = payments.filter(date_of_payment__year=year)
-        elif date_start and date_end:
-            cash_invoices = cash_invoices.filter(date_of_sale__range=(date_start, date_end))
-            payments = payments.filter(date_of_payment__range=(date_start, date_end))
-        else:
-            raise ParseError("Must provide a month, year or custom date range")
+        start, end = date_window(self.request.query_params)
+        queryset = database.models.CashflowEntry.objects.filter(date__gte=start.date(), date__lt=end.date())
+
+        return queryset.annotate(month=ExtractMonth('date'), year=ExtractYear('date'), day=ExtractDay('date'))\
+                       .values(group_by, "type")\
+                       .annotate(cash=Sum('amount'))\
+                       .order_by(group_by, "type")
+
+
+class ReceivablesViewSet(StreamingListMixin, viewsets.ModelViewSet):
+    serializer_class = ReceivablesSerializer
+    http_method_names = ('get')
+
+    # Outstanding credit per customer, aged by days since the date of sale
+    def get_queryset(self):
+        ids = self.request.query_params.get("id")
+
+        queryset = database.models.Invoice.objects.receivable()
+        if ids:
+            queryset = queryset.filter(customer__in=ids.split(','))
+
+        today = timezone.localdate()
+        cutoffs = [timezone.make_aware(datetime.datetime.combine(today - datetime.timedelta(days=days), datetime.time.min))
+                   for days in (30, 60, 90)]
+
+        balance = F('invoice_total') - F('payments_total')
+        decimal_field = models.DecimalField(max_digits=15, decimal_places=3)
 
-        cash_invoices = cash_invoices.annotate(month=ExtractMonth('date_of_sale'), year=ExtractYear('date_of_sale'),
-                                               day=ExtractDay('date_of_sale'),
-                                               type=Value("invoice", output_field=models.CharField()))\
-                                     .values(group_by, "type")\
-                                     .annotate(cash=Sum('invoice_total'))
-        payments = payments.annotate(month=ExtractMonth('date_of_payment'), year=ExtractYear('date_of_payment'),
-                                     day=ExtractDay('date_of_payment'),
-                                     type=Value("credit_payment", output_field=models.CharField()))\
-                           .values(group_by, "type")\
-                           .annotate(cash=Sum('payment'))
+        def aged(**lookups):
+            return Coalesce(Sum(balance, filter=Q(**lookups), output_field=decimal_field), Value(0),
+                            output_field=decimal_field)
 
-        return cash_invoices.union(payments).order_by(group_by)
+        return queryset.values('customer')\
+                       .annotate(invoices=Count('id'), oldest_sale=Min('date_of_sale'),
+                                 outstanding=Sum(balance, output_field=decimal_field),
+                                 days_0_30=aged(date_of_sale__gte=cutoffs[0]),
+                                 days_31_60=aged(date_of_sale__gte=cutoffs[1], date_of_sale__lt=cutoffs[0]),
+                                 days_61_90=aged(date_of_sale__gte=cutoffs[2], date_of_sale__lt=cutoffs[1]),
+                                 days_over_90=aged(date_of_sale__lt=cutoffs[2]))\
+                       .order_by('-outstanding', 'customer')
 
 
-class StockSoldTotalViewSet(viewsets.ModelViewSet):
+# Ad-hoc sales reports: ?group_by= and ?pivot= take any of the analytics DIMENSIONS, ?measures= picks the totals
+# and each dimension can be filtered with a comma separated list of ids, e.g. ?category=1,2. The date params are
+# optional, without them the whole history is reported.
+class SalesAnalyticsViewSet(viewsets.ViewSet):
+    def list(self, request):
+        params = request.query_params
+
+        def listed(name, default=''):
+            value = params.get(name, default)
+            return [item for item in value.split(',') if item]
+
+        group_by = listed("group_by")
+        measures = listed("measures", "sales,profit,units")
+        pivot = params.get("pivot") or None
+
+        # Validate params
+        if any(name not in analytics.DIMENSIONS for name in group_by + ([pivot] if pivot else [])):
+            raise ParseError("Can only group by or pivot on {0}".format(', '.join(analytics.DIMENSIONS)))
+        if len(set(group_by)) != len(group_by) or pivot in group_by:
+            raise ParseError("Can not group by the same dimension twice")
+        if not measures or any(name not in analytics.MEASURES for name in measures):
+            raise ParseError("Measures must be from {0}".format(', '.join(analytics.MEASURES)))
+
+        dimension_filters = dict()
+        try:
+            for name in analytics.DIMENSIONS:
+                if params.get(name) and name not in ("year", "month"):
+                    dimension_filters[name] = [int(value) for value in listed(name)]
+        except ValueError:
+            raise ParseError("Dimension filters must be comma separated numbers")
+
+        # Handle date range filters
+        start = end = None
+        if any(params.get(name) for name in ("year", "month", "date_start", "date_end")):
+            start, end = date_window(params)
+
+        return Response(analytics.sales_query(group_by, measures, dimension_filters, start, end, pivot))
+
+
+class StockSoldTotalViewSet(StreamingListMixin, viewsets.ModelViewSet):
     serializer_class = StockSoldTotalSerializer
     http_method_names = ('get')
 
+    # Units sold per product and month from the monthly rollup, optionally for one ?year=
+    def get_queryset(self):
+        year = self.request.query_params.get("year")
+
+        queryset = database.models.MonthlySales.objects.all()
+        if year:
+            try:
+                queryset = queryset.filter(month__gte=datetime.date(int(year), 1, 1),
+                                           month__lt=datetime.date(int(year) + 1, 1, 1))
+            except ValueError:
+                raise ParseError("Invalid year")
+
+        return queryset.annotate(year=ExtractYear('month'), month_number=ExtractMonth('month'))\
+                       .values('product', 'year', 'month_number', 'units_total')\
+                       .order_by('product', 'year', 'month_number')
+
+
+class StockVelocityViewSet(StreamingListMixin, viewsets.ModelViewSet):
+    serializer_class = StockVelocitySerializer
+    http_method_names = ('get')
+
+    def velocity(self, **kwargs):
+        ids = self.request.query_params.get("id")
+        suppliers = self.request.query_params.get("supplier")
+
+        queryset = database.models.Product.objects.velocity(**kwargs)
+        if ids:
+            queryset = queryset.filter(id__in=ids.split(','))
+        if suppliers:
+            queryset = queryset.filter(supplier__in=suppliers.split(','))
+
+        return queryset
+
     def get_queryset(self):
-        return database.models.InvoiceProduct.objects.annotate(month=ExtractMonth('invoice__date_of_sale'))\
-                                                     .values('product', 'month')\
-                                                     .annotate(quantity=Sum(F('quantity') - F('returned_quantity')))
+        return self.velocity().order_by('id')
+
+
+# Products of each supplier that will run out before a delivery ordered today arrives and covers the following
+# days, with the quantity to order. Lead time and cover default to LEAD_DAYS and COVER_DAYS.
+class StockReorderViewSet(StockVelocityViewSet):
+    serializer_class = StockReorderSerializer
+    LEAD_DAYS = 14
+    COVER_DAYS = 30
+
+    def get_queryset(self):
+        try:
+            lead_days = int(self.request.query_params.get("lead_days", self.LEAD_DAYS))
+            cover_days = int(self.request.query_params.get("cover_days", self.COVER_DAYS))
+        except ValueError:
+            raise ParseError("lead_days and cover_days must be numbers")
+        if lead_days < 0 or cover_days < 0:
+            raise ParseError("lead_days and cover_days can not be negative")
+
+        return self.velocity(lead_days=lead_days, cover_days=cover_days)\
+                   .filter(reorder_quantity__gt=0, hide_product=False)\
+                   .order_by('supplier', 'days_of_cover', 'id')
 
 
 class BackupDbViewSet(viewsets.ModelViewSet):
     http_method_names = ('get',)
 
     def list(self, request):
-        # Using delete=True would delete the file immediately on close, 
-        # so we manage cleanup manually to allow FileResponse to stream it.
-        tmp_file = tempfile.NamedTemporaryFile(delete=False)
-        
         try:
-            # Context manager ensures tar footer and gzip stream are finalized
-            with tarfile.open(fileobj=tmp_file, mode='w:gz') as archive:
-                fixtures = [
-                    ('database.Category', 'categories.json'), 
-                    ('database.Source', 'sources.json'),
-                    ('database.Supplier', 'suppliers.json'), 
-                    ('database.Product', 'products.json'),
-                    ('database.Customer', 'customers.json'), 
-                    ('database.Invoice', 'invoices.json'),
-                    ('database.InvoiceProduct', 'invoice_products.json'),
-                    ('database.InvoiceCreditPayment', 'payments.json')
-                ]
-
-                for fixture, filename in fixtures:
-                    buf = io.StringIO()
-                    management.call_command('dumpdata', fixture, indent=2, format='json', stdout=buf)
-                    data = buf.getvalue().encode('utf-8')
-                    
-                    tarinfo = tarfile.TarInfo(name=filename)
-                    tarinfo.size = len(data)
-                    archive.addfile(tarinfo, fileobj=io.BytesIO(data))
-                    buf.close()
-            
-            # Close the underlying file handle so the OS flushes the buffer to disk
-            tmp_file.close()
-
-            today = datetime.datetime.now().strftime("%Y-%m-%d")
-            download_name = "backup_{}.tar.gz".format(today)
-            
-            # Re-open in read-binary mode for the response
-            return FileResponse(open(tmp_file.name, 'rb'), filename=download_name, as_attachment=True)
-            
-        except Exception as e:
-            # If something fails during creation, clean up the leaked temp file
-            if os.path.exists(tmp_file.name):
-                os.remove(tmp_file.name)
-            raise e
+            compresslevel = int(request.query_params.get("compression", 6))
+            if not 0 <= compresslevel <= 9:
+                raise ValueError(compresslevel)
+        except ValueError:
+            return HttpResponseBadRequest("Compression must be a level from 0 to 9")
+
+        # A delta backup holds only the changes since the given backup
+        base = None
+        since = request.query_params.get("since")
+        if since:
+            try:
+                base = database.models.Backup.objects.get(id=since)
+            except (ValueError, database.models.Backup.DoesNotExist):
+                return HttpResponseBadRequest("Unknown backup {0}".format(since))
+
+        record = database.models.Backup.objects.create(base=base)
+        members = backup.backup_members(record, since=base.taken - backup.CHANGE_MARGIN if base else None)
+
+        # Each table is dumped only when the archive reaches it, so the response starts streaming right away
+        today = datetime.datetime.now().strftime("%Y-%m-%d")
+        response = StreamingHttpResponse(backup.stream_tar_gz(members, compresslevel), content_type='application/gzip')
+        response['Content-Disposition'] = "attachment; filename=backup_{0}{1}.tar.gz".format(
+            today, "_delta_{0}".format(record.id) if base else "")
+        response['X-Backup-Id'] = record.id
+        return response
+
 
 class RestoreDbViewSet(viewsets.ModelViewSet):
     http_method_names = ('post',)
 
-    FIXTURES = [
-        "customers.json", "categories.json", "sources.json", "suppliers.json", 
-        "products.json", "invoices.json", "invoice_products.json", "payments.json"
-    ]
-
     def create(self, request):
         file_obj = request.FILES.get('file', None)
         if not file_obj:
             return HttpResponseBadRequest("No file received")
 
+        # A full backup, optionally followed by the chain of delta backups taken after it
+        archives = []
         try:
-            # Open the tarball
-            archive = tarfile.open(fileobj=file_obj, mode='r:gz')
-            
-            # Pre-parse and validate all JSON files first to avoid 
-            # failing halfway through a database transaction
-            fixtures_data = []
-            for fixture_name in self.FIXTURES:
-                extracted = archive.extractfile(fixture_name)
-                if extracted:
-                    fixtures_data.append({
-                        'name': fixture_name,
-                        'data': json.loads(extracted.read().decode('utf-8'))
-                    })
-            archive.close()
-        except Exception as e:
+            for upload in [file_obj] + request.FILES.getlist('delta'):
+                archives.append(tarfile.open(fileobj=upload, mode='r:gz'))
+
+            previous = backup.read_manifest(archives[0])
+            if previous and previous['base'] is not None:
+                return HttpResponseBadRequest("Backup {0} is a delta, restore its full backup first".format(
+                    previous['backup']))
+
+            for archive in archives[1:]:
+                manifest = backup.read_manifest(archive)
+                if not manifest or manifest['base'] is None:
+                    return HttpResponseBadRequest("Only delta backups can follow the full backup")
+                if not previous or not backup.follows(manifest, previous):
+                    return HttpResponseBadRequest("Delta backup {0} does not follow backup {1}".format(
+                        manifest['backup'], previous['backup'] if previous else "without a manifest"))
+                previous = manifest
+        except (tarfile.TarError, OSError, ValueError, KeyError) as e:
+            for archive in archives:
+                archive.close()
             return HttpResponseBadRequest(f"Archive processing error: {str(e)}")
 
-        # Start the optimization: Everything inside one Database Transaction
+        # Everything inside one database transaction, a bad fixture leaves the database untouched
         try:
             with transaction.atomic():
                 # 1. Clear the database
                 management.call_command('flush', verbosity=0, interactive=False)
 
+                # 2. Stream each fixture into the database in batches and reset the id sequences, then apply the
+                # deltas on top
                 results = []
-                # 2. Process each file separately (Backwards Compatible)
-                for item in fixtures_data:
-                    with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as f:
-                        json.dump(item['data'], f)
-                        temp_path = f.name
-                    
-                    try:
-                        output = io.StringIO()
-                        management.call_command('loaddata', temp_path, stdout=output)
-                        
-                        # Extract the count for the response log
-                        val = output.getvalue()
-                        count = val.split(' ')[1] if 'Installed' in val else "0"
-                        results.append(f"Restored {count} from {item['name']}")
-                    finally:
-                        if os.path.exists(temp_path):
-                            os.remove(temp_path)
-
-                # 3. Optional but Recommended: Reset Postgres ID sequences
-                # This prevents "Duplicate Key" errors on next manual entry
-                # (Requires django-extensions or a custom management command)
-                management.call_command('sqlsequencereset', 'database') 
+                for index, archive in enumerate(archives):
+                    results += ["Restored {0} from {1}{2}".format(count, name, " (delta {0})".format(index) if index else "")
+                                for name, count in backup.restore_archive(archive, upsert=index > 0)]
+
+                # 3. Rebuild derived data from the restored rows, older archives do not carry it. The stored columns
+                # of backed up rows are refreshed only where they drifted, so the rows keep their archived modified
+                # times and the next delta backup stays small.
+                invoices = list(database.models.Invoice.objects.drifted().values_list('id', flat=True))
+                database.models.Invoice.objects.refresh_totals(invoices)
+                customers = list(database.models.Customer.objects.drifted().values_list('id', flat=True))
+                database.models.Customer.objects.refresh_outstanding(customers)
+                for model in [database.models.Source, database.models.Category]:
+                    model.objects.refresh_values(list(model.objects.drifted().values_list('id', flat=True)))
+                database.models.DailySales.objects.rebuild()
+                database.models.MonthlySales.objects.rebuild()
+                database.models.ProductPair.objects.rebuild()
+                database.models.CashflowEntry.objects.rebuild()
+                database.models.CustomerStatistics.objects.rebuild()
+                invalidate_catalogue()
 
             return HttpResponse("\n".join(results))
 
+        except (ValueError, DeserializationError) as e:
+            return HttpResponseBadRequest(f"Archive processing error: {str(e)}")
         except Exception as e:
             return HttpResponse(f"Transaction failed: {str(e)}", status=500)
+        finally:
+            for archive in archives:
+                archive.close()
+
 
 class StockXlsViewSet(viewsets.ModelViewSet):
     http_method_names = ('get', 'post')
 
+    COLUMNS = ['ID', 'Product Name', 'Description', 'Size', 'Stock', 'Cost Price', 'Sell Price', 'Supplier',
+               'Source', 'Category']
+
     def list(self, request):
         today = datetime.datetime.now().strftime("%Y-%m-%d")
+
+        hide_product = request.query_params.get("hide_product");
+        if hide_product is None:
+            products = database.models.Product.objects.all()
+        else:
+            products = database.models.Product.objects.filter(hide_product=hide_product)
+
+        rows = products.order_by('id')\
+                       .values_list('id', 'name', 'description', 'size', 'stock', 'cost_price', 'sell_price',
+                                    'supplier__company', 'source__name', 'category__name')
+
+        # The streaming formats read the rows through a server-side cursor and send the file as it is written
+        export = request.query_params.get("export", "xls")
+        if export == "xlsx":
+            response = StreamingHttpResponse(xlsx.stream_xlsx('Stock', self.COLUMNS, rows.iterator(chunk_size=2000)),
+                content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+            response['Content-Disposition'] = "attachment; filename=stock-{0}.xlsx".format(today)
+            return response
+        elif export == "csv":
+            response = StreamingHttpResponse(self.stream_csv(self.COLUMNS, rows.iterator(chunk_size=2000)),
+                                             content_type='text/csv')
+            response['Content-Disposition'] = "attachment; filename=stock-{0}.csv".format(today)
+            return response
+        elif export != "xls":
+            return HttpResponseBadRequest("Export must be one of 'xls', 'xlsx' or 'csv'")
+
         response = HttpResponse(content_type='application/ms-excel')
         response['Content-Disposition'] = "attachment; filename=stock-{0}.xls".format(today)
 
@@ -466,24 +748,12 @@ class StockXlsViewSet(viewsets.ModelViewSet):
         font_style = xlwt.XFStyle()
         font_style.font.bold = True
 
-        columns = ['ID', 'Product Name', 'Description', 'Size', 'Stock', 'Cost Price', 'Sell Price', 'Supplier',
-                   'Source', 'Category']
-
-        for col_num in range(len(columns)):
-            ws.write(row_num, col_num, columns[col_num], font_style)
+        for col_num in range(len(self.COLUMNS)):
+            ws.write(row_num, col_num, self.COLUMNS[col_num], font_style)
 
         # Sheet body, remaining rows
         font_style = xlwt.XFStyle()
 
-        hide_product = request.query_params.get("hide_product");
-        if hide_product is None:
-            products = database.models.Product.objects.all()
-        else:
-            products = database.models.Product.objects.filter(hide_product=hide_product)
-
-        rows = products.values_list('id', 'name', 'description', 'size', 'stock', 'cost_price', 'sell_price',
-                                    'supplier__company', 'source__name', 'category__name')
-
         for row in rows:
             row_num += 1
             for col_num in range(len(row)):
@@ -492,6 +762,18 @@ class StockXlsViewSet(viewsets.ModelViewSet):
         wb.save(response)
         return response
 
+    @staticmethod
+    def stream_csv(columns, rows):
+        # csv.writer returns whatever the file's write() returns, so echo each formatted line straight back out
+        class Echo(object):
+            def write(self, value):
+                return value
+
+        writer = csv.writer(Echo())
+        yield writer.writerow(columns)
+        for row in rows:
+            yield writer.writerow(row)
+
     def create(self, request):
         file = request.FILES.get('file', None)
 
@@ -520,18 +802,63 @@ class StockXlsViewSet(viewsets.ModelViewSet):
         else:
             return HttpResponseBadRequest("'ID' column not found in spreadsheet")
 
-        # Update the products
+        # Read the rows, the last row wins when an ID is repeated
+        fields = {col_name.lower().replace(' ', '_'): col for col_name, col in cols.items()}
+        rows = dict()
+        missing = []
+        for row in range(start_row, sheet.nrows):
+            product_id = sheet.cell(row, 0).value
+            if product_id == "":
+                continue
+
+            if not isinstance(product_id, float) or product_id != int(product_id):
+                missing.append(product_id)
+                continue
+
+            try:
+                values = dict()
+                for field, col in fields.items():
+                    value = sheet.cell(row, col).value
+                    if field == "stock":
+                        if value != int(value):
+                            raise ValueError(value)
+                        values[field] = int(value)
+                    else:
+                        values[field] = decimal.Decimal(str(value)).quantize(decimal.Decimal('0.001'))
+            except (ValueError, TypeError, decimal.InvalidOperation):
+                return HttpResponseBadRequest("Invalid value in row {0}".format(row + 1))
+
+            rows[int(product_id)] = values
+
+        # Update only the products whose values changed
         with transaction.atomic():
-            for row in range(start_row, sheet.nrows):
-                try:
-                    product = database.models.Product.objects.get(id=sheet.cell(row, 0).value)
-                except database.models.Product.DoesNotExist:
-                    continue
-
-                for col_name, col in cols.items():
-                    field = col_name.lower().replace(' ', '_')
-                    setattr(product, field, sheet.cell(row, col).value)
-
-                product.save()
-
-        return HttpResponse()
+            products = database.models.Product.objects.select_for_update()\
+                                                      .only('id', 'source_id', 'category_id', 'stock', 'cost_price',
+                                                            *fields)\
+                                                      .in_bulk(list(rows))
+
+            updated = []
+            unchanged = []
+            value_changes = []
+            now = timezone.now()
+            for product_id, values in rows.items():
+                product = products.get(product_id)
+                if product is None:
+                    missing.append(product_id)
+                elif all(getattr(product, field) == value for field, value in values.items()):
+                    unchanged.append(product_id)
+                else:
+                    value_changes.append((product.source_id, product.category_id, -stock_value(product)))
+                    for field, value in values.items():
+                        setattr(product, field, value)
+                    product.modified = now
+                    updated.append(product)
+                    value_changes.append((product.source_id, product.category_id, stock_value(product)))
+
+            database.models.Product.objects.bulk_update(updated, list(fields) + ['modified'], batch_size=500)
+            if updated:
+                adjust_inventory_value(value_changes)
+                invalidate_catalogue()
+
+        return Response({"updated": sorted(product.id for product in updated), "unchanged": sorted(unchanged),
+                         "missing": missing})
@@ -1,5 +1,15 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete
 
 
 class DatabaseConfig(AppConfig):
     name = 'database'
+
+    def ready(self):
+        from . import models
+
+        # Log deletions of the rows delta backups track
+        for model in self.get_models():
+            if issubclass(model, models.BackupTrackedModel):
+                post_delete.connect(models.record_deleted_row, sender=model,
+                                    dispatch_uid='record_deleted_row.{0}'.format(model._meta.label_lower))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from api.cache import invalidate_catalogue
+from database import sample_data
+
+
+class Command(BaseCommand):
+    help = "Add a synthetic catalogue, customers and years of invoices to the database, e.g. for benchmarking"
+
+    def add_arguments(self, parser):
+        sample_data.add_scale_arguments(parser)
+
+    def handle(self, *args, **options):
+        scale = {name: options[name] for name in sample_data.DEFAULT_SCALE}
+        counts = sample_data.generate(seed=options['seed'], **scale)
+        invalidate_catalogue()
+
+        for label, count in counts.items():
+            self.stdout.write("Created {0} {1} rows".format(count, label))
@@ -0,0 +1,14 @@
+from django.db import transaction
+from django.core.management.base import BaseCommand
+
+import database.models
+
+
+class Command(BaseCommand):
+    help = "Rebuild the cashflow ledger from the cash invoices and credit payments"
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            count = database.models.CashflowEntry.objects.rebuild()
+
+        self.stdout.write("Rebuilt {0} cashflow entries".format(count))
@@ -0,0 +1,14 @@
+from django.db import transaction
+from django.core.management.base import BaseCommand
+
+import database.models
+
+
+class Command(BaseCommand):
+    help = "Rebuild the lifetime statistics of each customer from their invoices"
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            count = database.models.CustomerStatistics.objects.rebuild()
+
+        self.stdout.write("Rebuilt statistics of {0} customers".format(count))
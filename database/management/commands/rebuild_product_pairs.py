@@ -0,0 +1,14 @@
+from django.db import transaction
+from django.core.management.base import BaseCommand
+
+import database.models
+
+
+class Command(BaseCommand):
+    help = "Rebuild the counts of products bought together from the invoice line items"
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            count = database.models.ProductPair.objects.rebuild()
+
+        self.stdout.write("Rebuilt {0} product pair rows".format(count))
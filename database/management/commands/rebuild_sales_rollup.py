@@ -0,0 +1,15 @@
+from django.db import transaction
+from django.core.management.base import BaseCommand
+
+import database.models
+
+
+class Command(BaseCommand):
+    help = "Rebuild the daily and monthly sales rollups from the invoice line items"
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            count = database.models.DailySales.objects.rebuild()
+            monthly_count = database.models.MonthlySales.objects.rebuild()
+
+        self.stdout.write("Rebuilt {0} daily and {1} monthly sales rows".format(count, monthly_count))
@@ -0,0 +1,31 @@
+from django.db import transaction
+from django.core.management.base import BaseCommand, CommandError
+
+import database.models
+from api.cache import invalidate_catalogue
+
+
+class Command(BaseCommand):
+    help = "Recompute the stored source and category stock values, or verify them with --verify"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify', action='store_true', help="Report sources and categories with drifted values without fixing them")
+
+    def handle(self, *args, **options):
+        models = [database.models.Source, database.models.Category]
+        drifted = {model: list(model.objects.drifted().values_list('id', flat=True)) for model in models}
+
+        if options['verify']:
+            errors = ["{0} {1}(s) with drifted values: {2}".format(
+                          len(ids), model._meta.verbose_name, ', '.join(str(pk) for pk in ids))
+                      for model, ids in drifted.items() if ids]
+            if errors:
+                raise CommandError("; ".join(errors))
+            self.stdout.write("All source and category values are in sync")
+            return
+
+        with transaction.atomic():
+            for model in models:
+                count = model.objects.refresh_values(drifted[model])
+                self.stdout.write("Refreshed values for {0} drifted {1}".format(count, model._meta.verbose_name_plural))
+            invalidate_catalogue()
@@ -0,0 +1,26 @@
+from django.db import transaction
+from django.core.management.base import BaseCommand, CommandError
+
+import database.models
+
+
+class Command(BaseCommand):
+    help = "Backfill the stored invoice, profit and payments totals, or verify them with --verify"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify', action='store_true', help="Report invoices with drifted totals without fixing them")
+
+    def handle(self, *args, **options):
+        drifted = list(database.models.Invoice.objects.drifted().values_list('id', flat=True))
+
+        if options['verify']:
+            if drifted:
+                raise CommandError("{0} invoice(s) with drifted totals: {1}".format(
+                    len(drifted), ', '.join(str(invoice_id) for invoice_id in drifted)))
+            self.stdout.write("All invoice totals are in sync")
+            return
+
+        with transaction.atomic():
+            count = database.models.Invoice.objects.refresh_totals(drifted)
+
+        self.stdout.write("Refreshed totals for {0} drifted invoices".format(count))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+import database.models
+
+
+class Command(BaseCommand):
+    help = "Count the products bought together on the invoices added since the last refresh, run it from cron"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help="Invoices counted per transaction")
+
+    def handle(self, *args, **options):
+        count = database.models.ProductPair.objects.refresh(batch_size=options['batch_size'])
+        self.stdout.write("Counted products of {0} invoices".format(count))
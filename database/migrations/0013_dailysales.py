@@ -0,0 +1,51 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:45
+
+from django.db import migrations, models
+from django.db.models import Sum, F
+from django.db.models.functions import TruncDate
+import django.db.models.deletion
+
+
+def populate_daily_sales(apps, schema_editor):
+    InvoiceProduct = apps.get_model('database', 'InvoiceProduct')
+    DailySales = apps.get_model('database', 'DailySales')
+
+    rows = InvoiceProduct.objects.annotate(date=TruncDate('invoice__date_of_sale'), customer=F('invoice__customer'))\
+               .values('date', 'product', 'customer')\
+               .annotate(sales_total=Sum((F('quantity') - F('returned_quantity')) * F('sell_price'),
+                             output_field=models.DecimalField(max_digits=15, decimal_places=3)),
+                         profit_total=Sum((F('quantity') - F('returned_quantity')) * (F('sell_price') - F('cost_price')),
+                             output_field=models.DecimalField(max_digits=15, decimal_places=3)),
+                         units_total=Sum(F('quantity') - F('returned_quantity')))\
+               .order_by()
+
+    DailySales.objects.bulk_create((DailySales(date=row['date'], product_id=row['product'], customer_id=row['customer'],
+                                               sales_total=row['sales_total'], profit_total=row['profit_total'],
+                                               units_total=row['units_total']) for row in rows.iterator()),
+                                   batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0012_auto_20180506_0014'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailySales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(db_index=True, help_text='Day of sale')),
+                ('sales_total', models.DecimalField(decimal_places=3, default=0.0, help_text='Sales for the day', max_digits=15)),
+                ('profit_total', models.DecimalField(decimal_places=3, default=0.0, help_text='Profit for the day', max_digits=15)),
+                ('units_total', models.IntegerField(default=0, help_text='Units sold for the day, net of returns')),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_sales', to='database.customer')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_sales', to='database.product')),
+            ],
+            options={
+                'unique_together': {('date', 'product', 'customer')},
+            },
+        ),
+        migrations.RunPython(populate_daily_sales, migrations.RunPython.noop),
+    ]
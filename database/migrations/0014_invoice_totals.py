@@ -0,0 +1,53 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:46
+
+from django.db import migrations, models
+from django.db.models import Sum, F, Value, Subquery, OuterRef
+from django.db.models.functions import Coalesce
+
+
+def backfill_invoice_totals(apps, schema_editor):
+    Invoice = apps.get_model('database', 'Invoice')
+    InvoiceProduct = apps.get_model('database', 'InvoiceProduct')
+    InvoiceCreditPayment = apps.get_model('database', 'InvoiceCreditPayment')
+
+    decimal_field = models.DecimalField(max_digits=15, decimal_places=3)
+    invoice_total = Subquery(InvoiceProduct.objects.filter(invoice=OuterRef('pk')).values('invoice_id')\
+                        .annotate(sum=Sum((F('quantity') - F('returned_quantity')) * F('sell_price'), output_field=decimal_field))\
+                        .values('sum')[:1])
+    profit_total = Subquery(InvoiceProduct.objects.filter(invoice=OuterRef('pk')).values('invoice_id')\
+                        .annotate(sum=Sum((F('quantity') - F('returned_quantity')) * (F('sell_price') - F('cost_price')),
+                                          output_field=decimal_field))\
+                        .values('sum')[:1])
+    payments_total = Subquery(InvoiceCreditPayment.objects.filter(invoice=OuterRef('pk')).values('invoice_id')\
+                        .annotate(sum=Sum('payment', output_field=decimal_field))\
+                        .values('sum')[:1])
+
+    Invoice.objects.update(invoice_total=Coalesce(invoice_total, Value(0), output_field=decimal_field),
+                           profit_total=Coalesce(profit_total, Value(0), output_field=decimal_field),
+                           payments_total=Coalesce(payments_total, Value(0), output_field=decimal_field))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0013_dailysales'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='invoice',
+            name='invoice_total',
+            field=models.DecimalField(decimal_places=3, default=0.0, help_text='Total of the invoice, net of returns', max_digits=15),
+        ),
+        migrations.AddField(
+            model_name='invoice',
+            name='payments_total',
+            field=models.DecimalField(decimal_places=3, default=0.0, help_text='Credit payments made for the invoice', max_digits=15),
+        ),
+        migrations.AddField(
+            model_name='invoice',
+            name='profit_total',
+            field=models.DecimalField(decimal_places=3, default=0.0, help_text='Profit of the invoice, net of returns', max_digits=15),
+        ),
+        migrations.RunPython(backfill_invoice_totals, migrations.RunPython.noop),
+    ]
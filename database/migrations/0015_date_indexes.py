@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0014_invoice_totals'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='invoice',
+            index=models.Index(fields=['date_of_sale', 'customer'], name='invoice_sale_customer_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='invoice',
+            index=models.Index(fields=['credit', 'date_of_sale'], name='invoice_credit_sale_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='invoicecreditpayment',
+            index=models.Index(fields=['date_of_payment'], name='payment_date_idx'),
+        ),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:53
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0015_date_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeletedRow',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.TextField(help_text='Label of the model the row belonged to')),
+                ('object_id', models.BigIntegerField(help_text='Primary key of the deleted row')),
+                ('deleted', models.DateTimeField(db_index=True, default=django.utils.timezone.now, help_text='Date the row was deleted')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='modified',
+            field=models.DateTimeField(auto_now=True, db_index=True, help_text='Date of the last change to the row'),
+        ),
+        migrations.AddField(
+            model_name='customer',
+            name='modified',
+            field=models.DateTimeField(auto_now=True, db_index=True, help_text='Date of the last change to the row'),
+        ),
+        migrations.AddField(
+            model_name='invoice',
+            name='modified',
+            field=models.DateTimeField(auto_now=True, db_index=True, help_text='Date of the last change to the row'),
+        ),
+        migrations.AddField(
+            model_name='invoicecreditpayment',
+            name='modified',
+            field=models.DateTimeField(auto_now=True, db_index=True, help_text='Date of the last change to the row'),
+        ),
+        migrations.AddField(
+            model_name='invoiceproduct',
+            name='modified',
+            field=models.DateTimeField(auto_now=True, db_index=True, help_text='Date of the last change to the row'),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='modified',
+            field=models.DateTimeField(auto_now=True, db_index=True, help_text='Date of the last change to the row'),
+        ),
+        migrations.AddField(
+            model_name='source',
+            name='modified',
+            field=models.DateTimeField(auto_now=True, db_index=True, help_text='Date of the last change to the row'),
+        ),
+        migrations.AddField(
+            model_name='supplier',
+            name='modified',
+            field=models.DateTimeField(auto_now=True, db_index=True, help_text='Date of the last change to the row'),
+        ),
+        migrations.CreateModel(
+            name='Backup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('taken', models.DateTimeField(default=django.utils.timezone.now, help_text='Date the backup was started')),
+                ('base', models.ForeignKey(blank=True, help_text='Backup this one holds the changes since, empty for a full backup', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='deltas', to='database.backup')),
+            ],
+        ),
+    ]
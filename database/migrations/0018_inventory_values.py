@@ -0,0 +1,39 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:00
+
+from django.db import migrations, models
+from django.db.models import Sum, F, Value, Subquery, OuterRef
+from django.db.models.functions import Coalesce
+
+
+def backfill_inventory_values(apps, schema_editor):
+    Product = apps.get_model('database', 'Product')
+
+    decimal_field = models.DecimalField(max_digits=15, decimal_places=3)
+    for model_name, field in [('Source', 'source'), ('Category', 'category')]:
+        value = Subquery(Product.objects.filter(**{field: OuterRef('pk')}).values(field)\
+                    .annotate(sum=Sum(F('stock') * F('cost_price'), output_field=decimal_field))\
+                    .values('sum')[:1])
+
+        apps.get_model('database', model_name).objects.update(
+            total_value=Coalesce(value, Value(0), output_field=decimal_field))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0017_product_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='total_value',
+            field=models.DecimalField(decimal_places=3, default=0.0, help_text='Stock value of the products in this category', max_digits=15),
+        ),
+        migrations.AddField(
+            model_name='source',
+            name='total_value',
+            field=models.DecimalField(decimal_places=3, default=0.0, help_text='Stock value of the products from this source', max_digits=15),
+        ),
+        migrations.RunPython(backfill_inventory_values, migrations.RunPython.noop),
+    ]
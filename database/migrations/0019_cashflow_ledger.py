@@ -0,0 +1,47 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:01
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+from django.db.models.functions import TruncDate
+
+
+def populate_cashflow(apps, schema_editor):
+    Invoice = apps.get_model('database', 'Invoice')
+    InvoiceCreditPayment = apps.get_model('database', 'InvoiceCreditPayment')
+    CashflowEntry = apps.get_model('database', 'CashflowEntry')
+
+    invoices = Invoice.objects.filter(credit=False).exclude(invoice_total=0)\
+                              .annotate(date=TruncDate('date_of_sale')).values_list('date', 'invoice_total', 'id')
+    payments = InvoiceCreditPayment.objects.annotate(date=TruncDate('date_of_payment'))\
+                                           .values_list('date', 'payment', 'invoice_id')
+
+    CashflowEntry.objects.bulk_create((CashflowEntry(date=date, type=entry_type, amount=amount, invoice_id=invoice_id)
+                                       for entry_type, rows in [('invoice', invoices), ('credit_payment', payments)]
+                                       for date, amount, invoice_id in rows.iterator()),
+                                      batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0018_inventory_values'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CashflowEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(help_text='Day the cash is counted on')),
+                ('type', models.CharField(choices=[('invoice', 'Cash invoice'), ('credit_payment', 'Credit payment')], help_text='Source of the cash', max_length=20)),
+                ('amount', models.DecimalField(decimal_places=3, help_text='Cash in, negative for refunds and reversals', max_digits=15)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, help_text='Date the entry was recorded')),
+                ('invoice', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cashflow_entries', to='database.invoice')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['date', 'type'], include=('amount',), name='cashflow_date_type_idx')],
+            },
+        ),
+        migrations.RunPython(populate_cashflow, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:02
+
+from django.db import migrations, models
+from django.db.models import Sum, F, Value, Subquery, OuterRef
+from django.db.models.functions import Coalesce
+
+
+def backfill_outstanding(apps, schema_editor):
+    Customer = apps.get_model('database', 'Customer')
+    Invoice = apps.get_model('database', 'Invoice')
+
+    decimal_field = models.DecimalField(max_digits=15, decimal_places=3)
+    outstanding = Subquery(Invoice.objects.filter(credit=True, invoice_total__gt=F('payments_total'), customer=OuterRef('pk'))\
+                      .values('customer_id')\
+                      .annotate(sum=Sum(F('invoice_total') - F('payments_total'), output_field=decimal_field))\
+                      .values('sum')[:1])
+
+    Customer.objects.update(outstanding_total=Coalesce(outstanding, Value(0), output_field=decimal_field))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0019_cashflow_ledger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customer',
+            name='outstanding_total',
+            field=models.DecimalField(decimal_places=3, default=0.0, help_text="Unpaid balance of the customer's credit invoices", max_digits=15),
+        ),
+        migrations.RunPython(backfill_outstanding, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='invoice',
+            index=models.Index(condition=models.Q(('credit', True), ('invoice_total__gt', models.F('payments_total'))), fields=['customer', 'date_of_sale'], name='invoice_receivable_idx'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:13
+
+from django.db import migrations, models
+from django.db.models import Sum, F
+from django.db.models.functions import TruncMonth
+import django.db.models.deletion
+
+
+def populate_monthly_sales(apps, schema_editor):
+    InvoiceProduct = apps.get_model('database', 'InvoiceProduct')
+    MonthlySales = apps.get_model('database', 'MonthlySales')
+
+    rows = InvoiceProduct.objects.annotate(month=TruncMonth('invoice__date_of_sale', output_field=models.DateField()))\
+                                 .values('month', 'product')\
+                                 .annotate(units_total=Sum(F('quantity') - F('returned_quantity')))\
+                                 .order_by()
+
+    MonthlySales.objects.bulk_create((MonthlySales(month=row['month'], product_id=row['product'],
+                                                   units_total=row['units_total']) for row in rows.iterator()),
+                                     batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0020_receivables'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonthlySales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(db_index=True, help_text='First day of the month of sale')),
+                ('units_total', models.IntegerField(default=0, help_text='Units sold in the month, net of returns')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='monthly_sales', to='database.product')),
+            ],
+            options={
+                'unique_together': {('product', 'month')},
+            },
+        ),
+        migrations.RunPython(populate_monthly_sales, migrations.RunPython.noop),
+    ]
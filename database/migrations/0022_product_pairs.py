@@ -0,0 +1,56 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:15
+
+from django.db import migrations, models
+from django.db.models import Count, F
+import django.db.models.deletion
+
+
+BASKET_LIMIT = 50
+
+
+def populate_product_pairs(apps, schema_editor):
+    Invoice = apps.get_model('database', 'Invoice')
+    InvoiceProduct = apps.get_model('database', 'InvoiceProduct')
+    ProductPair = apps.get_model('database', 'ProductPair')
+
+    small_invoices = Invoice.objects.annotate(product_count=Count('products__product', distinct=True))\
+                                    .filter(product_count__lte=BASKET_LIMIT).values('id')
+    pairs = InvoiceProduct.objects.filter(invoice__in=small_invoices)\
+                                  .annotate(companion=F('invoice__products__product'))\
+                                  .exclude(companion=F('product'))\
+                                  .values('product', 'companion')\
+                                  .annotate(invoices=Count('invoice', distinct=True))\
+                                  .order_by()
+    products = InvoiceProduct.objects.annotate(companion=F('product'))\
+                                     .values('product', 'companion')\
+                                     .annotate(invoices=Count('invoice', distinct=True))\
+                                     .order_by()
+
+    ProductPair.objects.bulk_create((ProductPair(product_id=row['product'], companion_id=row['companion'],
+                                                 invoices=row['invoices'])
+                                     for rows in (products, pairs) for row in rows.iterator()),
+                                    batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0021_monthly_sales'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductPair',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('invoices', models.IntegerField(default=0, help_text='Invoices with both products')),
+                ('companion', models.ForeignKey(help_text='Product on the same invoices, the product itself for its own count', on_delete=django.db.models.deletion.CASCADE, related_name='+', to='database.product')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pairs', to='database.product')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['product', '-invoices'], name='product_pair_top_idx')],
+                'unique_together': {('product', 'companion')},
+            },
+        ),
+        migrations.RunPython(populate_product_pairs, migrations.RunPython.noop),
+    ]
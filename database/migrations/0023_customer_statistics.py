@@ -0,0 +1,47 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:17
+
+from django.db import migrations, models
+from django.db.models import Sum, Count, Min, Max
+import django.db.models.deletion
+
+
+def populate_customer_statistics(apps, schema_editor):
+    Invoice = apps.get_model('database', 'Invoice')
+    CustomerStatistics = apps.get_model('database', 'CustomerStatistics')
+
+    rows = Invoice.objects.values('customer')\
+                          .annotate(first_purchase=Min('date_of_sale'), last_purchase=Max('date_of_sale'),
+                                    invoice_count=Count('id'), sales_total=Sum('invoice_total'),
+                                    profit_total=Sum('profit_total'))\
+                          .order_by()
+
+    CustomerStatistics.objects.bulk_create((CustomerStatistics(customer_id=row['customer'],
+                                                               first_purchase=row['first_purchase'],
+                                                               last_purchase=row['last_purchase'],
+                                                               invoice_count=row['invoice_count'],
+                                                               sales_total=row['sales_total'],
+                                                               profit_total=row['profit_total'])
+                                            for row in rows.iterator()),
+                                           batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0022_product_pairs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CustomerStatistics',
+            fields=[
+                ('customer', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='statistics', serialize=False, to='database.customer')),
+                ('first_purchase', models.DateTimeField(blank=True, help_text='Date of sale of the first invoice', null=True)),
+                ('last_purchase', models.DateTimeField(blank=True, help_text='Date of sale of the latest invoice', null=True)),
+                ('invoice_count', models.IntegerField(default=0, help_text='Number of invoices')),
+                ('sales_total', models.DecimalField(decimal_places=3, default=0.0, help_text='Sales over all invoices, net of returns', max_digits=15)),
+                ('profit_total', models.DecimalField(decimal_places=3, default=0.0, help_text='Profit over all invoices, net of returns', max_digits=15)),
+            ],
+        ),
+        migrations.RunPython(populate_customer_statistics, migrations.RunPython.noop),
+    ]
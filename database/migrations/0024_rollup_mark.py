@@ -0,0 +1,31 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:29
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+# Sales so far were counted into the product pairs when they were made
+def mark_product_pairs(apps, schema_editor):
+    Invoice = apps.get_model('database', 'Invoice')
+    RollupMark = apps.get_model('database', 'RollupMark')
+
+    RollupMark.objects.create(name='product_pairs', last_id=Invoice.objects.aggregate(last_id=Max('id'))['last_id'] or 0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0023_customer_statistics'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupMark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.TextField(help_text='Name of the rollup', unique=True)),
+                ('last_id', models.BigIntegerField(default=0, help_text='Id of the last row counted in the rollup')),
+            ],
+        ),
+        migrations.RunPython(mark_product_pairs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:41
+
+import uuid
+
+from django.db import migrations, models
+
+
+# Existing backups each need their own uuid before the column can be unique
+def populate_uuids(apps, schema_editor):
+    Backup = apps.get_model('database', 'Backup')
+
+    backups = list(Backup.objects.all())
+    for record in backups:
+        record.uuid = uuid.uuid4()
+    Backup.objects.bulk_update(backups, ['uuid'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0024_rollup_mark'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backup',
+            name='uuid',
+            field=models.UUIDField(editable=False, help_text='Identifies the backup across restores, which reuse the ids', null=True),
+        ),
+        migrations.RunPython(populate_uuids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='backup',
+            name='uuid',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, help_text='Identifies the backup across restores, which reuse the ids', unique=True),
+        ),
+    ]
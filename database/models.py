@@ -1,8 +1,28 @@
-from django.db import models
+from django.db import models, transaction, connections
+from django.db.transaction import TransactionManagementError
 from django.utils import timezone
-from django.db.models import Sum, F, Subquery, OuterRef
+from django.db.models import Sum, Count, Min, Max, F, Q, Value, Case, When, Subquery, OuterRef, FilteredRelation
+from django.db.models.functions import Coalesce, Cast, Ceil, TruncDate, TruncMonth, Greatest, Upper
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.contrib.postgres.search import TrigramSimilarity
 
 import re
+import uuid
+import datetime
+
+
+# Rollups are rebuilt by deleting and inserting them again, block writes to their source tables and to the rollup
+# until the rebuild commits so a sale made meanwhile is neither lost nor inserted twice. Reads carry on. Only
+# PostgreSQL has table locks, the other backends lock the whole database on the first write.
+def lock_tables(using, *lock_models):
+    connection = connections[using]
+    if not connection.in_atomic_block:
+        raise TransactionManagementError("Rollups can only be rebuilt inside a transaction")
+
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('LOCK TABLE {0} IN SHARE ROW EXCLUSIVE MODE'.format(
+                ', '.join(connection.ops.quote_name(model._meta.db_table) for model in lock_models)))
 
 
 class NaturalSortField(models.TextField):
@@ -19,6 +39,9 @@ class NaturalSortField(models.TextField):
         def naturalize_int_match(match):
             return '%08d' % (int(match.group(0)),)
 
+        if string is None:
+            return None
+
         string = string.lower()
         string = string.strip()
         string = re.sub(r'^the\s+', '', string)
@@ -27,8 +50,17 @@ class NaturalSortField(models.TextField):
         return string
 
 
+# Rows of these models are what incremental backups pick up, changed rows by their modified time and deleted
+# rows through a DeletedRow tombstone. Queryset update() and bulk_update() skip auto_now, so callers set it.
+class BackupTrackedModel(models.Model):
+    class Meta:
+        abstract = True
+
+    modified = models.DateTimeField(auto_now=True, db_index=True, help_text="Date of the last change to the row")
+
+
 # Supplier
-class Supplier(models.Model):
+class Supplier(BackupTrackedModel):
     class Meta:
         unique_together = ('company', 'agent',)
 
@@ -40,34 +72,114 @@ class Supplier(models.Model):
 
 
 # Source and Category
-class TotalValueManager(models.Manager):
-    def get_queryset(self):
-        queryset = super(TotalValueManager, self).get_queryset()
-        queryset = queryset.annotate(total_value=Sum(F('products__stock') * F('products__cost_price'),
-                                     output_field=models.DecimalField(max_digits=15, decimal_places=3)))
-        return queryset
-
-
-class Source(models.Model):
+class InventoryValueManager(models.Manager):
+    # Stock value of the products in each group, used to keep the stored column in sync
+    def computed_value(self):
+        field = self.model._meta.get_field('products').field.name
+        value = Subquery(Product.objects.filter(**{field: OuterRef('pk')}).values(field)\
+                    .annotate(sum=Sum(F('stock') * F('cost_price'),
+                        output_field=models.DecimalField(max_digits=15, decimal_places=3)))\
+                    .values('sum')[:1])
+
+        return Coalesce(value, Value(0), output_field=models.DecimalField(max_digits=15, decimal_places=3))
+
+    def refresh_values(self, ids=None):
+        queryset = self.get_queryset()
+        if ids is not None:
+            queryset = queryset.filter(id__in=ids)
+
+        return queryset.update(total_value=self.computed_value(), modified=timezone.now())
+
+    # Add signed amounts to the stored values, {id: amount}. Increments stay correct under concurrent writers.
+    def adjust_values(self, amounts):
+        amounts = {pk: amount for pk, amount in amounts.items() if amount}
+        if not amounts:
+            return
+
+        self.get_queryset().filter(id__in=amounts)\
+            .update(total_value=F('total_value') + Case(*[When(id=pk, then=Value(amount)) for pk, amount in amounts.items()],
+                                                       output_field=models.DecimalField(max_digits=15, decimal_places=3)),
+                    modified=timezone.now())
+
+    # Groups whose stored value no longer matches their products
+    def drifted(self):
+        return self.get_queryset().annotate(computed_value=self.computed_value())\
+                                  .exclude(total_value=F('computed_value'))
+
+
+class Source(BackupTrackedModel):
     name = models.TextField(unique=True, help_text="Name of a country and/or city")
     created = models.DateTimeField(default=timezone.now, help_text="Date product was added to database")
+    total_value = models.DecimalField(default=0.0, max_digits=15, decimal_places=3,
+                                      help_text="Stock value of the products from this source")
 
-    # Override the default ORM manager
-    objects = TotalValueManager()
+    objects = InventoryValueManager()
 
 
-class Category(models.Model):
+class Category(BackupTrackedModel):
     name = models.TextField(unique=True, help_text="Name of a product category")
     created = models.DateTimeField(default=timezone.now, help_text="Date product was added to database")
+    total_value = models.DecimalField(default=0.0, max_digits=15, decimal_places=3,
+                                      help_text="Stock value of the products in this category")
 
-    # Override the default ORM manager
-    objects = TotalValueManager()
+    objects = InventoryValueManager()
 
 
 # Product
-class Product(models.Model):
+class ProductManager(models.Manager):
+    # Products containing the query in their name, description or size, most similar first. The icontains lookups
+    # compare UPPER(column) so they are served by the trigram index on those expressions
+    def search(self, query):
+        return self.filter(Q(name__icontains=query) | Q(description__icontains=query) | Q(size__icontains=query))\
+                   .annotate(rank=Greatest(TrigramSimilarity('name', query),
+                                           TrigramSimilarity('description', query),
+                                           TrigramSimilarity('size', query)))\
+                   .order_by('-rank', 'name_sort', 'id')
+
+    # Sales velocity of every product from the monthly rollup, in one grouped query over the last year of it: units
+    # sold this month so far and in the previous 3 and 12 whole months with their monthly averages, the daily rate
+    # since the start of the 3 month window, the days the current stock lasts at that rate and the quantity to
+    # order for the stock to last lead_days + cover_days
+    def velocity(self, lead_days=0, cover_days=0):
+        this_month = timezone.localdate().replace(day=1)
+
+        def months_before(months):
+            year, month = divmod(this_month.year * 12 + this_month.month - 1 - months, 12)
+            return datetime.date(year, month + 1, 1)
+
+        window_start = months_before(3)
+        window_days = (timezone.localdate() - window_start).days + 1
+
+        def units(**lookups):
+            return Coalesce(Sum('recent_sales__units_total',
+                                filter=Q(**{'recent_sales__' + lookup: value for lookup, value in lookups.items()})),
+                            Value(0))
+
+        daily_rate = Cast(F('units_month') + F('units_3_months'), models.FloatField()) / window_days
+
+        return self.annotate(recent_sales=FilteredRelation('monthly_sales', condition=Q(
+                                 monthly_sales__month__gte=months_before(12))))\
+                   .annotate(units_month=units(month__gte=this_month),
+                             units_3_months=units(month__gte=window_start, month__lt=this_month),
+                             units_12_months=units(month__lt=this_month))\
+                   .annotate(average_3_months=Cast('units_3_months', models.FloatField()) / 3,
+                             average_12_months=Cast('units_12_months', models.FloatField()) / 12,
+                             daily_rate=daily_rate)\
+                   .annotate(days_of_cover=Case(When(daily_rate__gt=0, then=F('stock') / F('daily_rate')),
+                                                output_field=models.FloatField()),
+                             reorder_quantity=Greatest(Cast(Ceil(F('daily_rate') * (lead_days + cover_days)),
+                                                            models.IntegerField()) - F('stock'), Value(0)))
+
+
+class Product(BackupTrackedModel):
     class Meta:
         unique_together = ('name', 'description', 'size', 'supplier',)
+        indexes = [
+            GinIndex(OpClass(Upper('name'), name='gin_trgm_ops'),
+                     OpClass(Upper('description'), name='gin_trgm_ops'),
+                     OpClass(Upper('size'), name='gin_trgm_ops'),
+                     name='product_search_trgm_idx'),
+        ]
 
     name = models.TextField(help_text="Name of the product")
     name_sort = NaturalSortField(blank=True, null=True, for_field='name')
@@ -85,20 +197,129 @@ class Product(models.Model):
     category = models.ForeignKey(Category, related_name="products", on_delete=models.PROTECT)
     supplier = models.ForeignKey(Supplier, related_name="products", on_delete=models.PROTECT)
 
+    objects = ProductManager()
+
 
 # Customer
-class Customer(models.Model):
+class CustomerManager(models.Manager):
+    # Outstanding credit of each customer, summed over their open credit invoices
+    def computed_outstanding(self):
+        outstanding = Subquery(Invoice.objects.receivable().filter(customer=OuterRef('pk')).values('customer_id')\
+                          .annotate(sum=Sum(F('invoice_total') - F('payments_total'),
+                              output_field=models.DecimalField(max_digits=15, decimal_places=3)))\
+                          .values('sum')[:1])
+
+        return Coalesce(outstanding, Value(0), output_field=models.DecimalField(max_digits=15, decimal_places=3))
+
+    def refresh_outstanding(self, customer_ids=None):
+        queryset = self.get_queryset()
+        if customer_ids is not None:
+            queryset = queryset.filter(id__in=customer_ids)
+            # Lock the customers first so the sum below also sees invoices changed by a concurrent payment
+            list(queryset.select_for_update().order_by('id').values_list('id'))
+
+        return queryset.update(outstanding_total=self.computed_outstanding(), modified=timezone.now())
+
+    # Customers whose stored outstanding total no longer matches their credit invoices
+    def drifted(self):
+        return self.get_queryset().annotate(computed_outstanding=self.computed_outstanding())\
+                                  .exclude(outstanding_total=F('computed_outstanding'))
+
+
+class Customer(BackupTrackedModel):
     created = models.DateTimeField(default=timezone.now, help_text="Date customer added to database")
     name = models.TextField(unique=True, help_text="Name of the customer")
     primary_phone = models.CharField(blank=True, null=True, max_length=25, help_text="Phone number of the customer")
     secondary_phone = models.CharField(blank=True, null=True, max_length=25, help_text="Phone number of the customer")
+    outstanding_total = models.DecimalField(default=0.0, max_digits=15, decimal_places=3,
+                                            help_text="Unpaid balance of the customer's credit invoices")
+
+    objects = CustomerManager()
+
+
+# Customer lifetime statistics
+class CustomerStatisticsManager(models.Manager):
+    # Add invoices and returns to the statistics, each a (customer_id, date_of_sale, invoices, sales, profit) tuple
+    # with the sales and profit changes. Returns have no date and count no invoices. The customers are locked
+    # first, like refresh_outstanding, so concurrent invoices of a new customer do not both create its row.
+    def record(self, changes):
+        totals = dict()
+        for customer_id, date_of_sale, invoices, sales, profit in changes:
+            dates, count, sales_total, profit_total = totals.get(customer_id, ([], 0, 0, 0))
+            totals[customer_id] = (dates + [date_of_sale] if date_of_sale else dates, count + invoices,
+                                   sales_total + sales, profit_total + profit)
+
+        if not totals:
+            return
+
+        list(Customer.objects.select_for_update().filter(id__in=totals).order_by('id').values_list('id'))
+        existing = self.in_bulk(list(totals))
+
+        updated_rows = []
+        created_rows = []
+        for customer_id, (dates, invoices, sales, profit) in totals.items():
+            row = existing.get(customer_id)
+            if row:
+                dates += [date for date in (row.first_purchase, row.last_purchase) if date]
+                row.invoice_count = F('invoice_count') + invoices
+                row.sales_total = F('sales_total') + sales
+                row.profit_total = F('profit_total') + profit
+                updated_rows.append(row)
+            else:
+                row = CustomerStatistics(customer_id=customer_id, invoice_count=invoices, sales_total=sales,
+                                         profit_total=profit)
+                created_rows.append(row)
+            row.first_purchase = min(dates) if dates else None
+            row.last_purchase = max(dates) if dates else None
+
+        self.bulk_update(updated_rows, ['first_purchase', 'last_purchase', 'invoice_count', 'sales_total',
+                                        'profit_total'])
+        self.bulk_create(created_rows)
+
+    def rebuild(self):
+        lock_tables(self.db, Invoice, CustomerStatistics)
+        rows = Invoice.objects.values('customer')\
+                   .annotate(first_purchase=Min('date_of_sale'), last_purchase=Max('date_of_sale'),
+                             invoice_count=Count('id'), sales_total=Sum('invoice_total'),
+                             profit_total=Sum('profit_total'))\
+                   .order_by()
+
+        self.all()._raw_delete(self.db)
+        created = self.bulk_create((CustomerStatistics(customer_id=row['customer'],
+                                                       first_purchase=row['first_purchase'],
+                                                       last_purchase=row['last_purchase'],
+                                                       invoice_count=row['invoice_count'],
+                                                       sales_total=row['sales_total'],
+                                                       profit_total=row['profit_total'])
+                                    for row in rows.iterator()),
+                                   batch_size=1000)
+        return len(created)
+
+
+class CustomerStatistics(models.Model):
+    customer = models.OneToOneField(Customer, primary_key=True, related_name="statistics", on_delete=models.CASCADE)
+    first_purchase = models.DateTimeField(blank=True, null=True, help_text="Date of sale of the first invoice")
+    last_purchase = models.DateTimeField(blank=True, null=True, help_text="Date of sale of the latest invoice")
+    invoice_count = models.IntegerField(default=0, help_text="Number of invoices")
+    sales_total = models.DecimalField(default=0.0, max_digits=15, decimal_places=3,
+                                      help_text="Sales over all invoices, net of returns")
+    profit_total = models.DecimalField(default=0.0, max_digits=15, decimal_places=3,
+                                       help_text="Profit over all invoices, net of returns")
+
+    # Override the default ORM manager
+    objects = CustomerStatisticsManager()
+
+    @property
+    def average_basket(self):
+        if not self.invoice_count:
+            return None
+        return self.sales_total / self.invoice_count
 
 
 # Invoice
 class InvoiceTotalManager(models.Manager):
-    def get_queryset(self):
-        queryset = super(InvoiceTotalManager, self).get_queryset()
-
+    # Totals computed from the line items and payments, used to keep the stored columns in sync
+    def computed_totals(self):
         invoice_total = Subquery(InvoiceProduct.objects.filter(invoice=OuterRef('pk')).values('invoice_id')\
                             .annotate(sum=Sum((F('quantity') - F('returned_quantity')) * F('sell_price'),
                                 output_field=models.DecimalField(max_digits=15, decimal_places=3)))\
@@ -111,15 +332,49 @@ class InvoiceTotalManager(models.Manager):
                             .annotate(sum=Sum('payment', output_field=models.DecimalField(max_digits=15, decimal_places=3)))
                             .values('sum')[:1])
 
-        queryset = queryset.annotate(invoice_total=invoice_total, profit_total=profit_total, payments_total=payments_total)
-        return queryset
+        return {name: Coalesce(total, Value(0), output_field=models.DecimalField(max_digits=15, decimal_places=3))
+                for name, total in [('invoice_total', invoice_total), ('profit_total', profit_total),
+                                    ('payments_total', payments_total)]}
+
+    def refresh_totals(self, invoice_ids=None):
+        queryset = self.get_queryset()
+        if invoice_ids is not None:
+            queryset = queryset.filter(id__in=invoice_ids)
+
+        return queryset.update(modified=timezone.now(), **self.computed_totals())
+
+    # Credit invoices with an unpaid balance, served by the receivable partial index
+    def receivable(self):
+        return self.get_queryset().filter(credit=True, invoice_total__gt=F('payments_total'))
+
+    # Invoices whose stored totals no longer match their line items and payments
+    def drifted(self):
+        totals = self.computed_totals()
+        queryset = self.get_queryset().annotate(**{'computed_' + name: total for name, total in totals.items()})
+
+        drift = Q()
+        for name in totals:
+            drift |= ~Q(**{name: F('computed_' + name)})
 
+        return queryset.filter(drift)
+
+
+class Invoice(BackupTrackedModel):
+    class Meta:
+        indexes = [
+            models.Index(fields=['date_of_sale', 'customer'], name='invoice_sale_customer_idx'),
+            models.Index(fields=['credit', 'date_of_sale'], name='invoice_credit_sale_idx'),
+            models.Index(fields=['customer', 'date_of_sale'], condition=Q(credit=True, invoice_total__gt=F('payments_total')),
+                         name='invoice_receivable_idx'),
+        ]
 
-class Invoice(models.Model):
     created = models.DateTimeField(default=timezone.now, help_text="Date of creation of the invoice")
     credit = models.BooleanField(default=False, help_text="Credit sale")
     customer = models.ForeignKey(Customer, on_delete=models.PROTECT)
     date_of_sale = models.DateTimeField(default=timezone.now, help_text="Date of sale for the invoice")
+    invoice_total = models.DecimalField(default=0.0, max_digits=15, decimal_places=3, help_text="Total of the invoice, net of returns")
+    profit_total = models.DecimalField(default=0.0, max_digits=15, decimal_places=3, help_text="Profit of the invoice, net of returns")
+    payments_total = models.DecimalField(default=0.0, max_digits=15, decimal_places=3, help_text="Credit payments made for the invoice")
 
     # Override the default ORM manager
     objects = InvoiceTotalManager()
@@ -128,19 +383,10 @@ class Invoice(models.Model):
 class InvoiceProductManager(models.Manager):
     def totals(self):
         queryset = super(InvoiceProductManager, self).get_queryset()
-
-        payments_total = Subquery(InvoiceCreditPayment.objects.filter(invoice=OuterRef('invoice')).values('invoice_id')\
-                            .annotate(sum=Sum('payment', output_field=models.DecimalField(max_digits=15, decimal_places=3)))
-                            .values('sum')[:1])
-        invoice_total = Subquery(InvoiceProduct.objects.filter(invoice=OuterRef('invoice')).values('invoice_id')\
-                            .annotate(sum=Sum((F('quantity') - F('returned_quantity')) * F('sell_price'),
-                                output_field=models.DecimalField(max_digits=15, decimal_places=3)))\
-                            .values('sum')[:1])
-
-        queryset = queryset.annotate(invoice_total=invoice_total, payments_total=payments_total)
+        queryset = queryset.annotate(invoice_total=F('invoice__invoice_total'), payments_total=F('invoice__payments_total'))
         return queryset
 
-class InvoiceProduct(models.Model):
+class InvoiceProduct(BackupTrackedModel):
     invoice = models.ForeignKey(Invoice, related_name="products", on_delete=models.PROTECT)
     product = models.ForeignKey(Product, on_delete=models.PROTECT)
     quantity = models.IntegerField(help_text="Quantity sold")
@@ -152,7 +398,351 @@ class InvoiceProduct(models.Model):
     objects = InvoiceProductManager()
 
 
-class InvoiceCreditPayment(models.Model):
+class InvoiceCreditPayment(BackupTrackedModel):
+    class Meta:
+        indexes = [
+            models.Index(fields=['date_of_payment'], name='payment_date_idx'),
+        ]
+
     invoice = models.ForeignKey(Invoice, related_name="credit_payments", on_delete=models.PROTECT)
     payment = models.DecimalField(max_digits=7, decimal_places=3, help_text="Credit payment for this invoice")
     date_of_payment = models.DateTimeField(default=timezone.now, help_text="Date of credit payment")
+
+
+# Daily sales rollup
+class DailySalesManager(models.Manager):
+    # Add sold (or, with negative units, returned) line items to the rollup. Each line is a
+    # (date_of_sale, customer_id, product_id, units, sell_price, cost_price) tuple. Callers hold the row locks on
+    # the products involved, which serializes writers of the same rollup rows.
+    def record(self, lines):
+        totals = dict()
+        for date_of_sale, customer_id, product_id, units, sell_price, cost_price in lines:
+            key = (timezone.localdate(date_of_sale), product_id, customer_id)
+            sales, profit, count = totals.get(key, (0, 0, 0))
+            totals[key] = (sales + units * sell_price, profit + units * (sell_price - cost_price), count + units)
+
+        if not totals:
+            return
+
+        existing = self.filter(date__in={key[0] for key in totals}, product_id__in={key[1] for key in totals},
+                               customer_id__in={key[2] for key in totals})
+        existing = {(row.date, row.product_id, row.customer_id): row for row in existing}
+
+        updated_rows = []
+        created_rows = []
+        for key, (sales, profit, units) in totals.items():
+            row = existing.get(key)
+            if row:
+                row.sales_total = F('sales_total') + sales
+                row.profit_total = F('profit_total') + profit
+                row.units_total = F('units_total') + units
+                updated_rows.append(row)
+            else:
+                created_rows.append(DailySales(date=key[0], product_id=key[1], customer_id=key[2], sales_total=sales,
+                                               profit_total=profit, units_total=units))
+
+        self.bulk_update(updated_rows, ['sales_total', 'profit_total', 'units_total'])
+        self.bulk_create(created_rows)
+
+    def rebuild(self):
+        lock_tables(self.db, Invoice, InvoiceProduct, DailySales)
+        rows = InvoiceProduct.objects.annotate(date=TruncDate('invoice__date_of_sale'), customer=F('invoice__customer'))\
+                   .values('date', 'product', 'customer')\
+                   .annotate(sales_total=Sum((F('quantity') - F('returned_quantity')) * F('sell_price'),
+                                 output_field=models.DecimalField(max_digits=15, decimal_places=3)),
+                             profit_total=Sum((F('quantity') - F('returned_quantity')) * (F('sell_price') - F('cost_price')),
+                                 output_field=models.DecimalField(max_digits=15, decimal_places=3)),
+                             units_total=Sum(F('quantity') - F('returned_quantity')))\
+                   .order_by()
+
+        self.all()._raw_delete(self.db)
+        created = self.bulk_create((DailySales(date=row['date'], product_id=row['product'], customer_id=row['customer'],
+                                               sales_total=row['sales_total'], profit_total=row['profit_total'],
+                                               units_total=row['units_total']) for row in rows.iterator()),
+                                   batch_size=1000)
+        return len(created)
+
+
+class DailySales(models.Model):
+    class Meta:
+        unique_together = ('date', 'product', 'customer',)
+
+    date = models.DateField(db_index=True, help_text="Day of sale")
+    product = models.ForeignKey(Product, related_name="daily_sales", on_delete=models.CASCADE)
+    customer = models.ForeignKey(Customer, related_name="daily_sales", on_delete=models.CASCADE)
+    sales_total = models.DecimalField(default=0.0, max_digits=15, decimal_places=3, help_text="Sales for the day")
+    profit_total = models.DecimalField(default=0.0, max_digits=15, decimal_places=3, help_text="Profit for the day")
+    units_total = models.IntegerField(default=0, help_text="Units sold for the day, net of returns")
+
+    # Override the default ORM manager
+    objects = DailySalesManager()
+
+
+# Monthly sales of each product
+class MonthlySalesManager(models.Manager):
+    # Add sold (or returned) units to the rollup, taking the same line tuples as DailySalesManager.record. Callers
+    # hold the row locks on the products involved.
+    def record(self, lines):
+        totals = dict()
+        for date_of_sale, customer_id, product_id, units, sell_price, cost_price in lines:
+            key = (timezone.localdate(date_of_sale).replace(day=1), product_id)
+            totals[key] = totals.get(key, 0) + units
+
+        if not totals:
+            return
+
+        existing = self.filter(month__in={key[0] for key in totals}, product_id__in={key[1] for key in totals})
+        existing = {(row.month, row.product_id): row for row in existing}
+
+        updated_rows = []
+        created_rows = []
+        for key, units in totals.items():
+            row = existing.get(key)
+            if row:
+                row.units_total = F('units_total') + units
+                updated_rows.append(row)
+            else:
+                created_rows.append(MonthlySales(month=key[0], product_id=key[1], units_total=units))
+
+        self.bulk_update(updated_rows, ['units_total'])
+        self.bulk_create(created_rows)
+
+    def rebuild(self):
+        lock_tables(self.db, Invoice, InvoiceProduct, MonthlySales)
+        rows = InvoiceProduct.objects.annotate(month=TruncMonth('invoice__date_of_sale', output_field=models.DateField()))\
+                   .values('month', 'product')\
+                   .annotate(units_total=Sum(F('quantity') - F('returned_quantity')))\
+                   .order_by()
+
+        self.all()._raw_delete(self.db)
+        created = self.bulk_create((MonthlySales(month=row['month'], product_id=row['product'],
+                                                 units_total=row['units_total']) for row in rows.iterator()),
+                                   batch_size=1000)
+        return len(created)
+
+
+class MonthlySales(models.Model):
+    class Meta:
+        unique_together = ('product', 'month',)
+
+    month = models.DateField(db_index=True, help_text="First day of the month of sale")
+    product = models.ForeignKey(Product, related_name="monthly_sales", on_delete=models.CASCADE)
+    units_total = models.IntegerField(default=0, help_text="Units sold in the month, net of returns")
+
+    # Override the default ORM manager
+    objects = MonthlySalesManager()
+
+
+# Progress of rollups refreshed in the background
+class RollupMarkManager(models.Manager):
+    # The mark of the named rollup, locked until the end of the transaction so refreshes do not overlap
+    def lock(self, name):
+        self.get_or_create(name=name)
+        return self.select_for_update().get(name=name)
+
+
+class RollupMark(models.Model):
+    name = models.TextField(unique=True, help_text="Name of the rollup")
+    last_id = models.BigIntegerField(default=0, help_text="Id of the last row counted in the rollup")
+
+    # Override the default ORM manager
+    objects = RollupMarkManager()
+
+
+# Products bought together
+class ProductPairManager(models.Manager):
+    # Invoices with more distinct products than this say little about which products go together and would add
+    # the square of their size in pairs, only their own product counts are kept
+    BASKET_LIMIT = 50
+
+    @classmethod
+    def basket_pairs(cls, product_ids):
+        product_ids = set(product_ids)
+        if len(product_ids) > cls.BASKET_LIMIT:
+            return [(product_id, product_id) for product_id in product_ids]
+        return [(product_id, companion_id) for product_id in product_ids for companion_id in product_ids]
+
+    # Invoices are counted once they are this old, so a sale still being committed with a lower id is not skipped
+    SETTLE_TIME = datetime.timedelta(minutes=5)
+    MARK = 'product_pairs'
+
+    # Count the products of new invoices, each basket a collection of the product ids on one invoice. Only called
+    # by refresh and rebuild, which hold the lock on the rollup mark.
+    def record(self, baskets):
+        totals = dict()
+        for product_ids in baskets:
+            for key in self.basket_pairs(product_ids):
+                totals[key] = totals.get(key, 0) + 1
+
+        if not totals:
+            return
+
+        existing = self.filter(product_id__in={key[0] for key in totals}, companion_id__in={key[1] for key in totals})
+        existing = {(row.product_id, row.companion_id): row for row in existing}
+
+        updated_rows = []
+        created_rows = []
+        for key, invoices in totals.items():
+            row = existing.get(key)
+            if row:
+                row.invoices = F('invoices') + invoices
+                updated_rows.append(row)
+            else:
+                created_rows.append(ProductPair(product_id=key[0], companion_id=key[1], invoices=invoices))
+
+        self.bulk_update(updated_rows, ['invoices'])
+        self.bulk_create(created_rows)
+
+    # Count the invoices added since the last refresh, in batches of batch_size invoices. Kept out of the sale so the
+    # till does not pay for the square of the invoice size in writes, run it every few minutes from cron with the
+    # refresh_product_pairs command. Returns the number of invoices counted.
+    def refresh(self, batch_size=500):
+        count = 0
+        while True:
+            with transaction.atomic():
+                mark = RollupMark.objects.lock(self.MARK)
+                invoice_ids = list(Invoice.objects.filter(id__gt=mark.last_id)
+                                                  .filter(modified__lt=timezone.now() - self.SETTLE_TIME)
+                                                  .order_by('id').values_list('id', flat=True)[:batch_size])
+                if not invoice_ids:
+                    return count
+
+                # Every invoice up to the newest settled one, also those changed since by a return
+                lines = InvoiceProduct.objects.filter(invoice__gt=mark.last_id, invoice__lte=invoice_ids[-1])\
+                                              .order_by().values_list('invoice_id', 'product_id')
+                baskets = dict()
+                for invoice_id, product_id in lines:
+                    baskets.setdefault(invoice_id, []).append(product_id)
+
+                self.record(baskets.values())
+                mark.last_id = invoice_ids[-1]
+                mark.save(update_fields=['last_id'])
+                count += len(baskets)
+
+    def rebuild(self):
+        lock_tables(self.db, Invoice, InvoiceProduct, ProductPair)
+        mark = RollupMark.objects.lock(self.MARK)
+        mark.last_id = Invoice.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+
+        small_invoices = Invoice.objects.filter(id__lte=mark.last_id)\
+                                        .annotate(product_count=Count('products__product', distinct=True))\
+                                        .filter(product_count__lte=self.BASKET_LIMIT).values('id')
+        pairs = InvoiceProduct.objects.filter(invoice__in=small_invoices)\
+                    .annotate(companion=F('invoice__products__product'))\
+                    .exclude(companion=F('product'))\
+                    .values('product', 'companion')\
+                    .annotate(invoices=Count('invoice', distinct=True))\
+                    .order_by()
+        products = InvoiceProduct.objects.filter(invoice__lte=mark.last_id)\
+                       .annotate(companion=F('product'))\
+                       .values('product', 'companion')\
+                       .annotate(invoices=Count('invoice', distinct=True))\
+                       .order_by()
+
+        self.all()._raw_delete(self.db)
+        created = self.bulk_create((ProductPair(product_id=row['product'], companion_id=row['companion'],
+                                                invoices=row['invoices'])
+                                    for rows in (products, pairs) for row in rows.iterator()),
+                                   batch_size=1000)
+        mark.save(update_fields=['last_id'])
+        return len(created)
+
+    # The limit products most often bought with the given one, with the share of all invoices they are on together
+    # (support), the share of the product's invoices (confidence) and how much more often than by chance (lift)
+    def companions(self, product_id, invoice_count, limit=10):
+        own = self.filter(product=product_id, companion=product_id).values_list('invoices', flat=True).first()
+        if not own:
+            return []
+
+        rows = self.filter(product=product_id).exclude(companion=product_id)\
+                   .annotate(companion_invoices=Subquery(self.filter(product=OuterRef('companion'),
+                                                                     companion=OuterRef('companion'))
+                                                             .values('invoices')[:1]))\
+                   .order_by('-invoices', 'companion')[:limit]
+
+        return [{'product': row.companion_id, 'invoices': row.invoices,
+                 'support': row.invoices / invoice_count,
+                 'confidence': row.invoices / own,
+                 'lift': row.invoices * invoice_count / (own * row.companion_invoices)}
+                for row in rows]
+
+
+class ProductPair(models.Model):
+    class Meta:
+        unique_together = ('product', 'companion',)
+        indexes = [
+            models.Index(fields=['product', '-invoices'], name='product_pair_top_idx'),
+        ]
+
+    product = models.ForeignKey(Product, related_name="pairs", on_delete=models.CASCADE)
+    companion = models.ForeignKey(Product, related_name="+", on_delete=models.CASCADE,
+                                  help_text="Product on the same invoices, the product itself for its own count")
+    invoices = models.IntegerField(default=0, help_text="Invoices with both products")
+
+    # Override the default ORM manager
+    objects = ProductPairManager()
+
+
+# Cashflow ledger
+class CashflowEntryManager(models.Manager):
+    # Append cash events, each a (date, type, amount, invoice_id) tuple. Changes are recorded as new signed entries,
+    # never by editing earlier ones.
+    def record(self, entries):
+        self.bulk_create([CashflowEntry(date=timezone.localdate(date), type=entry_type, amount=amount, invoice_id=invoice_id)
+                          for date, entry_type, amount, invoice_id in entries if amount])
+
+    def rebuild(self):
+        lock_tables(self.db, Invoice, InvoiceCreditPayment, CashflowEntry)
+        invoices = Invoice.objects.filter(credit=False).exclude(invoice_total=0)\
+                                  .annotate(date=TruncDate('date_of_sale')).values_list('date', 'invoice_total', 'id')
+        payments = InvoiceCreditPayment.objects.annotate(date=TruncDate('date_of_payment'))\
+                                               .values_list('date', 'payment', 'invoice_id')
+
+        self.all()._raw_delete(self.db)
+        created = self.bulk_create([CashflowEntry(date=date, type=entry_type, amount=amount, invoice_id=invoice_id)
+                                    for entry_type, rows in [(CashflowEntry.INVOICE, invoices),
+                                                             (CashflowEntry.CREDIT_PAYMENT, payments)]
+                                    for date, amount, invoice_id in rows.iterator()],
+                                   batch_size=1000)
+        return len(created)
+
+
+class CashflowEntry(models.Model):
+    INVOICE = 'invoice'
+    CREDIT_PAYMENT = 'credit_payment'
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['date', 'type'], include=['amount'], name='cashflow_date_type_idx'),
+        ]
+
+    date = models.DateField(help_text="Day the cash is counted on")
+    type = models.CharField(max_length=20, choices=[(INVOICE, "Cash invoice"), (CREDIT_PAYMENT, "Credit payment")],
+                            help_text="Source of the cash")
+    amount = models.DecimalField(max_digits=15, decimal_places=3, help_text="Cash in, negative for refunds and reversals")
+    invoice = models.ForeignKey(Invoice, related_name="cashflow_entries", on_delete=models.CASCADE)
+    created = models.DateTimeField(default=timezone.now, help_text="Date the entry was recorded")
+
+    # Override the default ORM manager
+    objects = CashflowEntryManager()
+
+
+# Backups
+class DeletedRow(models.Model):
+    model = models.TextField(help_text="Label of the model the row belonged to")
+    object_id = models.BigIntegerField(help_text="Primary key of the deleted row")
+    deleted = models.DateTimeField(default=timezone.now, db_index=True, help_text="Date the row was deleted")
+
+
+# Connected to each BackupTrackedModel by DatabaseConfig.ready. A receiver without a sender would turn off fast
+# deletes for every model, so deleting a rollup would fetch and delete its rows in batches.
+def record_deleted_row(sender, instance, **kwargs):
+    DeletedRow.objects.create(model=sender._meta.label_lower, object_id=instance.pk)
+
+
+class Backup(models.Model):
+    uuid = models.UUIDField(default=uuid.uuid4, unique=True, editable=False,
+                            help_text="Identifies the backup across restores, which reuse the ids")
+    taken = models.DateTimeField(default=timezone.now, help_text="Date the backup was started")
+    base = models.ForeignKey('self', blank=True, null=True, related_name="deltas", on_delete=models.SET_NULL,
+                             help_text="Backup this one holds the changes since, empty for a full backup")
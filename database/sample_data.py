@@ -0,0 +1,169 @@
+import random
+import decimal
+import datetime
+
+from django.db import transaction
+from django.utils import timezone
+
+import database.models
+
+
+# Size of the generated data set, each can be overridden from the command line
+DEFAULT_SCALE = {
+    'suppliers': 20,
+    'sources': 10,
+    'categories': 15,
+    'products': 2000,
+    'customers': 300,
+    'years': 2,
+    'invoices_per_day': 40,
+    'lines_per_invoice': 6,
+}
+
+SCALE_HELP = {
+    'suppliers': "Number of suppliers",
+    'sources': "Number of sources",
+    'categories': "Number of categories",
+    'products': "Number of products",
+    'customers': "Number of customers",
+    'years': "Years of invoices, ending today",
+    'invoices_per_day': "Average number of invoices per day",
+    'lines_per_invoice': "Average number of line items per invoice",
+}
+
+CREDIT_SHARE = 0.3
+RETURN_SHARE = 0.03
+
+WORDS = ['steel', 'brass', 'hinge', 'bolt', 'sheet', 'paint', 'primer', 'bracket', 'handle', 'chain', 'wire', 'pipe',
+         'flange', 'washer', 'nut', 'rivet', 'clamp', 'plate', 'rod', 'angle', 'channel', 'mesh', 'coil', 'grey']
+
+
+def add_scale_arguments(parser):
+    for name, default in DEFAULT_SCALE.items():
+        parser.add_argument('--' + name.replace('_', '-'), dest=name, type=int, default=default, help=SCALE_HELP[name])
+    parser.add_argument('--seed', type=int, default=0, help="Random seed, the same seed and scale give the same data")
+
+
+def money(rng, low, high):
+    return decimal.Decimal(rng.uniform(low, high)).quantize(decimal.Decimal('0.001'))
+
+
+# Generate a synthetic catalogue, customers and years of invoices with returns and credit payments, then build the
+# derived totals and rollups the same way a restore does. Returns the number of rows created per model.
+@transaction.atomic
+def generate(seed=0, batch_size=2000, **scale):
+    scale = dict(DEFAULT_SCALE, **scale)
+    rng = random.Random(seed)
+    models = database.models
+    counts = dict()
+
+    def named(model, count, prefix, **fields):
+        start = model.objects.count()
+        rows = model.objects.bulk_create([model(name='{0} {1}'.format(prefix, start + n), **fields)
+                                          for n in range(count)], batch_size=batch_size)
+        counts[model._meta.label] = len(rows)
+        return rows
+
+    sources = named(models.Source, scale['sources'], "Source")
+    categories = named(models.Category, scale['categories'], "Category")
+    customers = named(models.Customer, scale['customers'], "Customer")
+
+    start = models.Supplier.objects.count()
+    suppliers = models.Supplier.objects.bulk_create([models.Supplier(company="Supplier {0}".format(start + n))
+                                                     for n in range(scale['suppliers'])])
+    counts[models.Supplier._meta.label] = len(suppliers)
+
+    start = models.Product.objects.count()
+    products = []
+    for n in range(scale['products']):
+        cost_price = money(rng, 0.1, 50)
+        products.append(models.Product(name="{0}".format(10000 + start + n),
+                                       description=' '.join(rng.sample(WORDS, 2)),
+                                       size="{0}mm".format(rng.choice([4, 6, 8, 10, 12, 16, 20, 25])),
+                                       cost_price=cost_price,
+                                       sell_price=(cost_price * decimal.Decimal(rng.uniform(1.2, 1.6)))
+                                                  .quantize(decimal.Decimal('0.001')),
+                                       stock=rng.randint(100, 10000),
+                                       source=rng.choice(sources), category=rng.choice(categories),
+                                       supplier=rng.choice(suppliers)))
+    products = models.Product.objects.bulk_create(products, batch_size=batch_size)
+    counts[models.Product._meta.label] = len(products)
+
+    counts.update({models.Invoice._meta.label: 0, models.InvoiceProduct._meta.label: 0,
+                   models.InvoiceCreditPayment._meta.label: 0})
+
+    def flush(pending):
+        invoices = models.Invoice.objects.bulk_create([invoice for invoice, lines, payments in pending])
+        line_items = []
+        payments = []
+        for invoice, lines, invoice_payments in pending:
+            for line in lines:
+                line.invoice = invoice
+            for payment in invoice_payments:
+                payment.invoice = invoice
+            line_items.extend(lines)
+            payments.extend(invoice_payments)
+
+        models.InvoiceProduct.objects.bulk_create(line_items, batch_size=batch_size)
+        models.InvoiceCreditPayment.objects.bulk_create(payments, batch_size=batch_size)
+        counts[models.Invoice._meta.label] += len(invoices)
+        counts[models.InvoiceProduct._meta.label] += len(line_items)
+        counts[models.InvoiceCreditPayment._meta.label] += len(payments)
+
+    now = timezone.now()
+    day = timezone.localdate() - datetime.timedelta(days=365 * scale['years'])
+    pending = []
+    while day <= timezone.localdate():
+        midnight = timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+
+        for _ in range(rng.randint(scale['invoices_per_day'] // 2, scale['invoices_per_day'] * 3 // 2)):
+            date_of_sale = min(midnight + datetime.timedelta(seconds=rng.randint(8 * 3600, 20 * 3600)), now)
+            invoice = models.Invoice(customer=rng.choice(customers), credit=rng.random() < CREDIT_SHARE,
+                                     date_of_sale=date_of_sale, created=date_of_sale)
+
+            total = decimal.Decimal(0)
+            lines = []
+            line_count = min(rng.randint(1, 2 * scale['lines_per_invoice'] - 1), len(products))
+            for product in rng.sample(products, line_count):
+                quantity = rng.randint(1, 10)
+                returned_quantity = rng.randint(1, quantity) if rng.random() < RETURN_SHARE else 0
+                sell_price = (product.sell_price * decimal.Decimal(rng.choice([1, 1, 1, 0.95, 0.9])))\
+                                 .quantize(decimal.Decimal('0.001'))
+                lines.append(models.InvoiceProduct(product=product, quantity=quantity,
+                                                   returned_quantity=returned_quantity, sell_price=sell_price,
+                                                   cost_price=product.cost_price))
+                total += (quantity - returned_quantity) * sell_price
+
+            # Most credit invoices are settled in a few payments, some are part paid or still open
+            payments = []
+            if invoice.credit:
+                outcome = rng.random()
+                paid = total if outcome < 0.75 else (total / 2).quantize(decimal.Decimal('0.001')) if outcome < 0.9 else 0
+                installments = rng.randint(1, 3)
+                for n in range(installments if paid else 0):
+                    amount = paid - sum(payment.payment for payment in payments) if n == installments - 1 \
+                             else (paid / installments).quantize(decimal.Decimal('0.001'))
+                    date_of_payment = min(date_of_sale + datetime.timedelta(days=rng.randint(1, 60)), now)
+                    payments.append(models.InvoiceCreditPayment(payment=amount, date_of_payment=date_of_payment))
+
+            pending.append((invoice, lines, payments))
+
+        if len(pending) >= batch_size:
+            flush(pending)
+            pending = []
+        day += datetime.timedelta(days=1)
+
+    flush(pending)
+
+    # Derived data, as after a restore
+    models.Invoice.objects.refresh_totals()
+    models.DailySales.objects.rebuild()
+    models.MonthlySales.objects.rebuild()
+    models.ProductPair.objects.rebuild()
+    models.CashflowEntry.objects.rebuild()
+    models.Source.objects.refresh_values()
+    models.Category.objects.refresh_values()
+    models.Customer.objects.refresh_outstanding()
+    models.CustomerStatistics.objects.rebuild()
+
+    return counts
@@ -1,3 +1,79 @@
+import decimal
+
 from django.test import TestCase
+from django.utils import timezone
+
+from . import models
+
+
+class SalesTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        supplier = models.Supplier.objects.create(company="Weavers")
+        source = models.Source.objects.create(name="Kashmir")
+        category = models.Category.objects.create(name="Shawls")
+        cls.customer = models.Customer.objects.create(name="Aisha")
+        cls.products = [models.Product.objects.create(name=name, cost_price=2, sell_price=5, stock=100, source=source,
+                                                      category=category, supplier=supplier)
+                        for name in ("Shawl", "Scarf", "Stole", "Shrug")]
+
+    # An invoice of one unit of each product with stored totals to match, old enough for the product pairs unless
+    # settled is False
+    def create_invoice(self, products, settled=True):
+        invoice = models.Invoice.objects.create(customer=self.customer, invoice_total=5 * len(products),
+                                                profit_total=3 * len(products))
+        models.InvoiceProduct.objects.bulk_create([models.InvoiceProduct(invoice=invoice, product=product, quantity=1,
+                                                                         sell_price=5, cost_price=2)
+                                                   for product in products])
+        if settled:
+            models.Invoice.objects.filter(id=invoice.id).update(
+                modified=timezone.now() - models.ProductPair.objects.SETTLE_TIME)
+        return invoice
+
+
+class InvoiceTotalsTests(SalesTestCase):
+
+    def test_drifted_finds_and_refresh_fixes_stale_totals(self):
+        invoice = self.create_invoice(self.products[:2])
+        in_sync = self.create_invoice(self.products[2:])
+        self.assertFalse(models.Invoice.objects.drifted().exists())
+
+        models.InvoiceProduct.objects.filter(invoice=invoice).update(returned_quantity=1)
+        self.assertEqual(list(models.Invoice.objects.drifted().values_list('id', flat=True)), [invoice.id])
+
+        self.assertEqual(models.Invoice.objects.refresh_totals([invoice.id]), 1)
+        self.assertFalse(models.Invoice.objects.drifted().exists())
+        self.assertEqual(models.Invoice.objects.get(id=invoice.id).invoice_total, 0)
+        self.assertEqual(models.Invoice.objects.get(id=in_sync.id).invoice_total, decimal.Decimal('10'))
+
+
+class ProductPairTests(SalesTestCase):
+
+    def pairs(self):
+        return sorted(models.ProductPair.objects.values_list('product', 'companion', 'invoices'))
+
+    def test_refresh_matches_rebuild(self):
+        models.ProductPair.objects.rebuild()
+        self.create_invoice(self.products[:3])
+        self.create_invoice(self.products[1:])
+        self.create_invoice(self.products[:1])
+
+        self.assertEqual(models.ProductPair.objects.refresh(batch_size=2), 3)
+        refreshed = self.pairs()
+
+        models.ProductPair.objects.rebuild()
+        self.assertEqual(refreshed, self.pairs())
+        self.assertIn((self.products[1].id, self.products[2].id, 2), refreshed)
+
+    def test_refresh_waits_for_invoices_to_settle(self):
+        models.ProductPair.objects.rebuild()
+        self.create_invoice(self.products[:2], settled=False)
+
+        self.assertEqual(models.ProductPair.objects.refresh(), 0)
+        self.assertEqual(self.pairs(), [])
 
-# Create your tests here.
+        models.Invoice.objects.update(modified=timezone.now() - models.ProductPair.objects.SETTLE_TIME)
+        self.assertEqual(models.ProductPair.objects.refresh(), 1)
+        self.assertEqual(models.ProductPair.objects.refresh(), 0)
+        self.assertEqual(len(self.pairs()), 4)
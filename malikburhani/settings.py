@@ -44,6 +44,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.metrics.MetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -90,6 +91,24 @@ DATABASES = {
 }
 
 
+# Caches
+# The catalogue cache holds rendered product, category, source and supplier lists and the catalogue version, see
+# api/cache.py. A local memory cache is only correct with a single worker process. With several, point it at a
+# cache they share (Memcached, or a Redis database of its own since invalidation clears the whole cache).
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'catalogue': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'catalogue',
+        'TIMEOUT': 60 * 60,
+        'OPTIONS': {'MAX_ENTRIES': 500},
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/1.10/ref/settings/#auth-password-validators
 
@@ -136,7 +155,28 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static/')
 CORS_ORIGIN_ALLOW_ALL = True
 
 REST_FRAMEWORK = {
-    'DEFAULT_FILTER_BACKENDS': ('django_filters.rest_framework.DjangoFilterBackend',)
+    'DEFAULT_FILTER_BACKENDS': ('django_filters.rest_framework.DjangoFilterBackend',),
+    'DEFAULT_RENDERER_CLASSES': (
+        'rest_framework.renderers.JSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+        'api.renderers.NDJSONRenderer',
+    ),
+    # Default page size for the paginated lists (products, customers, invoices). None leaves them unpaginated
+    # unless the client passes ?page_size=
+    'PAGE_SIZE': None,
 }
 
+# API metrics, see api/metrics.py
+# Share of requests instrumented with query counts and timings, 0 turns the instrumentation off. Sampled requests
+# slower than METRICS_SLOW_REQUEST_SECONDS are logged with their SQL, None disables the log. The metrics endpoint
+# only answers INTERNAL_IPS.
+METRICS_SAMPLE_RATE = 0.0
+METRICS_SLOW_REQUEST_SECONDS = None
+INTERNAL_IPS = ['127.0.0.1']
+
+# Answer /sales/analytics from invoice lines held in memory by each worker process, see api/analytics.py. Every
+# worker then holds the whole line history. Needs NumPy, without it or when False the reports are aggregated by the
+# database.
+SALES_ANALYTICS_IN_MEMORY = False
+
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
@@ -16,7 +16,7 @@ Including another URLconf
 from django.urls import re_path, include
 from django.contrib import admin
 from rest_framework import routers
-from api import views
+from api import views, metrics
 
 
 router = routers.DefaultRouter()
@@ -35,10 +35,15 @@ router.register(r'sales/category_source', views.SalesCategorySourceViewSet, 'Inv
 router.register(r'sales/products', views.SalesProductsViewSet, 'InvoiceProduct')
 router.register(r'sales/suppliers', views.SalesSuppliersViewSet, 'InvoiceProduct')
 router.register(r'sales/customers', views.SalesCustomersViewSet, 'InvoiceProduct')
+router.register(r'sales/analytics', views.SalesAnalyticsViewSet, 'InvoiceProduct')
 router.register(r'cashflow/total', views.CashflowTotalViewSet, 'Invoice')
+router.register(r'receivables', views.ReceivablesViewSet, 'Invoice')
 router.register(r'stock/sold/total', views.StockSoldTotalViewSet, 'InvoiceProduct')
+router.register(r'stock/velocity', views.StockVelocityViewSet, 'Product')
+router.register(r'stock/reorder', views.StockReorderViewSet, 'Product')
 
 
 urlpatterns = [
 	re_path(r'^api/v1/', include(router.urls)),
+	re_path(r'^internal/metrics$', metrics.metrics_view),
 ]